@@ -0,0 +1,276 @@
+"""
+Benchmarks preprocessing, index loading and query throughput on synthetic street networks, and writes the results
+as JSON. Compare against the results of another version with --compare to catch regressions:
+
+    $ python benchmark/benchmark.py --sizes 20 60 --output before.json
+    $ python benchmark/benchmark.py --sizes 20 60 --output after.json --compare before.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+# benchmark the working tree, not an installed copy of the package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import intersection_proximity
+from intersection_proximity import IntersectionProximity
+from intersection_proximity._intersection_proximity import get_intermediate_files, get_intermediates_path
+from intersection_proximity.preprocessing import generate_street_edge_name_map, generate_intersection_points, \
+    generate_real_segments, generate_segment_index, generate_intersection_index, make_street_network_index
+from synthetic_city import make_city, get_bounds
+
+
+def get_peak_rss():
+    """
+    :return: peak resident set size of this process, in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def time_preprocessing(city_config, settings, workers):
+    """
+    Run every preprocessing stage, like run_preprocess does, and time each of them
+    :return: dict of stage -> seconds
+    """
+    stages = [
+        ('street_edge_name_map', lambda: generate_street_edge_name_map(
+            settings['road_network_dump'], settings['osm_way_ids'], settings['street_edge_name_filename'])),
+        ('intersection_points', lambda: generate_intersection_points(
+            settings['street_network_filename'], settings['street_edge_name_filename'],
+            settings['intersection_points_filename'],
+            street_network_cache_file=settings['street_network_cache_filename'])),
+        ('real_segments', lambda: generate_real_segments(
+            settings['street_network_filename'], settings['intersection_points_filename'],
+            settings['street_edge_name_filename'], settings['real_segments_output_filename'], workers=workers,
+            street_network_cache_file=settings['street_network_cache_filename'],
+            segment_streets_file=settings['segment_streets_filename'])),
+        ('segment_index', lambda: generate_segment_index(
+            settings['real_segments_output_filename'], settings['segment_index_dirname'],
+            city_config.get('metric_crs'), settings['segment_streets_filename'])),
+        ('intersection_index', lambda: generate_intersection_index(
+            settings['intersection_points_filename'], settings['intersection_index_dirname'])),
+    ]
+    seconds = {}
+    for stage, run in stages:
+        start = time.perf_counter()
+        run()
+        seconds[stage] = time.perf_counter() - start
+    seconds['total'] = sum(seconds.values())
+    return seconds
+
+
+def measure_load(target, city_config, queue):
+    """
+    Load a preprocessed city in a fresh process, so its peak memory use can be measured on its own
+    :param target: 'intersection_proximity' or 'make_street_network_index'
+    """
+    rss_before = get_peak_rss()
+    start = time.perf_counter()
+    if target == 'intersection_proximity':
+        IntersectionProximity(city_config, cache_results=False)
+    else:
+        make_street_network_index(get_intermediate_files(city_config)['real_segments_output_filename'])
+    queue.put({'seconds': time.perf_counter() - start, 'rss_before_bytes': rss_before,
+               'peak_rss_bytes': get_peak_rss()})
+
+
+def time_load(target, city_config):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    process = context.Process(target=measure_load, args=(target, city_config, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def time_import():
+    """
+    Import the package in a fresh interpreter, on top of NumPy, like a worker that only answers queries
+    :return: seconds the import took
+    """
+    code = ("import sys, time; sys.path.insert(0, {!r}); import numpy; start = time.perf_counter(); "
+            "import intersection_proximity; print(time.perf_counter() - start)").format(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    return float(subprocess.check_output([sys.executable, '-c', code]))
+
+
+def get_latency_stats(seconds):
+    """
+    :param seconds: array of the duration of every call
+    :return: dict of latency percentiles, in milliseconds
+    """
+    milliseconds = 1000 * np.asarray(seconds)
+    return {
+        'mean': float(milliseconds.mean()),
+        'p50': float(np.percentile(milliseconds, 50)),
+        'p90': float(np.percentile(milliseconds, 90)),
+        'p99': float(np.percentile(milliseconds, 99)),
+        'max': float(milliseconds.max())
+    }
+
+
+def time_scalar_queries(ip, points):
+    seconds = np.empty(len(points))
+    for i, (lng, lat) in enumerate(points.tolist()):
+        start = time.perf_counter()
+        ip.compute_proximity(lat, lng)
+        seconds[i] = time.perf_counter() - start
+    return {'queries': len(points), 'throughput': len(points) / seconds.sum(),
+            'latency_ms': get_latency_stats(seconds)}
+
+
+def time_batch_queries(ip, points, batch_size):
+    seconds = []
+    for start_index in range(0, len(points), batch_size):
+        batch = points[start_index:start_index + batch_size]
+        start = time.perf_counter()
+        ip.compute_proximity_many(batch[:, 1], batch[:, 0])
+        seconds.append(time.perf_counter() - start)
+    return {'queries': len(points), 'batch_size': batch_size, 'throughput': len(points) / sum(seconds),
+            'latency_ms': get_latency_stats(seconds)}
+
+
+def run_benchmark(kind, size, args):
+    """
+    Benchmark one synthetic city
+    :return: dict of results
+    """
+    print('Benchmarking {} city of size {}... '.format(kind, size), end='', flush=True)
+    data_dir = tempfile.mkdtemp(prefix='intersection-proximity-benchmark-')
+    city_config = make_city(data_dir, size, kind, seed=args.seed)
+    # lay the intermediates out like IntersectionProximity does, so it loads them instead of preprocessing again
+    intermediates_path = get_intermediates_path(city_config)
+    settings = {**city_config, **get_intermediate_files(city_config)}
+    os.makedirs(intermediates_path, exist_ok=True)
+
+    try:
+        with open(city_config['osm_way_ids']) as f:
+            edges = sum(1 for _ in f) - 1
+        result = {
+            'network': {'kind': kind, 'size': size, 'edges': edges},
+            'preprocess_seconds': time_preprocessing(city_config, settings, args.workers),
+            'load': {
+                'import_seconds': time_import(),
+                'intersection_proximity': time_load('intersection_proximity', city_config),
+                'make_street_network_index': time_load('make_street_network_index', city_config)
+            }
+        }
+
+        ip = IntersectionProximity(city_config, cache_results=False)
+        result['network']['segments'] = len(ip.segment_offsets) - 1
+        result['network']['sub_segments'] = len(ip.sub_segment_line)
+
+        # labels spread over the city and a little past its edges
+        rng = np.random.RandomState(args.seed)
+        bounds = np.array(get_bounds(size))
+        margin = 2 * (bounds[2] - bounds[0]) / size
+        points = rng.uniform(bounds[:2] - margin, bounds[2:] + margin, (args.batch_queries, 2))
+        result['scalar'] = time_scalar_queries(ip, points[:args.scalar_queries])
+        result['scalar_grid'] = time_scalar_queries(
+            IntersectionProximity(city_config, cache_results=False, index_backend='grid'), points[:args.scalar_queries])
+        result['batch'] = time_batch_queries(ip, points, args.batch_size)
+    finally:
+        shutil.rmtree(intermediates_path, ignore_errors=True)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+    print('Done!')
+    return result
+
+
+def flatten(results, prefix=''):
+    """
+    Flatten nested result dicts into {'a.b.c': value}
+    """
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print how every timing changed since a baseline run
+    :param tolerance: fraction by which a metric may get worse before it counts as a regression
+    :return: number of regressions
+    """
+    baseline_runs = {(r['network']['kind'], r['network']['size']): r for r in baseline['results']}
+    regressions = 0
+    for run in results['results']:
+        key = (run['network']['kind'], run['network']['size'])
+        if key not in baseline_runs:
+            continue
+        old = flatten(baseline_runs[key])
+        for metric, value in flatten(run).items():
+            if metric.startswith('network.') or metric.endswith('.queries') or metric.endswith('batch_size') \
+                    or metric.endswith('rss_before_bytes') or metric not in old or not old[metric]:
+                continue
+            # throughput should go up; times and memory use should go down
+            change = value / old[metric] - 1
+            worse = -change if metric.endswith('throughput') else change
+            flag = ''
+            if worse > tolerance:
+                flag = '  <-- REGRESSION'
+                regressions += 1
+            print('{} {} {}: {:.4g} -> {:.4g} ({:+.1%}){}'.format(key[0], key[1], metric, old[metric], value,
+                                                                  change, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark intersection_proximity on synthetic street networks")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 60],
+                        help="numbers of streets in each direction of the synthetic cities")
+    parser.add_argument('--kinds', nargs='+', default=['grid', 'irregular'], choices=['grid', 'irregular'])
+    parser.add_argument('--scalar-queries', type=int, default=2000)
+    parser.add_argument('--batch-queries', type=int, default=200000)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    parser.add_argument('--workers', type=int, default=1, help="number of processes to preprocess with")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help="JSON results of an earlier run to compare with")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="fraction by which a metric may get worse before it is reported as a regression")
+    args = parser.parse_args()
+
+    results = {
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'package': os.path.dirname(intersection_proximity.__file__),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S%z')
+        },
+        'parameters': vars(args),
+        'results': [run_benchmark(kind, size, args) for kind in args.kinds for size in args.sizes]
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to {}'.format(args.output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('{} regressions'.format(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+import json
+import os
+import struct
+import numpy as np
+
+# Synthetic street networks in the input format of a city config: a GeoJSON FeatureCollection of street edges,
+# an osm_way_ids CSV and a road network DBF, so that benchmarks need no downloaded data.
+
+ORIGIN = (-122.35, 47.65)  # southwest corner of every synthetic city, in (lng, lat)
+BLOCK_SIZE = 0.0012  # length of a block, in degrees
+
+
+def get_street_edges(size, kind, rng):
+    """
+    Lay out the street edges of a size x size city
+    :param kind: 'grid' for straight streets on a regular grid, 'irregular' for a jittered grid with curved
+    blocks, missing blocks and unnamed streets
+    :return: list of (osm way id, street name, coordinates) for every street edge
+    """
+    x, y = np.meshgrid(np.arange(size), np.arange(size), indexing='ij')
+    nodes = np.stack((ORIGIN[0] + x * BLOCK_SIZE, ORIGIN[1] + y * BLOCK_SIZE), axis=-1)
+    if kind == 'irregular':
+        nodes += rng.uniform(-0.25, 0.25, nodes.shape) * BLOCK_SIZE
+    elif kind != 'grid':
+        raise Exception("Unknown street network kind: {}".format(kind))
+
+    edges = []
+    for direction, suffix in ((0, 'St'), (1, 'Ave')):
+        for i in range(size):
+            way_id = 1000000 * (direction + 1) + i
+            name = '{} {}'.format(i, suffix)
+            if kind == 'irregular' and rng.random_sample() < 0.05:
+                name = ''
+            line = nodes[:, i] if direction == 0 else nodes[i, :]
+            for j in range(size - 1):
+                if kind == 'irregular' and rng.random_sample() < 0.1:
+                    continue
+                start, end = line[j], line[j + 1]
+                # a midpoint vertex, bent sideways in irregular cities
+                n_inner = 1 if kind == 'grid' else rng.randint(1, 5)
+                t = np.linspace(0, 1, n_inner + 2)[:, None]
+                coords = start + t * (end - start)
+                if kind == 'irregular':
+                    normal = np.array([-(end - start)[1], (end - start)[0]])
+                    coords[1:-1] += np.sin(np.pi * t[1:-1]) * rng.uniform(-0.1, 0.1) * normal
+                edges.append((way_id, name, coords))
+    return edges
+
+
+def write_dbf(filename, records):
+    """
+    Write a minimal dBASE III file with the osm_id and name columns a road network dump has
+    :param records: list of (osm id, name)
+    """
+    fields = [(b'osm_id', b'N', 12), (b'name', b'C', 40)]
+    header_length = 32 + 32 * len(fields) + 1
+    record_length = 1 + sum(length for _, _, length in fields)
+    with open(filename, 'wb') as f:
+        f.write(struct.pack('<BBBBIHH20x', 3, 120, 1, 1, len(records), header_length, record_length))
+        for name, field_type, length in fields:
+            f.write(struct.pack('<11sc4xBB14x', name, field_type, length, 0))
+        f.write(b'\r')
+        for osm_id, name in records:
+            f.write(b' ' + str(osm_id).rjust(12).encode() + name.encode().ljust(40)[:40])
+        f.write(b'\x1a')
+
+
+def make_city(directory, size, kind='grid', seed=0):
+    """
+    Write the input files of a synthetic city
+    :param directory: directory to write the files to
+    :param size: number of streets in each direction
+    :param kind: 'grid' or 'irregular', see get_street_edges
+    :param seed: random seed, so the same arguments always make the same city
+    :return: city config dictionary for the files
+    """
+    rng = np.random.RandomState(seed)
+    edges = get_street_edges(size, kind, rng)
+    os.makedirs(directory, exist_ok=True)
+
+    city_config = {
+        'street_network_filename': os.path.join(directory, 'streets.geojson'),
+        'osm_way_ids': os.path.join(directory, 'osm-way-ids.csv'),
+        'road_network_dump': os.path.join(directory, 'roads.dbf'),
+    }
+
+    features = [{
+        'type': 'Feature',
+        'properties': {'street_edge_id': edge_id},
+        'geometry': {'type': 'LineString', 'coordinates': coords.tolist()}
+    } for edge_id, (_, _, coords) in enumerate(edges, 1)]
+    with open(city_config['street_network_filename'], 'w') as f:
+        json.dump({'type': 'FeatureCollection', 'features': features}, f)
+
+    with open(city_config['osm_way_ids'], 'w') as f:
+        f.write('street_edge_id,osm_way_id\n')
+        for edge_id, (way_id, _, _) in enumerate(edges, 1):
+            f.write('{},{}\n'.format(edge_id, way_id))
+
+    names = {way_id: name for way_id, name, _ in edges}
+    write_dbf(city_config['road_network_dump'], sorted(names.items()))
+    return city_config
+
+
+def get_bounds(size):
+    """
+    :return: (min_lng, min_lat, max_lng, max_lat) around a synthetic city of the given size
+    """
+    extent = (size - 1) * BLOCK_SIZE
+    return ORIGIN[0], ORIGIN[1], ORIGIN[0] + extent, ORIGIN[1] + extent
@@ -1,2 +1,15 @@
 from ._intersection_proximity import IntersectionProximity
+from ._registry import CityRegistry
+from ._metrics import ProximityMetrics
 from .settings import default_settings
+
+# Only what answering queries needs is imported with the package, so processes that just load preprocessed cities
+# start quickly. Preprocessing dependencies are imported when a city is preprocessed, and asyncio when
+# AsyncIntersectionProximity is first used.
+
+
+def __getattr__(name):
+    if name == 'AsyncIntersectionProximity':
+        from ._async import AsyncIntersectionProximity
+        return AsyncIntersectionProximity
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
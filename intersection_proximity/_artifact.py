@@ -0,0 +1,161 @@
+import hashlib
+import io
+import json
+import os
+import shutil
+import tarfile
+import time
+from ._lock import FileLock
+from .settings import *
+
+# An artifact bundle holds everything a city's queries read, so workers can load a city that a separate build job
+# preprocessed, without its input files. It is a tar file of the segment index, the intersection index and any
+# rasters, plus a manifest.json (stored first) with the bundle format version, the city config and the SHA-256 of
+# every file. Bundles are unpacked into the cache directory once, and checked against the manifest as they are.
+
+MANIFEST_FILENAME = 'manifest.json'
+# intermediate files bundled, by their setting names; the rest are only needed to preprocess
+ARTIFACT_FILES = ('segment_index_dirname', 'intersection_index_dirname', 'raster_dirname',
+                  'input_fingerprints_filename')
+
+
+def get_sha256(file):
+    """
+    :param file: file object open for reading in binary mode
+    :return: SHA-256 hex digest of the rest of the file
+    """
+    sha256 = hashlib.sha256()
+    for block in iter(lambda: file.read(1 << 20), b''):
+        sha256.update(block)
+    return sha256.hexdigest()
+
+
+def list_artifact_files(intermediate_files):
+    """
+    List the files of a city's intermediates that go into its artifact bundle. Lock files and the temporary files
+    of builds in progress are left out.
+    :param intermediate_files: dict of setting name -> path, from get_intermediate_files
+    :return: list of (path, path in the bundle)
+    """
+    intermediates_path = os.path.dirname(intermediate_files['segment_index_dirname'])
+    files = []
+    for key in ARTIFACT_FILES:
+        path = intermediate_files[key]
+        if os.path.isfile(path):
+            files.append(path)
+        for directory, subdirectories, filenames in os.walk(path):
+            subdirectories[:] = sorted(d for d in subdirectories if not d.endswith('.tmp'))
+            files.extend(os.path.join(directory, filename) for filename in sorted(filenames)
+                         if not filename.endswith(('.lock', '.tmp.npy')))
+    return [(path, os.path.relpath(path, intermediates_path).replace(os.sep, '/')) for path in files]
+
+
+def write_artifact(intermediate_files, city_config, artifact_file):
+    """
+    Bundle the intermediate files of a city into an artifact. The bundle is written next to artifact_file and
+    moved into place once complete.
+    :param intermediate_files: dict of setting name -> path, from get_intermediate_files
+    :param city_config: city config dictionary the intermediate files were built from
+    :param artifact_file: tar file to write
+    :return: the manifest of the bundle
+    """
+    files = list_artifact_files(intermediate_files)
+    checksums = {}
+    for path, name in files:
+        with open(path, 'rb') as f:
+            checksums[name] = get_sha256(f)
+    manifest = {
+        'format_version': ARTIFACT_FORMAT_VERSION,
+        'city_config': city_config,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'files': checksums
+    }
+
+    temporary_file = artifact_file + '.tmp'
+    with tarfile.open(temporary_file, 'w') as tar:
+        manifest_bytes = json.dumps(manifest, indent=2).encode()
+        info = tarfile.TarInfo(MANIFEST_FILENAME)
+        info.size, info.mtime = len(manifest_bytes), time.time()
+        tar.addfile(info, io.BytesIO(manifest_bytes))
+        for path, name in files:
+            tar.add(path, name)
+    os.replace(temporary_file, artifact_file)
+    return manifest
+
+
+def read_manifest(tar):
+    """
+    Read the manifest of an artifact bundle and check that this version of the package can load the bundle
+    :param tar: the bundle, as an open TarFile
+    """
+    try:
+        manifest = json.load(tar.extractfile(MANIFEST_FILENAME))
+    except KeyError:
+        raise Exception("{} is not an artifact bundle: it has no {}".format(tar.name, MANIFEST_FILENAME))
+    if manifest.get('format_version') != ARTIFACT_FORMAT_VERSION:
+        raise Exception("Artifact bundle {} has format version {}, but this version of intersection_proximity loads "
+                        "version {}".format(tar.name, manifest.get('format_version'), ARTIFACT_FORMAT_VERSION))
+    return manifest
+
+
+def extract_file(tar, name, checksum, directory):
+    """
+    Extract a file of an artifact bundle and check it against its checksum
+    :param tar: the bundle, as an open TarFile
+    :param name: path of the file in the bundle
+    :param checksum: SHA-256 of the file, from the manifest
+    :param directory: directory to extract the file into, under its path in the bundle
+    """
+    parts = name.split('/')
+    if name.startswith('/') or '..' in parts:
+        raise Exception("Artifact bundle {} has a file outside of it: {}".format(tar.name, name))
+    try:
+        member = tar.extractfile(name)
+    except KeyError:
+        member = None
+    if member is None:
+        raise Exception("Artifact bundle {} is missing {}".format(tar.name, name))
+
+    path = os.path.join(directory, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        shutil.copyfileobj(member, f)
+    with open(path, 'rb') as f:
+        if get_sha256(f) != checksum:
+            raise Exception("Artifact bundle {} is corrupt: the checksum of {} doesn't match".format(tar.name, name))
+
+
+def unpack_artifact(artifact_file, cache_dir):
+    """
+    Unpack an artifact bundle into the cache directory, unless it was unpacked before. Every file is checked
+    against its checksum in the manifest. Processes unpacking the same bundle at the same time wait for the first
+    one instead of unpacking it again.
+    :param artifact_file: tar file written by write_artifact
+    :param cache_dir: directory to unpack bundles under
+    :return: (directory the bundle was unpacked to, manifest)
+    """
+    with tarfile.open(artifact_file) as tar:
+        manifest = read_manifest(tar)
+        # bundles are told apart by their manifest, which holds the checksums of all their files
+        manifest_hash = hashlib.sha256(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+        artifacts_path = os.path.join(cache_dir, 'artifacts')
+        artifact_path = os.path.join(artifacts_path, manifest_hash)
+        if os.path.exists(artifact_path):
+            return artifact_path, manifest
+
+        os.makedirs(artifacts_path, exist_ok=True)
+        with FileLock(artifact_path + '.lock'):
+            if os.path.exists(artifact_path):
+                return artifact_path, manifest
+
+            temporary_path = artifact_path + '.tmp'
+            shutil.rmtree(temporary_path, ignore_errors=True)
+            try:
+                for name, checksum in manifest['files'].items():
+                    extract_file(tar, name, checksum, temporary_path)
+            except Exception:
+                # leave nothing half-unpacked behind
+                shutil.rmtree(temporary_path, ignore_errors=True)
+                raise
+            os.replace(temporary_path, artifact_path)
+    return artifact_path, manifest
@@ -0,0 +1,94 @@
+import asyncio
+import numpy as np
+from .settings import *
+
+
+class AsyncIntersectionProximity:
+    """
+    Asyncio front-end for an IntersectionProximity (or a CityRegistry). Labels awaited at about the same time are
+    collected for a short window, scored together with one compute_proximity_many call in an executor, and each
+    caller gets its own result back. A batch is scored as soon as max_batch_size labels are waiting, so no label
+    waits longer than batch_window plus the time to score its batch.
+    """
+    def __init__(self, intersection_proximity, batch_window=ASYNC_BATCH_WINDOW, max_batch_size=ASYNC_MAX_BATCH_SIZE,
+                 executor=None):
+        """
+        :param intersection_proximity: IntersectionProximity or CityRegistry to score labels with
+        :param batch_window: seconds to wait for more labels after the first one of a batch arrives
+        :param max_batch_size: number of waiting labels that makes a batch be scored right away
+        :param executor: concurrent.futures executor to score batches in; the event loop's default one if None
+        """
+        self.intersection_proximity = intersection_proximity
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.executor = executor
+        self._pending = []
+        self._flush_handle = None
+        self._running = set()
+
+    async def compute_proximity(self, label_lat, label_lng):
+        """
+        Compute the proximity of a label, batched with the other labels awaited at the same time
+        :return: tuple (absolute_dist_in_meters, middleness_percentage), or None if the label has no result
+        """
+        cache = getattr(self.intersection_proximity, 'proximity_cache', None)
+        if cache is not None:
+            cached = cache.get(label_lat, label_lng)
+            if cached is not None:
+                return cached
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((label_lat, label_lng, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+        return await future
+
+    def _flush(self):
+        """
+        Start scoring the waiting labels as one batch
+        """
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._pending:
+            return
+        batch, self._pending = self._pending, []
+        task = asyncio.get_running_loop().create_task(self._score_batch(batch))
+        # keep a reference to the task until it is done, so it isn't garbage collected
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _score_batch(self, batch):
+        lats = np.array([label[0] for label in batch], dtype=np.float64)
+        lngs = np.array([label[1] for label in batch], dtype=np.float64)
+        try:
+            distances, middleness = await asyncio.get_running_loop().run_in_executor(
+                self.executor, self.intersection_proximity.compute_proximity_many, lats, lngs)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        cache = getattr(self.intersection_proximity, 'proximity_cache', None)
+        for i, (label_lat, label_lng, future) in enumerate(batch):
+            if np.isnan(distances[i]):
+                result = None
+            else:
+                result = float(distances[i]), float(middleness[i])
+                if cache is not None:
+                    cache.put(label_lat, label_lng, result)
+            # callers that were cancelled while waiting don't get a result
+            if not future.done():
+                future.set_result(result)
+
+    async def flush(self):
+        """
+        Score the waiting labels now, and wait until every batch has been scored
+        """
+        self._flush()
+        if self._running:
+            await asyncio.gather(*list(self._running))
@@ -0,0 +1,321 @@
+import numpy as np
+import os
+from .settings import *
+
+# Array versions of the helpers in _intersection_proximity, used to answer many queries at once.
+# Every real segment is flattened into one (n_vertices, 2) vertex array plus an offsets array, so
+# segment i owns vertices[offsets[i]:offsets[i+1]]. Sub-segments (pairs of consecutive vertices) are
+# numbered in the same order get_rtree numbers them, which lets us go from a sub-segment id to its
+# first vertex with sub_segment_id + segment_id.
+
+
+def save_array(filename, array):
+    """
+    Write an array to a .npy file. The file is replaced in one step, so processes that have the old file
+    memory-mapped keep reading the old contents.
+    """
+    temporary_filename = filename + '.tmp.npy'
+    np.save(temporary_filename, array)
+    os.replace(temporary_filename, filename)
+
+
+def get_segment_arrays(real_segments):
+    """
+    Flatten a list of real segments into a vertex array and an offsets array
+    :param real_segments: list of shapely LineStrings
+    :return: (vertices, offsets), where segment i is vertices[offsets[i]:offsets[i+1]]
+    """
+    lengths = np.array([len(segment.coords) for segment in real_segments], dtype=np.int64)
+    offsets = np.zeros(len(real_segments) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+
+    vertices = np.empty((offsets[-1], 2), dtype=np.float64)
+    for i, segment in enumerate(real_segments):
+        vertices[offsets[i]:offsets[i + 1]] = np.asarray(segment.coords)[:, :2]
+    return vertices, offsets
+
+
+def get_sub_segment_arrays(offsets):
+    """
+    Get, for every sub-segment, the id of the real segment it belongs to and the index of its first vertex
+    :param offsets: segment offsets from get_segment_arrays
+    :return: (sub_segment_line, sub_segment_vertex)
+    """
+    counts = np.diff(offsets) - 1
+    sub_segment_line = np.repeat(np.arange(len(counts)), counts)
+    sub_segment_vertex = np.arange(len(sub_segment_line)) + sub_segment_line
+    return sub_segment_line, sub_segment_vertex
+
+
+def get_cumulative_lengths(vertices, offsets):
+    """
+    Get the distance along its segment at every vertex, starting from 0 at each segment's first vertex
+    :param vertices: vertex array from get_segment_arrays, in any planar coordinates
+    :param offsets: segment offsets from get_segment_arrays
+    :return: array with one cumulative length per vertex
+    """
+    step = np.zeros(len(vertices))
+    step[1:] = np.hypot(*(vertices[1:] - vertices[:-1]).T)
+    # the first vertex of every segment starts over at 0
+    step[offsets[:-1]] = 0
+    cumulative = np.cumsum(step)
+    cumulative -= np.repeat(cumulative[offsets[:-1]], np.diff(offsets))
+    return cumulative
+
+
+def get_distance_many(points, starts, ends):
+    """
+    Closest point on each segment starts[i]-ends[i] to points[i]
+    :return: (closest points, distances)
+    """
+    direction = ends - starts
+    denominator = (direction ** 2).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        t = ((points - starts) * direction).sum(axis=1) / denominator
+    # degenerate segments are a single point
+    t = np.clip(np.nan_to_num(t), 0, 1)
+    closest = starts + t[:, None] * direction
+    return closest, np.hypot(*(points - closest).T)
+
+
+def expand_ranges(counts):
+    """
+    Enumerate the elements of consecutive groups with the given sizes
+    :param counts: size of every group
+    :return: (group of every element, index of every element within its group)
+    """
+    group = np.repeat(np.arange(len(counts)), counts)
+    k = np.arange(len(group)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return group, k
+
+
+class SegmentGrid:
+    """
+    Uniform grid over the sub-segments of the street network for answering batched lookups with array
+    operations. Each sub-segment is stored in every cell that its bounding box, padded by MIN_SIZE,
+    overlaps; so a cell holds every sub-segment the rtree would return for a query box around any point
+    inside it.
+    """
+    def __init__(self, starts, ends, pad=MIN_SIZE, ids=None):
+        """
+        :param starts: (n, 2) array of the first vertex of every sub-segment
+        :param ends: (n, 2) array of the second vertex of every sub-segment
+        :param pad: distance to pad the bounding box of every sub-segment by
+        :param ids: id to store for every sub-segment; by default its position in starts and ends
+        """
+        self.pad = pad
+        self.cell_size = 2 * pad
+
+        low = np.minimum(starts, ends) - pad
+        high = np.maximum(starts, ends) + pad
+        self.origin = low.min(axis=0)
+        first_cell = np.floor((low - self.origin) / self.cell_size).astype(np.int64)
+        last_cell = np.floor((high - self.origin) / self.cell_size).astype(np.int64)
+        self.shape = last_cell.max(axis=0) + 1
+
+        # expand every sub-segment into the list of (cell, sub-segment) pairs it covers
+        span = last_cell - first_cell + 1
+        sub_segment, k = expand_ranges(span[:, 0] * span[:, 1])
+        cell_x = first_cell[sub_segment, 0] + k % span[sub_segment, 0]
+        cell_y = first_cell[sub_segment, 1] + k // span[sub_segment, 0]
+        keys = cell_x * self.shape[1] + cell_y
+
+        order = np.argsort(keys, kind='stable')
+        self.keys, cell_start = np.unique(keys[order], return_index=True)
+        self.cell_start = np.append(cell_start, len(keys))
+        self.entries = sub_segment[order] if ids is None else np.asarray(ids)[sub_segment[order]]
+
+    def save(self, directory):
+        """
+        Write the grid as .npy files in a directory
+        """
+        save_array(os.path.join(directory, 'grid-geometry.npy'),
+                   np.array([self.pad, self.origin[0], self.origin[1], self.shape[0], self.shape[1]]))
+        save_array(os.path.join(directory, 'grid-keys.npy'), self.keys)
+        save_array(os.path.join(directory, 'grid-cell-start.npy'), self.cell_start)
+        save_array(os.path.join(directory, 'grid-entries.npy'), self.entries.astype(np.int32))
+
+    @classmethod
+    def load(cls, directory):
+        """
+        Open a grid written by save, memory-mapping its arrays
+        """
+        grid = cls.__new__(cls)
+        geometry = np.load(os.path.join(directory, 'grid-geometry.npy'))
+        grid.pad = geometry[0]
+        grid.cell_size = 2 * grid.pad
+        grid.origin = geometry[1:3]
+        grid.shape = geometry[3:5].astype(np.int64)
+        grid.keys = np.load(os.path.join(directory, 'grid-keys.npy'), mmap_mode='r')
+        grid.cell_start = np.load(os.path.join(directory, 'grid-cell-start.npy'), mmap_mode='r')
+        grid.entries = np.load(os.path.join(directory, 'grid-entries.npy'), mmap_mode='r')
+        return grid
+
+    @property
+    def bounds(self):
+        """
+        Bounding box (min_x, min_y, max_x, max_y) covered by the grid's cells
+        """
+        high = self.origin + self.shape * self.cell_size
+        return float(self.origin[0]), float(self.origin[1]), float(high[0]), float(high[1])
+
+    def candidates(self, points, radius=0):
+        """
+        Get the sub-segments stored in the cells within some number of cells of each point's cell. Every
+        sub-segment within radius * cell_size + pad of a point is among its candidates.
+        :param points: (n, 2) array of (lng, lat)
+        :param radius: number of cells to search around each point's cell, for all points or for each one
+        :return: (point index, sub-segment id) arrays, grouped by point index
+        """
+        cell = np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+        radius = np.broadcast_to(radius, len(points))[:, None]
+        return self._cell_range_entries(cell - radius, cell + radius, points, radius[:, 0] * self.cell_size + self.pad)
+
+    def candidates_in_boxes(self, boxes):
+        """
+        Get the sub-segments stored in the cells each box overlaps, which include every sub-segment whose
+        bounding box intersects the box. A sub-segment may be returned more than once for the same box.
+        :param boxes: (n, 4) array of (min_lng, min_lat, max_lng, max_lat)
+        :return: (box index, sub-segment id) arrays, grouped by box index
+        """
+        low = np.floor((boxes[:, :2] - self.origin) / self.cell_size).astype(np.int64)
+        high = np.floor((boxes[:, 2:] - self.origin) / self.cell_size).astype(np.int64)
+        return self._cell_range_entries(low, high)
+
+    def _cell_range_entries(self, low, high, points=None, reach=None):
+        """
+        Get the sub-segments stored in rectangles of cells
+        :param low: (n, 2) array of the first cell of every rectangle in each direction
+        :param high: (n, 2) array of the last cell of every rectangle in each direction
+        :param points: if given with reach, only the cells of each rectangle within reach of its point are used
+        :param reach: distance from each point
+        :return: (rectangle index, sub-segment id) arrays, grouped by rectangle index
+        """
+        low = np.maximum(low, 0)
+        high = np.minimum(high, self.shape - 1)
+        # rectangles entirely outside the grid have no cells
+        span = np.maximum(high - low + 1, 0)
+
+        rectangle_of_cell, k = expand_ranges(span[:, 0] * span[:, 1])
+        cell_x = low[rectangle_of_cell, 0] + k % span[rectangle_of_cell, 0]
+        cell_y = low[rectangle_of_cell, 1] + k // span[rectangle_of_cell, 0]
+        if points is not None:
+            # the corners of a large neighborhood are farther away than anything a search needs
+            cell_low = self.origin + np.column_stack((cell_x, cell_y)) * self.cell_size
+            gap = np.maximum(np.maximum(cell_low - points[rectangle_of_cell],
+                                        points[rectangle_of_cell] - (cell_low + self.cell_size)), 0)
+            near = np.hypot(*gap.T) <= reach[rectangle_of_cell]
+            rectangle_of_cell, cell_x, cell_y = rectangle_of_cell[near], cell_x[near], cell_y[near]
+        keys = cell_x * self.shape[1] + cell_y
+
+        position = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        found = self.keys[position] == keys
+        first = self.cell_start[position]
+        counts = np.where(found, self.cell_start[position + 1] - first, 0)
+
+        cell_of_entry, k = expand_ranges(counts)
+        return rectangle_of_cell[cell_of_entry], self.entries[first[cell_of_entry] + k]
+
+    def cells_to_grid(self, points):
+        """
+        Get the number of cells between each point's cell and the nearest cell of the grid; 0 for points inside it
+        """
+        cell = np.floor((points - self.origin) / self.cell_size).astype(np.int64)
+        return np.maximum(np.maximum(-cell, cell - (self.shape - 1)), 0).max(axis=1)
+
+    def covers(self, points, radius):
+        """
+        Check whether searching radius cells around each point's cell searches the whole grid. candidates only
+        searches the cells within reach of the point, so the farthest corner of the grid must be within reach.
+        """
+        min_x, min_y, max_x, max_y = self.bounds
+        farthest = np.hypot(np.maximum(points[:, 0] - min_x, max_x - points[:, 0]),
+                            np.maximum(points[:, 1] - min_y, max_y - points[:, 1]))
+        return radius * self.cell_size + self.pad >= farthest
+
+
+def get_closest_candidates(grid, vertices, sub_segment_line, points, radius, candidate_counts=None):
+    """
+    Get the closest of the candidate sub-segments within radius cells of each point
+    :param candidate_counts: if given, the number of candidates of each point is added to this array
+    :return: (sub-segment ids, closest points on them, distances); -1, NaN and inf for points with no candidates
+    """
+    point_index, sub_segment = grid.candidates(points, radius)
+    if candidate_counts is not None:
+        candidate_counts += np.bincount(point_index, minlength=len(points))
+    first_vertex = sub_segment + sub_segment_line[sub_segment]
+    closest, d = get_distance_many(points[point_index], vertices[first_vertex], vertices[first_vertex + 1])
+
+    # candidates are grouped by point, so take the minimum of every group. Of equally close sub-segments the one
+    # with the lowest id wins, and a sub-segment may be a candidate more than once, so keep its first occurrence.
+    group_start = np.flatnonzero(np.diff(point_index, prepend=-1))
+    group_min = np.minimum.reduceat(d, group_start) if len(d) else d
+    is_min = np.flatnonzero(d == np.repeat(group_min, np.diff(group_start, append=len(d))))
+    min_start = np.flatnonzero(np.diff(point_index[is_min], prepend=-1))
+    lowest = np.minimum.reduceat(sub_segment[is_min], min_start) if len(is_min) else is_min
+    is_min = is_min[sub_segment[is_min] == np.repeat(lowest, np.diff(min_start, append=len(is_min)))]
+    is_first = np.ones(len(is_min), dtype=bool)
+    is_first[1:] = point_index[is_min][1:] != point_index[is_min][:-1]
+    best = is_min[is_first]
+
+    result = np.full(len(points), -1, dtype=np.int64)
+    closest_points = np.full((len(points), 2), np.nan)
+    distances = np.full(len(points), np.inf)
+    result[point_index[best]] = sub_segment[best]
+    closest_points[point_index[best]] = closest[best]
+    distances[point_index[best]] = d[best]
+    return result, closest_points, distances
+
+
+def get_closest_segment_to_each_point(grid, vertices, sub_segment_line, points, max_search_size=None,
+                                      candidate_counts=None):
+    """
+    Batched get_closest_line_to_each_point. Each point's own cell is searched first; points whose closest
+    candidate there isn't provably the closest sub-segment are searched again over a larger neighborhood,
+    until every point has its exact closest sub-segment.
+    :param grid: SegmentGrid over the sub-segments
+    :param vertices: vertex array from get_segment_arrays
+    :param sub_segment_line: real segment id of every sub-segment, from get_sub_segment_arrays
+    :param points: (n, 2) array of (lng, lat)
+    :param max_search_size: if given, only sub-segments within this distance (in degrees) of a point are
+    searched, for all points or for each one
+    :param candidate_counts: if given, an array the number of sub-segments examined for each point is added to
+    :return: (sub-segment ids, closest points on them); -1 and NaN for points with no sub-segment in reach
+    """
+    result = np.full(len(points), -1, dtype=np.int64)
+    closest_points = np.full((len(points), 2), np.nan)
+    if max_search_size is not None:
+        max_search_size = np.broadcast_to(max_search_size, len(points))
+
+    todo = np.arange(len(points))
+    # points outside the grid start with the neighborhood that reaches its nearest cells
+    gap = grid.cells_to_grid(points)
+    radius = gap.copy()
+    while len(todo):
+        counts = None if candidate_counts is None else np.zeros(len(todo), dtype=np.int64)
+        sub_segments, closest, d = get_closest_candidates(grid, vertices, sub_segment_line, points[todo],
+                                                          radius[todo], counts)
+        if candidate_counts is not None:
+            candidate_counts[todo] += counts
+        # every sub-segment within reach of a point was one of its candidates
+        reach = radius[todo] * grid.cell_size + grid.pad
+        found = d <= reach
+        give_up = ~np.isfinite(d) & grid.covers(points[todo], radius[todo])
+        if max_search_size is not None:
+            found &= d <= max_search_size[todo]
+            give_up |= reach >= max_search_size[todo]
+
+        result[todo[found]] = sub_segments[found]
+        closest_points[todo[found]] = closest[found]
+
+        # search again with a neighborhood that reaches the closest candidate, or twice as far into the grid if
+        # there was none
+        again = ~found & ~give_up
+        next_radius = np.where(np.isfinite(d), np.ceil((d - grid.pad) / grid.cell_size),
+                               2 * radius[todo] - gap[todo] + 1)
+        if max_search_size is not None:
+            next_radius = np.minimum(next_radius, np.ceil((max_search_size[todo] - grid.pad) / grid.cell_size))
+        radius[todo[again]] = np.maximum(next_radius, radius[todo] + 1)[again]
+        todo = todo[again]
+
+    return result, closest_points
@@ -0,0 +1,69 @@
+from collections import OrderedDict
+import threading
+
+
+class ProximityCache:
+    """
+    Bounded, thread-safe LRU cache of proximity results keyed on label coordinates.
+    """
+    def __init__(self, max_size, quantization=None):
+        """
+        :param max_size: maximum number of results kept; the least recently used one is evicted past it
+        :param quantization: if given, coordinates are rounded to a multiple of this many degrees (e.g. 1e-6)
+        before being used as a key, so near-duplicate label coordinates share one entry
+        """
+        self.max_size = max_size
+        self.quantization = quantization
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def key(self, lat, lng):
+        if self.quantization:
+            return round(lat / self.quantization), round(lng / self.quantization)
+        return lat, lng
+
+    def get(self, lat, lng):
+        """
+        :return: the cached result for the coordinates, or None if there isn't one
+        """
+        key = self.key(lat, lng)
+        with self._lock:
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(key)
+            return result
+
+    def put(self, lat, lng, result):
+        key = self.key(lat, lng)
+        with self._lock:
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        :return: dict with the cache size and its hit/miss/eviction counters
+        """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,235 @@
+import argparse
+import json
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from ._intersection_proximity import IntersectionProximity
+from .settings import *
+
+# Command line interface. `intersection-proximity score in.csv out.parquet --city seattle --workers 8` streams
+# the labels in in.csv through the city's street network a chunk at a time, so inputs don't need to fit in memory.
+# `intersection-proximity build-artifact seattle.tar --city seattle` preprocesses a city into an artifact bundle,
+# which `score --artifact seattle.tar` loads without the city's input files.
+
+# the IntersectionProximity of a worker process, created once by init_worker
+_worker_proximity = None
+
+
+def init_worker(city_config, max_distance, raster_cell_size, artifact=None):
+    global _worker_proximity
+    _worker_proximity = load_proximity(city_config, artifact, cache_results=False, max_distance=max_distance,
+                                       raster_cell_size=raster_cell_size)
+
+
+def load_proximity(city_config, artifact=None, **kwargs):
+    """
+    Load a city from its config, or from an artifact bundle if one is given
+    """
+    if artifact is not None:
+        return IntersectionProximity.from_artifact(artifact, **kwargs)
+    return IntersectionProximity(city_config, **kwargs)
+
+
+def score_chunk(lats, lngs):
+    return _worker_proximity.compute_proximity_many(lats, lngs, return_segment_ids=True)
+
+
+def is_parquet(filename):
+    return filename.lower().endswith(('.parquet', '.pq'))
+
+
+def import_pandas():
+    try:
+        import pandas
+    except ImportError:
+        raise Exception("Scoring files requires pandas: pip install intersection-proximity-nchowder[cli]")
+    return pandas
+
+
+def import_parquet():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise Exception("Reading and writing Parquet files requires pyarrow: pip install pyarrow")
+    return pyarrow, pyarrow.parquet
+
+
+def read_chunks(input_file, chunk_size):
+    """
+    Read a CSV or Parquet file a chunk of rows at a time
+    :return: generator of DataFrames
+    """
+    if is_parquet(input_file):
+        _, pq = import_parquet()
+        for batch in pq.ParquetFile(input_file).iter_batches(batch_size=chunk_size):
+            yield batch.to_pandas()
+    else:
+        yield from import_pandas().read_csv(input_file, chunksize=chunk_size)
+
+
+class ChunkWriter:
+    """
+    Writes DataFrames to a CSV or Parquet file one after the other, as parts of one table
+    """
+    def __init__(self, output_file):
+        self.output_file = output_file
+        self.parquet_writer = None
+        self.rows = 0
+
+    def write(self, df):
+        if is_parquet(self.output_file):
+            pa, pq = import_parquet()
+            if self.parquet_writer is None:
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                self.parquet_writer = pq.ParquetWriter(self.output_file, table.schema)
+            else:
+                table = pa.Table.from_pandas(df, schema=self.parquet_writer.schema, preserve_index=False)
+            self.parquet_writer.write_table(table)
+        else:
+            df.to_csv(self.output_file, mode='w' if self.rows == 0 else 'a', header=self.rows == 0, index=False)
+        self.rows += len(df)
+
+    def close(self):
+        if self.parquet_writer is not None:
+            self.parquet_writer.close()
+
+
+def score(input_file, output_file, city_config, workers=1, chunk_size=SCORE_CHUNK_SIZE, lat_column='lat',
+          lng_column='lng', max_distance=None, raster_cell_size=None, artifact=None):
+    """
+    Compute the proximity of every label in a CSV or Parquet file, and write the labels with their results
+    to another CSV or Parquet file. The results are written as 'distance', 'middleness' and 'segment_id' columns.
+    :param input_file: CSV or Parquet file of labels
+    :param output_file: file to write; Parquet if it ends in .parquet or .pq, otherwise CSV
+    :param city_config: city config dictionary, as passed to IntersectionProximity
+    :param workers: number of processes to score chunks in
+    :param chunk_size: number of labels read, scored and written at a time
+    :param lat_column: name of the latitude column of the input
+    :param lng_column: name of the longitude column of the input
+    :param max_distance: if given, labels farther than this many meters from every street have no result
+    :param raster_cell_size: if given, score approximately from a precomputed raster with cells this many meters
+    wide (see IntersectionProximity)
+    :param artifact: if given, load the city from this artifact bundle instead of from city_config
+    :return: number of labels scored
+    """
+    # fail before any work is done if pandas or pyarrow is missing
+    import_pandas()
+    if is_parquet(input_file) or is_parquet(output_file):
+        import_parquet()
+
+    # preprocess the city, if needed, before any worker loads it
+    if artifact is not None:
+        proximity = load_proximity(city_config, artifact, cache_results=False, max_distance=max_distance,
+                                   raster_cell_size=raster_cell_size)
+    else:
+        proximity = load_proximity(city_config, cache_results=False, max_distance=max_distance, workers=workers,
+                                   raster_cell_size=raster_cell_size)
+
+    writer = ChunkWriter(output_file)
+    start_time = time.time()
+
+    def write_chunk(chunk, result):
+        chunk['distance'], chunk['middleness'], chunk['segment_id'] = result
+        writer.write(chunk)
+        print('Scored {} labels ({:.0f} labels/s)'.format(
+            writer.rows, writer.rows / max(time.time() - start_time, 1e-9)), flush=True)
+
+    try:
+        if workers == 1:
+            for chunk in read_chunks(input_file, chunk_size):
+                write_chunk(chunk, proximity.compute_proximity_many(
+                    chunk[lat_column].values, chunk[lng_column].values, return_segment_ids=True))
+        else:
+            del proximity
+            with ProcessPoolExecutor(workers, initializer=init_worker,
+                                     initargs=(city_config, max_distance, raster_cell_size, artifact)) as executor:
+                # keep a couple of chunks per worker in flight, and write them out in order as they finish
+                in_flight = deque()
+                for chunk in read_chunks(input_file, chunk_size):
+                    in_flight.append((chunk, executor.submit(score_chunk, chunk[lat_column].values,
+                                                             chunk[lng_column].values)))
+                    if len(in_flight) >= 2 * workers:
+                        chunk, future = in_flight.popleft()
+                        write_chunk(chunk, future.result())
+                while in_flight:
+                    chunk, future = in_flight.popleft()
+                    write_chunk(chunk, future.result())
+    finally:
+        writer.close()
+
+    return writer.rows
+
+
+def build_artifact(artifact_file, city_config, workers=1, raster_cell_sizes=()):
+    """
+    Preprocess a city, if needed, and bundle everything its queries read into an artifact
+    :param artifact_file: tar file to write
+    :param city_config: city config dictionary, as passed to IntersectionProximity
+    :param workers: number of processes to preprocess with
+    :param raster_cell_sizes: cell sizes of the rasters to build and bundle, in meters
+    :return: the manifest of the bundle
+    """
+    proximity = IntersectionProximity(city_config, cache_results=False, workers=workers)
+    for raster_cell_size in raster_cell_sizes:
+        IntersectionProximity(city_config, cache_results=False, raster_cell_size=raster_cell_size)
+    return proximity.export_artifact(artifact_file)
+
+
+def add_city_arguments(parser):
+    city = parser.add_mutually_exclusive_group()
+    city.add_argument('--city', default='seattle', choices=sorted(default_settings),
+                      help="one of the built-in cities (default: seattle)")
+    city.add_argument('--config', help="JSON file with a city config, for cities that aren't built in")
+    return city
+
+
+def get_city_config(args):
+    if args.config:
+        with open(args.config) as f:
+            return json.load(f)
+    return default_settings[args.city]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='intersection-proximity',
+                                     description="Compute the proximity from points to street intersections")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    score_parser = subparsers.add_parser('score', help="score every label in a CSV or Parquet file")
+    score_parser.add_argument('input_file', help="CSV or Parquet file of labels")
+    score_parser.add_argument('output_file', help="file to write; Parquet if it ends in .parquet, otherwise CSV")
+    city = add_city_arguments(score_parser)
+    city.add_argument('--artifact', help="artifact bundle to load the city from, written by build-artifact")
+    score_parser.add_argument('--workers', type=int, default=1, help="number of processes to score in")
+    score_parser.add_argument('--chunk-size', type=int, default=SCORE_CHUNK_SIZE,
+                              help="number of labels to read and score at a time")
+    score_parser.add_argument('--lat-column', default='lat', help="name of the latitude column")
+    score_parser.add_argument('--lng-column', default='lng', help="name of the longitude column")
+    score_parser.add_argument('--max-distance', type=float,
+                              help="labels farther than this many meters from every street have no result")
+    score_parser.add_argument('--raster-cell-size', type=float,
+                              help="score approximately from a precomputed raster with cells this many meters wide")
+
+    artifact_parser = subparsers.add_parser('build-artifact', help="preprocess a city into an artifact bundle")
+    artifact_parser.add_argument('artifact_file', help="tar file to write")
+    add_city_arguments(artifact_parser)
+    artifact_parser.add_argument('--workers', type=int, default=1, help="number of processes to preprocess in")
+    artifact_parser.add_argument('--raster-cell-size', type=float, nargs='+', default=[],
+                                 help="cell sizes of proximity rasters to include, in meters")
+
+    args = parser.parse_args(argv)
+    city_config = get_city_config(args)
+
+    start_time = time.time()
+    if args.command == 'build-artifact':
+        manifest = build_artifact(args.artifact_file, city_config, workers=args.workers,
+                                  raster_cell_sizes=args.raster_cell_size)
+        print('Done! Wrote {} files to {} in {:.1f}s'.format(len(manifest['files']), args.artifact_file,
+                                                             time.time() - start_time))
+        return
+
+    rows = score(args.input_file, args.output_file, city_config, workers=args.workers, chunk_size=args.chunk_size,
+                 lat_column=args.lat_column, lng_column=args.lng_column, max_distance=args.max_distance,
+                 raster_cell_size=args.raster_cell_size, artifact=args.artifact)
+    print('Done! Scored {} labels in {:.1f}s'.format(rows, time.time() - start_time))
@@ -0,0 +1,115 @@
+import json
+
+# Incremental reader for GeoJSON FeatureCollections. The file is read in chunks and each feature is decoded
+# on its own, so only one feature (plus a chunk of text) is in memory at a time, instead of the whole object tree.
+
+CHUNK_SIZE = 1 << 20
+_decoder = json.JSONDecoder()
+
+
+class _Reader:
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ''
+        self.position = 0
+        self.eof = False
+
+    def _read_more(self):
+        chunk = self.f.read(CHUNK_SIZE)
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character, or '' at the end of the file
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer) or self.eof:
+                return self.buffer[self.position:self.position + 1]
+            self._read_more()
+
+    def expect(self, characters):
+        c = self.peek()
+        if c not in characters:
+            raise ValueError('Expected one of {!r} in GeoJSON file, found {!r}'.format(characters, c))
+        self.position += 1
+        return c
+
+    def value(self):
+        """
+        Decode the next JSON value, reading more of the file until it is complete
+        """
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+                # a number at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self.eof:
+                    self.position = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read_more()
+
+
+def iter_features(f):
+    """
+    Iterate over the features of a GeoJSON FeatureCollection one at a time
+    :param f: file object opened in text mode
+    :return: generator of features, as dicts
+    """
+    reader = _Reader(f)
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    while True:
+        key = reader.value()
+        reader.expect(':')
+        if key == 'features':
+            reader.expect('[')
+            if reader.peek() != ']':
+                while True:
+                    yield reader.value()
+                    if reader.expect(',]') == ']':
+                        break
+            else:
+                reader.expect(']')
+        else:
+            # other members of the collection (type, crs, ...) aren't needed
+            reader.value()
+        if reader.expect(',}') == '}':
+            return
+
+
+def _iter_positions(coordinates):
+    """
+    Iterate over the positions in the coordinates of a geometry, however deeply they are nested
+    """
+    if coordinates and isinstance(coordinates[0], (int, float)):
+        yield coordinates
+    else:
+        for c in coordinates:
+            yield from _iter_positions(c)
+
+
+def get_collection_bounds(f):
+    """
+    Get the bounding box of a GeoJSON FeatureCollection, reading it one feature at a time
+    :param f: file object opened in text mode
+    :return: (min_lng, min_lat, max_lng, max_lat), or None if the collection has no coordinates
+    """
+    bounds = None
+    for feature in iter_features(f):
+        geometry = feature.get('geometry') or {}
+        for position in _iter_positions(geometry.get('coordinates', [])):
+            lng, lat = position[0], position[1]
+            if bounds is None:
+                bounds = [lng, lat, lng, lat]
+            else:
+                bounds = [min(bounds[0], lng), min(bounds[1], lat), max(bounds[2], lng), max(bounds[3], lat)]
+    return None if bounds is None else tuple(bounds)
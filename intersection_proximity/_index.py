@@ -0,0 +1,174 @@
+import numpy as np
+from ._batch import get_closest_segment_to_each_point, get_distance_many
+from .settings import *
+
+# Index backends find the sub-segments near points. They all answer the same queries over the sub-segment ids of
+# a segment index (see load_segment_index), so IntersectionProximity can search with either of them:
+#   RtreeIndex - the on-disk rtree, through libspatialindex. Queries one point at a time, from one thread.
+#   GridIndex - the SegmentGrid, in NumPy. Queries whole arrays of points at once, from any number of threads.
+
+# The search starts with a box centered in each point with edges of size 2*MIN_SIZE,
+# which is big enough for most points in a city. Every segment closer to the point
+# than half the box size intersects the box, so when the closest segment found is
+# that close it is the true closest one; otherwise the box is grown and the search
+# repeated.
+
+def get_closest_line_to_each_point(idx, vertices, sub_segment_line, points, max_search_size=None,
+                                   candidate_counts=None):
+    """
+    Get a street segment closest to each point in a list
+    :param idx: street network index, whose ids are sub-segment ids
+    :param vertices: vertex array of the segment index
+    :param sub_segment_line: real segment id of every sub-segment
+    :param points: List of points
+    :param max_search_size: if given, only segments within this distance (in degrees) of a point are searched
+    :param candidate_counts: if given, a list the number of segments examined for each point is appended to
+    :return: dict of point -> (line id, closest sub-segment, closest point, distance, sub-segment id),
+    or None for points with no segment within max_search_size
+    """
+    bounds = idx.bounds
+    result = {}
+    for p in points:
+        size = MIN_SIZE
+        candidates = 0
+        while True:
+            if max_search_size is not None:
+                size = min(size, max_search_size)
+            pbox = (p[0]-size, p[1]-size, p[0]+size, p[1]+size)
+            hits = np.fromiter(idx.intersection(pbox), dtype=np.int64)
+            candidates += len(hits)
+            d = INFTY
+            s = None
+            if len(hits):
+                # the first vertex of sub-segment i is vertex i + its line id
+                lines = sub_segment_line[hits]
+                starts, ends = vertices[hits + lines], vertices[hits + lines + 1]
+                closest_points, distances = get_distance_many(np.array([p]), starts, ends)
+                # of equally close sub-segments, the one with the lowest id wins, like in the other backends
+                i = int(np.lexsort((hits, distances))[0])
+                d = float(distances[i])
+                s = (int(lines[i]), (tuple(starts[i]), tuple(ends[i])), tuple(closest_points[i]), d, int(hits[i]))
+
+            # no segment outside the box can be closer than size
+            if s is not None and d <= size:
+                break
+            if max_search_size is not None and size >= max_search_size:
+                s = None
+                break
+            if s is not None:
+                # all segments closer than the best one found intersect a box of this size
+                size = d
+            elif pbox[0] <= bounds[0] and pbox[1] <= bounds[1] and pbox[2] >= bounds[2] and pbox[3] >= bounds[3]:
+                # the box covers the whole index, which must be empty
+                break
+            else:
+                size *= 2
+
+        result[p] = s
+        if candidate_counts is not None:
+            candidate_counts.append(candidates)
+
+    return result
+
+
+class RtreeIndex:
+    """
+    Index backend over an rtree whose ids are sub-segment ids
+    """
+    name = 'rtree'
+    thread_safe = False
+
+    def __init__(self, idx, vertices, sub_segment_line):
+        """
+        :param idx: rtree index, e.g. from load_segment_index
+        :param vertices: vertex array of the segment index
+        :param sub_segment_line: real segment id of every sub-segment
+        """
+        self.idx = idx
+        self.vertices = vertices
+        self.sub_segment_line = sub_segment_line
+
+    @property
+    def bounds(self):
+        return tuple(self.idx.bounds)
+
+    def intersection(self, boxes):
+        """
+        Get the sub-segments whose bounding boxes intersect each box
+        :param boxes: (n, 4) array of (min_lng, min_lat, max_lng, max_lat)
+        :return: (box index, sub-segment id) arrays, sorted by box index and then sub-segment id
+        """
+        hits = [np.sort(np.fromiter(self.idx.intersection(tuple(box)), dtype=np.int64)) for box in boxes.tolist()]
+        box_index = np.repeat(np.arange(len(hits)), [len(h) for h in hits])
+        return box_index, np.concatenate(hits) if hits else np.empty(0, dtype=np.int64)
+
+    def nearest(self, points, max_search_size=None, candidate_counts=None):
+        """
+        Get the closest sub-segment to each point
+        :param points: (n, 2) array of (lng, lat)
+        :param max_search_size: if given, only sub-segments within this distance (in degrees) of a point are
+        searched, for all points or for each one
+        :param candidate_counts: if given, an array the number of sub-segments examined for each point is added to
+        :return: (sub-segment ids, closest points on them); -1 and NaN for points with no sub-segment in reach
+        """
+        sub_segments = np.full(len(points), -1, dtype=np.int64)
+        closest_points = np.full((len(points), 2), np.nan)
+        counts = [] if candidate_counts is not None else None
+        max_search_size = np.broadcast_to(max_search_size, len(points))
+        for i, p in enumerate(points.tolist()):
+            p = tuple(p)
+            closest = get_closest_line_to_each_point(self.idx, self.vertices, self.sub_segment_line, [p],
+                                                     max_search_size[i], counts)[p]
+            if closest is not None:
+                sub_segments[i], closest_points[i] = closest[4], closest[2]
+        if candidate_counts is not None:
+            candidate_counts += counts
+        return sub_segments, closest_points
+
+
+class GridIndex:
+    """
+    Index backend over a SegmentGrid. It is only ever read, so any number of threads can query it at once.
+    """
+    name = 'grid'
+    thread_safe = True
+
+    def __init__(self, grid, vertices, sub_segment_line):
+        """
+        :param grid: SegmentGrid over the sub-segments, e.g. from load_segment_index
+        :param vertices: vertex array of the segment index
+        :param sub_segment_line: real segment id of every sub-segment
+        """
+        self.grid = grid
+        self.vertices = vertices
+        self.sub_segment_line = sub_segment_line
+
+    @property
+    def bounds(self):
+        return self.grid.bounds
+
+    def intersection(self, boxes):
+        """
+        Get the sub-segments whose bounding boxes intersect each box
+        :param boxes: (n, 4) array of (min_lng, min_lat, max_lng, max_lat)
+        :return: (box index, sub-segment id) arrays, sorted by box index and then sub-segment id
+        """
+        box_index, sub_segments = self.grid.candidates_in_boxes(boxes)
+        first_vertex = sub_segments + self.sub_segment_line[sub_segments]
+        starts, ends = self.vertices[first_vertex], self.vertices[first_vertex + 1]
+        # the cells of a box also hold sub-segments that only come near it
+        inside = (np.minimum(starts, ends) <= boxes[box_index, 2:]).all(axis=1) & \
+            (np.maximum(starts, ends) >= boxes[box_index, :2]).all(axis=1)
+        # sub-segments that span several cells of a box are found once per cell
+        keys = np.unique(box_index[inside] * len(self.sub_segment_line) + sub_segments[inside])
+        return keys // len(self.sub_segment_line), keys % len(self.sub_segment_line)
+
+    def nearest(self, points, max_search_size=None, candidate_counts=None):
+        """
+        Get the closest sub-segment to each point, see RtreeIndex.nearest
+        """
+        return get_closest_segment_to_each_point(self.grid, self.vertices, self.sub_segment_line, points,
+                                                 max_search_size, candidate_counts)
+
+
+INDEX_BACKENDS = {backend.name: backend for backend in (RtreeIndex, GridIndex)}
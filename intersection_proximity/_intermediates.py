@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import warnings
+import numpy as np
+from ._batch import SegmentGrid
+
+# Readers of the intermediate files preprocessing writes, and of the fingerprints of the input files they were
+# written from. They only need NumPy, so a preprocessed city can be loaded without importing the dependencies of
+# preprocessing (pandas, shapely, pyproj, ...); see preprocessing for the writers.
+
+
+def load_segment_streets(segment_index_dir):
+    """
+    Open the streets written by write_segment_streets
+    :return: (street id of every segment, -1 for removed segments; list of street names), or (None, None) for
+    indexes without streets
+    """
+    if not os.path.exists(os.path.join(segment_index_dir, 'street-names.json')):
+        return None, None
+    segment_street = np.load(os.path.join(segment_index_dir, 'segment-street.npy'), mmap_mode='r')
+    with open(os.path.join(segment_index_dir, 'street-names.json')) as f:
+        street_names = json.load(f)
+    return segment_street, street_names
+
+
+def load_removed_segments(segment_index_dir):
+    """
+    :return: set of the ids of the segments an incremental update removed from a segment index
+    """
+    removed_file = os.path.join(segment_index_dir, 'removed-segments.npy')
+    if not os.path.exists(removed_file):
+        return set()
+    return set(np.load(removed_file).tolist())
+
+
+def load_segment_lengths(segment_index_dir):
+    """
+    Open the lengths written by generate_segment_lengths, memory-mapping them
+    :param segment_index_dir: directory written by generate_segment_index
+    :return: (cumulative lengths in degrees, cumulative lengths in meters, CRS the meters were measured in)
+    """
+    cumulative_lengths = np.load(os.path.join(segment_index_dir, 'cumulative-lengths.npy'), mmap_mode='r')
+    cumulative_lengths_metric = np.load(os.path.join(segment_index_dir, 'cumulative-lengths-metric.npy'),
+                                        mmap_mode='r')
+    with open(os.path.join(segment_index_dir, 'metric-crs.txt')) as f:
+        metric_crs = f.read().strip()
+    return cumulative_lengths, cumulative_lengths_metric, metric_crs
+
+
+def load_segment_index(segment_index_dir, open_rtree=True):
+    """
+    Open the segment index written by generate_segment_index. The arrays are memory-mapped read-only, so
+    several processes using the same index share its pages through the OS page cache.
+    :param segment_index_dir: directory written by generate_segment_index
+    :param open_rtree: open the rtree too; it's only needed to search with the rtree index backend
+    :return: (rtree index or None, vertices, offsets, sub-segment line ids, SegmentGrid)
+    """
+    vertices = np.load(os.path.join(segment_index_dir, 'vertices.npy'), mmap_mode='r')
+    offsets = np.load(os.path.join(segment_index_dir, 'offsets.npy'), mmap_mode='r')
+    sub_segment_line = np.load(os.path.join(segment_index_dir, 'sub-segment-line.npy'), mmap_mode='r')
+    grid = SegmentGrid.load(segment_index_dir)
+    idx = None
+    if open_rtree:
+        from rtree import index
+        idx = index.Index(os.path.join(segment_index_dir, 'rtree'))
+    return idx, vertices, offsets, sub_segment_line, grid
+
+
+INPUT_FILES = ('street_network_filename', 'osm_way_ids', 'road_network_dump')
+
+
+def get_file_fingerprint(filename, previous=None):
+    """
+    Fingerprint the contents of a file
+    :param previous: an earlier fingerprint of the file. If the file's size and modification time haven't changed
+    since, it is returned as is instead of hashing the file again.
+    :return: dict with the size, modification time and SHA-256 hash of the file
+    """
+    stat = os.stat(filename)
+    if previous is not None and previous['size'] == stat.st_size and previous['mtime_ns'] == stat.st_mtime_ns:
+        return previous
+
+    sha256 = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha256.update(block)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': sha256.hexdigest()}
+
+
+def get_input_fingerprints(city_settings, previous=None):
+    """
+    Fingerprint the input files of a city
+    :param previous: earlier fingerprints, to reuse for files that haven't been touched since
+    :return: dict of setting name -> fingerprint
+    """
+    previous = previous or {}
+    return {key: get_file_fingerprint(city_settings[key], previous.get(key)) for key in INPUT_FILES}
+
+
+def read_input_fingerprints(city_settings):
+    """
+    :return: the fingerprints written by the last preprocessing run, or None if there are none
+    """
+    if not os.path.exists(city_settings['input_fingerprints_filename']):
+        return None
+    with open(city_settings['input_fingerprints_filename']) as f:
+        return json.load(f)
+
+
+def write_input_fingerprints(city_settings, fingerprints):
+    with open(city_settings['input_fingerprints_filename'], 'w') as f:
+        json.dump(fingerprints, f, indent=2)
+
+
+def get_changed_input_fingerprints(city_settings):
+    """
+    Check whether the input files of a city changed since they were last preprocessed. Only files whose size or
+    modification time changed are hashed again. The fingerprints of files that were touched without changing,
+    and of intermediate files that predate fingerprints, are brought up to date on the way.
+    If an input file is missing, e.g. where only the intermediate files are deployed, nothing can be checked and
+    the intermediate files are kept as they are, with a warning.
+    :return: the new fingerprints if the contents of an input file changed, otherwise None
+    """
+    missing = [city_settings[key] for key in INPUT_FILES if not os.path.exists(city_settings[key])]
+    if missing:
+        warnings.warn('Input files {} are missing, using the intermediate files without checking them for '
+                      'changes'.format(', '.join(missing)))
+        return None
+
+    previous = read_input_fingerprints(city_settings)
+    if previous is None:
+        write_input_fingerprints(city_settings, get_input_fingerprints(city_settings))
+        return None
+
+    fingerprints = get_input_fingerprints(city_settings, previous)
+    if all(fingerprints[key]['sha256'] == previous[key]['sha256'] for key in INPUT_FILES):
+        if fingerprints != previous:
+            write_input_fingerprints(city_settings, fingerprints)
+        return None
+    return fingerprints
@@ -1,132 +1,109 @@
-import math
-from shapely.geometry import Polygon, LineString, Point
-import geojson
-from shapely.ops import transform
-from functools import partial
-import pyproj
-from .preprocessing import make_street_network_index, run_preprocess
+import importlib.util
+import numpy as np
+from ._projection import is_location, get_search_size, get_approximate_distance
+from ._cache import ProximityCache
+from ._metrics import ProximityMetrics
+from ._batch import get_closest_segment_to_each_point
+from ._index import INDEX_BACKENDS, RtreeIndex, GridIndex
+from ._raster import ProximityRaster, generate_raster
+from ._intersections import IntersectionIndex
+from ._artifact import write_artifact, unpack_artifact
+from ._lock import FileLock
+from ._intermediates import load_segment_index, load_segment_lengths, load_segment_streets, load_removed_segments, \
+    get_changed_input_fingerprints
 from .settings import *
 import json
 import os
 import shutil
 import hashlib
+import time
 
-# Finding line closest to point helper functions
-# From: https://stackoverflow.com/questions/46170577/
-# find-closest-line-to-each-point-on-big-dataset-possibly-using-shapely-and-rtree
-
-# MIN_SIZE should be a vaule such that if you build a box centered in each
-# point with edges of size 2*MIN_SIZE, you know a priori that at least one
-# segment is intersected with the box. Otherwise, you could get an inexact
-# solution, there is an exception checking this, though.
-
-global proximity_cache
-proximity_cache = dict()
-
-def distance(a, b):
-    return math.sqrt((a[0]-b[0])**2 + (a[1]-b[1])**2)
-
-
-def get_distance(apoint, segment):
-    a = apoint
-    b, c = segment
-    # t = <a-b, c-b>/|c-b|**2
-    # because p(a) = t*(c-b)+b is the ortogonal projection of vector a
-    # over the rectline that includes the points b and c.
-    t = (a[0]-b[0])*(c[0]-b[0]) + (a[1]-b[1])*(c[1]-b[1])
-    t = t / ( (c[0]-b[0])**2 + (c[1]-b[1])**2 )
-    # Only if t 0 <= t <= 1 the projection is in the interior of
-    # segment b-c, and it is the point that minimize the distance
-    # (by pitagoras theorem).
-    if 0 < t < 1:
-        pcoords = (t*(c[0]-b[0])+b[0], t*(c[1]-b[1])+b[1])
-        dmin = distance(a, pcoords)
-        return pcoords, dmin
-    elif t <= 0:
-        return b, distance(a, b)
-    elif 1 <= t:
-        return c, distance(a, c)
-
-
-def get_closest_line_to_each_point(idx, points):
+######### Helper functions ############
+
+
+def import_preprocessing():
     """
-    Get a street segment closest to each point in a list
-    :param idx: street network index
-    :param points: List of points
-    :return: list of closest segments
+    Import the preprocessing module. Its dependencies (pandas, shapely, pyproj, ...) are only needed to preprocess
+    cities, so they aren't imported with the package, and may not be installed where cities are only queried.
     """
-    result = {}
-    for p in points:
-        pbox = (p[0]-MIN_SIZE, p[1]-MIN_SIZE, p[0]+MIN_SIZE, p[1]+MIN_SIZE)
-        hits = idx.intersection(pbox, objects='raw')
-        d = INFTY
-        s = None
-        for h in hits:
-            nearest_p, new_d = get_distance(p, h[1])
-            if d >= new_d:
-                d = new_d
-                s = (h[0], h[1], nearest_p, new_d)
-        result[p] = s
-        # print(s)
-
-        # some checking you could remove after you adjust the constants
-        if s == None:
-            raise Exception("It seems INFTY is not big enough.")
-
-        pboxpol = ( (pbox[0], pbox[1]), (pbox[2], pbox[1]),
-                    (pbox[2], pbox[3]), (pbox[0], pbox[3]) )
-        if not Polygon(pboxpol).intersects(LineString(s[1])):
-            msg = "It seems MIN_SIZE is not big enough. "
-            msg += "You could get inexact solutions if remove this exception."
-            raise Exception(msg)
-
-    return result
-
-######### Other helper functions ############
-
-
-def extract_street_coords_from_geojson(street):
+    try:
+        from . import preprocessing
+    except ImportError as e:
+        raise Exception("Preprocessing a city requires the preprocessing dependencies ({}): "
+                        "pip install intersection-proximity-nchowder[preprocessing]".format(e))
+    return preprocessing
+
+
+def get_cache_dir(cache_dir=None):
     """
-    Returns tuple mapping street edge id to a list of coordinate tuples
-    :param street:
-    :return: Ex. ('edge_id', [(5,6),(7,8)])
+    Get the directory the intermediate files of every city are kept under
+    :param cache_dir: the directory; by default the one in the INTERSECTION_PROXIMITY_CACHE_DIR environment
+    variable, or intermediates/ in the package directory if that isn't set
     """
-    edge_id = str(street['properties']['street_edge_id'])
-    coords_generator = geojson.utils.coords(street)
-    coords_list = []
-    for c in coords_generator:
-        coords_list.append(c)
-    return edge_id, coords_list
+    if cache_dir is None:
+        cache_dir = os.environ.get(CACHE_DIR_VARIABLE) or \
+            os.path.join(os.path.dirname(os.path.abspath(__file__)), "intermediates")
+    return os.path.abspath(cache_dir)
 
 
-def cut(line, distance):
+def get_intermediates_path(city_config, cache_dir=None):
     """
-    Cuts a line in two at a distance from its starting point
-    https://stackoverflow.com/questions/50332273/shapely-split-linestring-at-arbitrary-point-along-edge
-    :param line:
-    :param distance:
-    :return:
+    Get the folder preprocessing writes a city's intermediate files to. Each city config gets its own
+    folder, named after a hash of the config.
+    :param city_config: city config dictionary, as passed to IntersectionProximity
+    :param cache_dir: directory the folder is in, see get_cache_dir
     """
-    if distance <= 0.0 or distance >= line.length:
-        return [LineString(line)]
-    coords = list(line.coords)
-    for i, p in enumerate(coords):
-        pd = line.project(Point(p))
-        if pd == distance:
-            return [
-                LineString(coords[:i+1]),
-                LineString(coords[i:])]
-        if pd > distance:
-            cp = line.interpolate(distance)
-            return [
-                LineString(coords[:i] + [(cp.x, cp.y)]),
-                LineString([(cp.x, cp.y)] + coords[i:])]
+    settings_hash = str(hashlib.sha256(json.dumps(city_config, sort_keys=True).encode()).hexdigest())
+    return os.path.join(get_cache_dir(cache_dir), settings_hash)
+
+
+def get_intermediate_files(city_config, cache_dir=None, intermediates_path=None):
+    """
+    Get the paths of the intermediate files preprocessing writes for a city
+    :param city_config: city config dictionary, as passed to IntersectionProximity
+    :param cache_dir: directory the city's folder is in, see get_cache_dir
+    :param intermediates_path: folder to get the paths in, instead of the city's folder
+    :return: dict of setting name -> absolute path
+    """
+    if intermediates_path is None:
+        intermediates_path = get_intermediates_path(city_config, cache_dir)
+    intermediate_files = {
+        # outputs from preprocessing
+        'intersection_points_filename': 'intersection-points.pickle',
+        'street_edge_name_filename': 'street-edge-name.csv',
+        'real_segments_output_filename': 'real-segments.pickle',
+        'segment_index_dirname': 'segment-index',
+        'intersection_index_dirname': 'intersection-index',
+        'street_network_cache_filename': 'street-network.npz',
+        'segment_streets_filename': 'segment-streets.pickle',
+        'input_fingerprints_filename': 'input-fingerprints.json',
+        'raster_dirname': 'rasters'
+    }
+    for key in intermediate_files:
+        intermediate_files[key] = os.path.join(intermediates_path, intermediate_files[key])
+    return intermediate_files
+
+
+def replace_directory(source, destination):
+    """
+    Move a directory over another one. Processes that still have files of the old directory open keep reading them.
+    :param source: directory to move
+    :param destination: existing directory to replace
+    """
+    old_path = destination + '.old'
+    shutil.rmtree(old_path, ignore_errors=True)
+    os.rename(destination, old_path)
+    os.rename(source, destination)
+    shutil.rmtree(old_path, ignore_errors=True)
+
 
 # End of helper functions
 # --------------------------------------------
 
 class IntersectionProximity:
-    def __init__(self, city_config, cache_results=True, verbose=False, clear_intermediates=False):
+    def __init__(self, city_config, cache_results=True, verbose=False, clear_intermediates=False,
+                 cache_size=DEFAULT_CACHE_SIZE, cache_quantization=None, workers=1, max_distance=None,
+                 thread_safe=False, metrics=None, index_backend=None, raster_cell_size=None, cache_dir=None):
         """
         Create an IntersectionProximity object
         :param city_config: Dictionary of the form:
@@ -135,114 +112,512 @@ class IntersectionProximity:
             'osm_way_ids': 'osm-way-ids-seattle.csv',
             'road_network_dump': 'seattle-roads.dbf',
         }
+        It may also contain a 'metric_crs' entry (e.g. 'EPSG:32610') to measure distances in. By default
+        the UTM zone at the center of the street network is used.
+        :param cache_results: keep results of compute_proximity in an LRU cache
+        :param cache_size: maximum number of cached results
+        :param cache_quantization: if given, round label coordinates to a multiple of this many degrees
+        (e.g. 1e-6) for the cache key, so near-duplicate labels share one entry
+        :param workers: number of processes to preprocess with, if this city hasn't been preprocessed yet
+        :param max_distance: if given, labels farther than this many meters from every street segment have no result
+        :param thread_safe: let compute_proximity be called from several threads at once. Labels are then looked up
+        in the read-only segment grid instead of the rtree, which can't be queried concurrently.
+        compute_proximity_many is always thread-safe.
+        :param metrics: True to collect timings and counts of the work done (see ProximityMetrics), or a
+        ProximityMetrics to collect them into, e.g. one shared by several objects. Off by default.
+        :param index_backend: index compute_proximity looks labels up in: 'rtree' (libspatialindex) or 'grid' (a
+        NumPy grid, which can be queried from several threads). 'grid' if thread_safe or rtree isn't installed, 'rtree'
+        otherwise by default.
+        compute_proximity_many always uses the grid, which answers whole arrays of labels at once.
+        :param raster_cell_size: if given, answer queries from a raster of precomputed results with cells this many
+        meters wide, built on first use (see ProximityRaster). Results are then approximate: distances are off by at
+        most raster.error_bound meters. Labels in cells where the closest segment changes are computed exactly.
+        :param cache_dir: directory to keep the intermediate files of preprocessing under, see get_cache_dir.
+        Processes that start at the same time with the same city wait for one of them to preprocess it.
+        """
+        index_backend = self._configure(city_config, cache_results, verbose, cache_size, cache_quantization,
+                                        max_distance, thread_safe, metrics, index_backend)
+
+        intermediates_path = get_intermediates_path(self.city_config, cache_dir)
+        self.intermediate_files = get_intermediate_files(self.city_config, intermediates_path=intermediates_path)
+
+        # merge the intermediate and input files to create a settings dictionary
+        self.settings = {**self.city_config, **self.intermediate_files}
 
+        os.makedirs(os.path.dirname(intermediates_path), exist_ok=True)
+        # other processes wait here while one of them preprocesses the city
+        with FileLock(intermediates_path + '.lock'):
+            if clear_intermediates and os.path.exists(intermediates_path):
+                shutil.rmtree(intermediates_path)
+
+            if not os.path.exists(intermediates_path):
+                # preprocess into a temporary folder, so an interrupted run leaves no half-written files behind
+                build_path = intermediates_path + '.tmp'
+                shutil.rmtree(build_path, ignore_errors=True)
+                os.mkdir(build_path)
+                import_preprocessing().run_preprocess({**self.city_config, **get_intermediate_files(self.city_config,
+                                                                             intermediates_path=build_path)},
+                               workers=workers)
+                os.replace(build_path, intermediates_path)
+            elif get_changed_input_fingerprints(self.settings) is not None:
+                # catch up with edits to the input files since they were preprocessed. The update is made to a copy
+                # of the intermediates that replaces them once it's complete, so an update that fails partway
+                # leaves the old files and their fingerprints behind, and is made again next time.
+                build_path = intermediates_path + '.tmp'
+                shutil.rmtree(build_path, ignore_errors=True)
+                # rasters hold results of the old street network
+                shutil.copytree(intermediates_path, build_path,
+                                ignore=shutil.ignore_patterns(os.path.basename(self.settings['raster_dirname'])))
+                import_preprocessing().update_preprocess({**self.city_config, **get_intermediate_files(
+                    self.city_config, intermediates_path=build_path)}, workers=workers)
+                replace_directory(build_path, intermediates_path)
+
+            # intermediates written before the segment index existed only need that last step. The streets of
+            # the segments weren't kept back then, so such an index has none (see get_segment_street).
+            if not os.path.exists(self.settings['segment_index_dirname']):
+                segment_streets_file = self.settings['segment_streets_filename']
+                import_preprocessing().generate_segment_index(
+                    self.settings['real_segments_output_filename'], self.settings['segment_index_dirname'],
+                    self.city_config.get('metric_crs'),
+                    segment_streets_file if os.path.exists(segment_streets_file) else None)
+            if not os.path.exists(os.path.join(self.settings['segment_index_dirname'], 'metric-crs.txt')):
+                import_preprocessing().generate_segment_lengths(self.settings['segment_index_dirname'],
+                                                                self.city_config.get('metric_crs'))
+            if not os.path.exists(self.settings['intersection_index_dirname']):
+                import_preprocessing().generate_intersection_index(self.settings['intersection_points_filename'],
+                                                                   self.settings['intersection_index_dirname'])
+
+        self._load(index_backend, raster_cell_size)
+
+    @classmethod
+    def from_artifact(cls, artifact_file, cache_dir=None, cache_results=True, verbose=False,
+                      cache_size=DEFAULT_CACHE_SIZE, cache_quantization=None, max_distance=None, thread_safe=False,
+                      metrics=None, index_backend=None, raster_cell_size=None):
+        """
+        Create an IntersectionProximity object from an artifact bundle written by export_artifact, e.g. by a
+        separate build job. The city's input files aren't needed, and nothing is preprocessed: the bundle is
+        unpacked under the cache directory the first time it is loaded, and checked against its checksums.
+        :param artifact_file: the artifact bundle
+        :param cache_dir: directory to unpack the bundle under, see get_cache_dir
+        The other parameters are the same as for the constructor. If the bundle holds no raster with cells
+        raster_cell_size wide, one is built next to the unpacked bundle.
+        """
+        artifact_path, manifest = unpack_artifact(artifact_file, get_cache_dir(cache_dir))
+        proximity = cls.__new__(cls)
+        index_backend = proximity._configure(manifest['city_config'], cache_results, verbose, cache_size,
+                                             cache_quantization, max_distance, thread_safe, metrics, index_backend)
+        proximity.intermediate_files = get_intermediate_files(proximity.city_config, intermediates_path=artifact_path)
+        proximity.settings = {**proximity.city_config, **proximity.intermediate_files}
+        proximity._load(index_backend, raster_cell_size)
+        return proximity
+
+    def export_artifact(self, artifact_file):
+        """
+        Write everything queries of this city read into an artifact bundle: a tar file with the segment index, the
+        intersection index, the rasters built so far and a manifest with the checksums of all of them. Load it with
+        from_artifact.
+        :param artifact_file: tar file to write
+        :return: the manifest of the bundle
+        """
+        return write_artifact(self.intermediate_files, self.city_config, artifact_file)
+
+    def _configure(self, city_config, cache_results, verbose, cache_size, cache_quantization, max_distance,
+                   thread_safe, metrics, index_backend):
+        """
+        Set the options of a new object, see the constructor
+        :return: name of the index backend to use
         """
         self.cache = cache_results
         self.verbose = verbose
         self.city_config = city_config
+        self.max_distance = max_distance
+        if index_backend is None:
+            # the rtree is an optional dependency of query-only installs
+            index_backend = 'grid' if thread_safe or importlib.util.find_spec('rtree') is None else 'rtree'
+        if index_backend not in INDEX_BACKENDS:
+            raise Exception("Unknown index backend: {}. Use one of {}".format(index_backend, sorted(INDEX_BACKENDS)))
+        if thread_safe and not INDEX_BACKENDS[index_backend].thread_safe:
+            raise Exception("The {} index backend can't be queried from several threads".format(index_backend))
+        self.thread_safe = thread_safe
+        self.metrics = ProximityMetrics() if metrics is True else metrics or None
 
         if self.cache:
-            self.proximity_cache = dict()
-
-        settings_hash = str(hashlib.sha256(json.dumps(self.city_config, sort_keys=True).encode()).hexdigest())
-        intermediates_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intermediates", settings_hash)
-        intermediates_folder_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "intermediates")
-        
-        self.intermediate_files = {
-            # outputs from preprocessing
-            'intersection_points_filename': 'intersection-points.pickle',
-            'street_edge_name_filename': 'street-edge-name.csv',
-            'real_segments_output_filename': 'real-segments.pickle'
-        }
-        
-        for key in self.intermediate_files:
-            self.intermediate_files[key] = os.path.join(intermediates_path, self.intermediate_files[key])
-        
-        # merge the intermediate and input files to create a settings dictionary
-        self.settings = {**self.city_config, **self.intermediate_files}
+            self.proximity_cache = ProximityCache(cache_size, cache_quantization)
+            if self.metrics is not None:
+                self.metrics.caches.append(self.proximity_cache)
+        return index_backend
 
-        if clear_intermediates:
-            shutil.rmtree(intermediates_path)
-        
-        if not os.path.exists(intermediates_folder_path):
-            os.mkdir(intermediates_folder_path)
+    def _load(self, index_backend, raster_cell_size):
+        """
+        Open the preprocessed street network in self.settings, building the raster first if it doesn't exist yet
+        """
+        load_start = time.perf_counter()
+
+        # the segments as flat, memory-mapped arrays, which both query paths compute results from
+        self.street_network_index, self.segment_vertices, self.segment_offsets, self.sub_segment_line, \
+            self.segment_grid = load_segment_index(self.settings['segment_index_dirname'],
+                                                   open_rtree=index_backend == RtreeIndex.name)
+        if index_backend == RtreeIndex.name:
+            self.index = RtreeIndex(self.street_network_index, self.segment_vertices, self.sub_segment_line)
+        else:
+            self.index = GridIndex(self.segment_grid, self.segment_vertices, self.sub_segment_line)
+        self.removed_segments = load_removed_segments(self.settings['segment_index_dirname'])
+        # street of every segment, as an index into street_names (-1 if removed); None for indexes written
+        # before streets were stored
+        self.segment_street, self.street_names = load_segment_streets(self.settings['segment_index_dirname'])
+
+        # cumulative length at every vertex, in degrees (for middleness) and in meters (for distance), measured
+        # during preprocessing so that queries only need lookups and arithmetic
+        # https://gis.stackexchange.com/questions/80881/what-is-unit-of-shapely-length-attribute
+        self.cumulative_lengths, self.cumulative_lengths_metric, self.metric_crs = \
+            load_segment_lengths(self.settings['segment_index_dirname'])
+
+        # opened by the first intersection query
+        self._intersection_index = None
+
+        self.raster = None
+        if raster_cell_size is not None:
+            raster_dir = os.path.join(self.settings['raster_dirname'], '{:g}m'.format(raster_cell_size))
+            if not os.path.exists(raster_dir):
+                os.makedirs(self.settings['raster_dirname'], exist_ok=True)
+                with FileLock(raster_dir + '.lock'):
+                    if not os.path.exists(raster_dir):
+                        print('Building {:g}m proximity raster... '.format(raster_cell_size), end='', flush=True)
+                        generate_raster(self, raster_dir, raster_cell_size)
+                        print('Done!')
+            self.raster = ProximityRaster(raster_dir)
+
+        if self.metrics is not None:
+            self.metrics.set_value('index_load_seconds', time.perf_counter() - load_start)
+
+    @property
+    def bounds(self):
+        """
+        Bounding box (min_lng, min_lat, max_lng, max_lat) of the street network, padded by MIN_SIZE
+        """
+        return self.segment_grid.bounds
 
-        if not os.path.exists(intermediates_path):
-            os.mkdir(intermediates_path)
-            run_preprocess(self.settings)
+    def memory_usage(self):
+        """
+        Estimate the memory used by this object's street network arrays, in bytes. Memory-mapped arrays
+        are counted in full, since the pages a query touches stay resident.
+        """
+        arrays = [self.segment_vertices, self.segment_offsets, self.sub_segment_line, self.cumulative_lengths,
+                  self.cumulative_lengths_metric, self.segment_grid.keys,
+                  self.segment_grid.cell_start, self.segment_grid.entries]
+        if self.raster is not None:
+            arrays.extend(self.raster.arrays.values())
+        if self._intersection_index is not None:
+            grid = self._intersection_index.grid
+            arrays.extend([self._intersection_index.points, grid.keys, grid.cell_start, grid.entries])
+        return sum(a.nbytes for a in arrays)
+
+    @property
+    def real_segments(self):
+        """
+        The real segments as shapely LineStrings. They are only needed for debugging, so they're built from the
+        segment arrays on every access; prefer get_segment for single segments.
+        Segments removed by an incremental update (see update_preprocess) are None.
+        """
+        return [self.get_segment(segment_id) for segment_id in range(len(self.segment_offsets) - 1)]
 
-        self.street_network_index, self.real_segments = make_street_network_index(self.settings['real_segments_output_filename'])
+    def get_segment_coords(self, segment_id):
+        """
+        :return: (n, 2) array of the vertices of a real segment, in (lng, lat)
+        """
+        return self.segment_vertices[self.segment_offsets[segment_id]:self.segment_offsets[segment_id + 1]]
 
+    def get_segment(self, segment_id):
+        """
+        :return: the real segment as a shapely LineString, or None if it was removed by an incremental update
+        """
+        if segment_id in self.removed_segments:
+            return None
+        from shapely.geometry import LineString
+        return LineString(self.get_segment_coords(segment_id))
 
-    def compute_proximity(self, label_lat, label_lng):
-        if self.cache and (label_lat, label_lng) in self.proximity_cache:
-            return self.proximity_cache[label_lat, label_lng]
+    def get_segment_street(self, segment_id):
+        """
+        :return: name of the street the real segment was cut from, or None if it isn't known
+        """
+        if self.segment_street is None or self.segment_street[segment_id] < 0:
+            return None
+        return self.street_names[self.segment_street[segment_id]]
 
-        # Points to compute results for, in (lng, lat) form
-        # Right now only the first point in this list is processed
-        points = [(label_lng, label_lat)]
+    def get_segment_geojson(self, segment_id):
+        """
+        :return: the real segment as a GeoJSON Feature, with its id and street name as properties
+        """
+        import geojson
+        return geojson.Feature(geometry=geojson.LineString(self.get_segment_coords(segment_id).tolist()),
+                               properties={'segment_id': int(segment_id),
+                                           'street_name': self.get_segment_street(segment_id)})
 
-        closest_line_for_each_point = get_closest_line_to_each_point(self.street_network_index, points)
+    @property
+    def intersection_index(self):
+        """
+        IntersectionIndex over the street intersections, opened on first use
+        """
+        if self._intersection_index is None:
+            self._intersection_index = IntersectionIndex(self.settings['intersection_index_dirname'])
+        return self._intersection_index
 
-        # Just process the first point for now. Get the coords of line closest to first point.
-        line_coords = list(closest_line_for_each_point[points[0]][1])
+    def get_intersection(self, intersection_id, distance=None):
+        """
+        :param distance: distance to the intersection in meters, to include in the result
+        :return: dict with the id, lat, lng and sorted street names of an intersection
+        """
+        lng, lat = self.intersection_index.points[intersection_id].tolist()
+        intersection = {'intersection_id': int(intersection_id), 'lat': lat, 'lng': lng,
+                        'street_names': self.intersection_index.street_names[intersection_id]}
+        if distance is not None:
+            intersection['distance'] = float(distance)
+        return intersection
+
+    def nearest_intersections(self, label_lat, label_lng, k=1):
+        """
+        Find the street intersections closest to a label
+        :param k: number of intersections to find
+        :return: list of up to k dicts, closest first, with the intersection_id, lat, lng, distance in meters and
+        street_names of each intersection
+        """
+        ids, distances = self.intersection_index.nearest(np.array([(label_lng, label_lat)]), k)
+        return [self.get_intersection(intersection_id, distance)
+                for intersection_id, distance in zip(ids[0].tolist(), distances[0].tolist()) if intersection_id >= 0]
 
-        # Also get the point on the line that is closest to the label coordinate
-        closest_point_on_line_coords = closest_line_for_each_point[points[0]][2]
-        closest_point_on_line = Point(closest_point_on_line_coords[0], closest_point_on_line_coords[1])
+    def intersections_within(self, label_lat, label_lng, radius):
+        """
+        Find the street intersections within some distance of a label
+        :param radius: distance in meters
+        :return: list of dicts, closest first, like nearest_intersections
+        """
+        _, ids, distances = self.intersection_index.within(np.array([(label_lng, label_lat)]), radius)
+        return [self.get_intersection(intersection_id, distance)
+                for intersection_id, distance in zip(ids.tolist(), distances.tolist())]
 
-        # For convenience, the same line coords in a format that doesn't use tuples
-        line_coords_as_list = []
-        for coord in line_coords:
-            line_coords_as_list.append(list(coord))
+    def nearest_intersections_many(self, label_lats, label_lngs, k=1):
+        """
+        Batched nearest_intersections
+        :return: (intersection ids, distances in meters) arrays of shape (number of labels, k), closest first; -1 and
+        NaN where the city has fewer than k intersections. Look the intersections up with get_intersection, or in
+        intersection_index.points and intersection_index.street_names.
+        """
+        points = np.column_stack((np.asarray(label_lngs, dtype=np.float64),
+                                  np.asarray(label_lats, dtype=np.float64)))
+        ids = np.full((len(points), k), -1, dtype=np.int64)
+        distances = np.full((len(points), k), np.nan)
+        for chunk_start in range(0, len(points), BATCH_CHUNK_SIZE):
+            chunk = slice(chunk_start, chunk_start + BATCH_CHUNK_SIZE)
+            ids[chunk], distances[chunk] = self.intersection_index.nearest(points[chunk], k)
+        return ids, distances
+
+    def intersections_within_many(self, label_lats, label_lngs, radius):
+        """
+        Batched intersections_within
+        :param radius: distance in meters, for all labels or for each one
+        :return: (label index, intersection id, distance in meters) arrays, grouped by label index and closest first
+        """
+        points = np.column_stack((np.asarray(label_lngs, dtype=np.float64),
+                                  np.asarray(label_lats, dtype=np.float64)))
+        radius = np.broadcast_to(radius, len(points))
+        results = []
+        for chunk_start in range(0, len(points), BATCH_CHUNK_SIZE):
+            chunk = slice(chunk_start, chunk_start + BATCH_CHUNK_SIZE)
+            label_index, ids, distances = self.intersection_index.within(points[chunk], radius[chunk])
+            results.append((label_index + chunk_start, ids, distances))
+        if not results:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0)
+        return tuple(np.concatenate(arrays) for arrays in zip(*results))
 
-        # Turn the line coords into a shapley line
-        # shapely_line = LineString(ast.literal_eval(str(line_coords_as_list)))
-        shapely_line = self.real_segments[closest_line_for_each_point[points[0]][0]]
+    def compute_proximity(self, label_lat, label_lng):
+        """
+        Compute the proximity of a label to the nearest street intersection
+        :return: tuple (absolute_dist_in_meters, middleness_percentage), or None if the label is farther than
+        max_distance from every street segment or isn't a location (see is_location)
+        """
+        if not (-90 <= label_lat <= 90 and -180 <= label_lng <= 180):
+            return None
 
-        line_length = shapely_line.length
-        line_start_to_closest_pt_len = shapely_line.project(closest_point_on_line)
+        if self.cache:
+            cached = self.proximity_cache.get(label_lat, label_lng)
+            if cached is not None:
+                return cached
 
-        # Position of label on the segment expressed as a fraction between 0 and 1
-        point_position_fraction = line_start_to_closest_pt_len / line_length
-        # print("Position of label along segment expressed as a fraction (0-1): {}".format(point_position_fraction))
+        # Points to compute results for, in (lng, lat) form
+        # Right now only the first point in this list is processed
+        points = [(label_lng, label_lat)]
 
-        # Position of label on the segment expressed as a percentage from 0 to 100,
-        # where 50 represents the middle of the segment and 0 represents both ends
-        middleness_pct = 100 * (min(abs(point_position_fraction - 0),abs(point_position_fraction-1)) / 0.5)
-        # print("Middleness percentage (0-100): {}".format(middleness_pct))
+        metrics = self.metrics
+        if self.raster is not None:
+            if metrics is not None:
+                lookup_start = time.perf_counter()
+            distances, middleness, _, exact = self.raster.lookup(np.array(points), self.max_distance)
+            if metrics is not None:
+                metrics.observe_time('raster', time.perf_counter() - lookup_start)
+            if not exact[0]:
+                if np.isnan(distances[0]):
+                    return None
+                if self.cache:
+                    self.proximity_cache.put(label_lat, label_lng, (float(distances[0]), float(middleness[0])))
+                return float(distances[0]), float(middleness[0])
+
+        candidate_counts = None
+        if metrics is not None:
+            search_start = time.perf_counter()
+            candidate_counts = np.zeros(1, dtype=np.int64)
+
+        max_search_size = None
+        if self.max_distance is not None:
+            max_search_size = get_search_size(self.max_distance, label_lat)
+        # Get the closest sub-segment and the point on it closest to the label coordinate
+        sub_segments, closest_points = self.index.nearest(np.array(points), max_search_size, candidate_counts)
+        closest = (sub_segments[0], closest_points[0]) if sub_segments[0] >= 0 else None
+
+        if metrics is not None:
+            search_end = time.perf_counter()
+            metrics.observe_time('search', search_end - search_start)
+            metrics.observe_candidates(int(candidate_counts[0]))
+
+        if closest is None:
+            return None
+        sub_segment, closest_point = closest
+        if self.max_distance is not None and \
+                get_approximate_distance(np.array(points), np.array([closest_point]))[0] > self.max_distance:
+            return None
+
+        distances, middleness = self._proximity_along_segments(np.array([sub_segment]), np.array([closest_point]))
+        distance_to_segment_end, middleness_pct = float(distances[0]), float(middleness[0])
+
+        if metrics is not None:
+            measure_end = time.perf_counter()
+            metrics.observe_time('measure', measure_end - search_end)
+            metrics.observe_time('query', measure_end - search_start)
 
-        # Get the two segments on either side of the label to compute their lengths
-        cut_point = shapely_line.project(closest_point_on_line)
-        split_segments = cut(shapely_line, line_start_to_closest_pt_len)
+        # Print the line as geojson
+        if self.verbose:
+            line = self.sub_segment_line[sub_segment]
+            print("Here is the line segment found closest to the label ({}):".format(self.get_segment_street(line)))
+            print([', '.join([('%.6f' % k) for k in reversed(a)]) for a in self.get_segment_coords(line)])
 
-        # We want to find lengths of the two segments in real-world units (meters) rather
-        # than degrees, so they need to be projected
-        # https://gis.stackexchange.com/questions/80881/what-is-unit-of-shapely-length-attribute
-        project = partial(
-            pyproj.transform,
-            pyproj.Proj(init='EPSG:4326'),
-            pyproj.Proj(init='EPSG:32633'))
+        if self.cache:
+            self.proximity_cache.put(label_lat, label_lng, (distance_to_segment_end, middleness_pct))
 
-        left_segment_transformed = transform(project, split_segments[0])
-        left_segment_length = left_segment_transformed.length
+        return distance_to_segment_end, middleness_pct
 
-        right_segment_transformed = transform(project, split_segments[1])
-        right_segment_length = right_segment_transformed.length
 
-        # The shorter segment represents the distance from label to end of street segment
-        distance_to_segment_end = min(left_segment_length, right_segment_length)
-        # print("Distance to end of segment: {} meters".format(distance_to_segment_end))
+    def compute_proximity_many(self, label_lats, label_lngs=None, return_segment_ids=False):
+        """
+        Compute the proximity of many labels at once. Gives the same results as calling compute_proximity
+        on every label, but does the work with array operations instead of one label at a time.
+        Labels farther than max_distance from every street segment, or that aren't locations (see is_location), get
+        NaN for both values.
+        :param label_lats: array of latitudes, or a DataFrame with 'lat' and 'lng' columns
+        :param label_lngs: array of longitudes, if label_lats is not a DataFrame
+        :param return_segment_ids: also return the id of the real segment each label was matched to (-1 for
+        labels with no result)
+        :return: tuple of arrays (absolute_dist_in_meters, middleness_percentage[, segment_id])
+        """
+        if label_lngs is None:
+            label_lats, label_lngs = label_lats['lat'], label_lats['lng']
+
+        # (lng, lat) pairs, like the scalar path
+        points = np.column_stack((np.asarray(label_lngs, dtype=np.float64),
+                                  np.asarray(label_lats, dtype=np.float64)))
+
+        distances = np.full(len(points), np.nan)
+        middleness = np.full(len(points), np.nan)
+        segment_ids = np.full(len(points), -1, dtype=np.int64)
+
+        # the search would never end for labels with NaN coordinates
+        valid = np.flatnonzero(is_location(points))
+
+        # chunk the points to keep the candidate arrays small
+        for chunk_start in range(0, len(valid), BATCH_CHUNK_SIZE):
+            chunk = valid[chunk_start:chunk_start + BATCH_CHUNK_SIZE]
+            distances[chunk], middleness[chunk], segment_ids[chunk] = self._compute_proximity_chunk(points[chunk])
+
+        if return_segment_ids:
+            return distances, middleness, segment_ids
+        return distances, middleness
+
+    def _compute_proximity_chunk(self, points):
+        if self.raster is None:
+            return self._compute_exact_chunk(points)
+
+        if self.metrics is not None:
+            lookup_start = time.perf_counter()
+        distances, middleness, segment_ids, exact = self.raster.lookup(points, self.max_distance)
+        if self.metrics is not None:
+            self.metrics.observe_time('batch_raster', time.perf_counter() - lookup_start)
+        if exact.any():
+            distances[exact], middleness[exact], segment_ids[exact] = self._compute_exact_chunk(points[exact])
+        return distances, middleness, segment_ids
+
+    def _compute_exact_chunk(self, points):
+        metrics = self.metrics
+        candidate_counts = None
+        if metrics is not None:
+            search_start = time.perf_counter()
+            candidate_counts = np.zeros(len(points), dtype=np.int64)
+
+        max_search_size = None
+        if self.max_distance is not None:
+            max_search_size = get_search_size(self.max_distance, points[:, 1])
+        sub_segments, closest_points = get_closest_segment_to_each_point(
+            self.segment_grid, self.segment_vertices, self.sub_segment_line, points, max_search_size,
+            candidate_counts)
+
+        if metrics is not None:
+            search_end = time.perf_counter()
+            metrics.observe_time('batch_search', search_end - search_start)
+            metrics.observe_candidates(candidate_counts)
+
+        distances = np.full(len(points), np.nan)
+        middleness = np.full(len(points), np.nan)
+        found = sub_segments >= 0
+        if self.max_distance is not None:
+            found[found] = get_approximate_distance(points[found], closest_points[found]) <= self.max_distance
+        distances[found], middleness[found] = self._proximity_along_segments(sub_segments[found],
+                                                                             closest_points[found])
+        segment_ids = np.full(len(points), -1, dtype=np.int64)
+        segment_ids[found] = self.sub_segment_line[sub_segments[found]]
+
+        if metrics is not None:
+            measure_end = time.perf_counter()
+            metrics.observe_time('batch_measure', measure_end - search_end)
+            metrics.observe_time('batch', measure_end - search_start)
+        return distances, middleness, segment_ids
+
+    def _proximity_along_segments(self, sub_segments, closest_points):
+        """
+        Compute distance to the closer segment end and middleness from the closest sub-segment of each label
+        :param sub_segments: array of sub-segment ids
+        :param closest_points: (n, 2) array of the closest point on each sub-segment, in (lng, lat)
+        :return: tuple of arrays (absolute_dist_in_meters, middleness_percentage)
+        """
+        line = self.sub_segment_line[sub_segments]
+        vertex = sub_segments + line
+        last_vertex = self.segment_offsets[line + 1] - 1
 
-        # Print the line as geojson
-        if self.verbose:
-            print("Here is the line segment found closest to the label:")
-            # print(shapely_line)
-            print([', '.join([('%.6f' % k) for k in reversed(a)]) for a in list(shapely_line.coords)])
+        # Position of the closest point along its sub-segment, as a fraction between 0 and 1
+        sub_segment_length = self.cumulative_lengths[vertex + 1] - self.cumulative_lengths[vertex]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            t = np.hypot(*(closest_points - self.segment_vertices[vertex]).T) / sub_segment_length
+        t = np.nan_to_num(t)
 
-        if self.cache:
-            proximity_cache[label_lat, label_lng] = distance_to_segment_end, middleness_pct
-        
-        return distance_to_segment_end, middleness_pct
+        # Position of label on the segment expressed as a fraction between 0 and 1
+        line_start_to_closest_pt_len = self.cumulative_lengths[vertex] + t * sub_segment_length
+        point_position_fraction = line_start_to_closest_pt_len / self.cumulative_lengths[last_vertex]
+
+        # Position of label on the segment expressed as a percentage from 0 to 100,
+        # where 50 represents the middle of the segment and 0 represents both ends
+        middleness = 100 * (np.minimum(point_position_fraction, 1 - point_position_fraction) / 0.5)
 
+        # Lengths of the two pieces on either side of the closest point, in meters. Sub-segments are short
+        # enough that the closest point sits at the same fraction t of the projected sub-segment.
+        left_segment_length = self.cumulative_lengths_metric[vertex] + \
+            t * (self.cumulative_lengths_metric[vertex + 1] - self.cumulative_lengths_metric[vertex])
+        right_segment_length = self.cumulative_lengths_metric[last_vertex] - left_segment_length
 
+        # The shorter piece represents the distance from label to end of street segment
+        return np.minimum(left_segment_length, right_segment_length), middleness
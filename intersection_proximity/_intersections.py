@@ -0,0 +1,116 @@
+import json
+import os
+import numpy as np
+from ._batch import SegmentGrid
+from ._projection import METERS_PER_DEGREE, get_approximate_distance, get_search_size
+
+# Searches over the street intersections of a city, written by generate_intersection_index. Every intersection is
+# stored in the grid as a sub-segment with both ends at its point, so a search of radius cells around a point finds
+# every intersection within radius * cell_size + pad degrees of it. Distances are measured in meters with
+# get_approximate_distance, which is never less than that many degrees at the scale of longitude at the point, so
+# a search that reaches some number of meters that way finds every intersection that close.
+
+
+class IntersectionIndex:
+    """
+    Spatial index over the street intersections of a city. Intersections are identified by their position in
+    points; street_names holds the sorted names of the streets that meet at each of them.
+    """
+    def __init__(self, index_dir):
+        """
+        Open an index written by generate_intersection_index, memory-mapping its arrays
+        """
+        self.points = np.load(os.path.join(index_dir, 'points.npy'), mmap_mode='r')
+        with open(os.path.join(index_dir, 'street-names.json')) as f:
+            self.street_names = json.load(f)
+        self.grid = SegmentGrid.load(index_dir)
+
+    def __len__(self):
+        return len(self.points)
+
+    def _reach(self, points, radius):
+        """
+        :return: distance in meters within which a search of radius cells around each point finds every
+        intersection
+        """
+        return (radius * self.grid.cell_size + self.grid.pad) * METERS_PER_DEGREE * np.cos(np.radians(points[:, 1]))
+
+    def _candidates(self, points, radius):
+        """
+        Get the intersections in the cells within some number of cells of each point
+        :return: (point index, intersection id, distance in meters) arrays of distinct intersections, grouped by
+        point index and sorted by distance within each point
+        """
+        point_index, ids = self.grid.candidates(points, radius)
+        distances = get_approximate_distance(points[point_index], self.points[ids])
+        order = np.lexsort((ids, distances, point_index))
+        point_index, ids, distances = point_index[order], ids[order], distances[order]
+        # an intersection near the border of a cell is stored in the cells next to it too
+        distinct = np.ones(len(ids), dtype=bool)
+        distinct[1:] = (point_index[1:] != point_index[:-1]) | (ids[1:] != ids[:-1])
+        return point_index[distinct], ids[distinct], distances[distinct]
+
+    def _covers(self, points, radius):
+        """
+        Check whether a search of radius cells around each point reaches every cell of the grid
+        """
+        min_x, min_y, max_x, max_y = self.grid.bounds
+        farthest = np.hypot(np.maximum(points[:, 0] - min_x, max_x - points[:, 0]),
+                            np.maximum(points[:, 1] - min_y, max_y - points[:, 1]))
+        return radius * self.grid.cell_size + self.grid.pad >= farthest
+
+    def nearest(self, points, k=1):
+        """
+        Find the k intersections closest to each point. Points far from the city are searched with a
+        neighborhood that grows until it reaches k intersections, like get_closest_segment_to_each_point.
+        :param points: (n, 2) array of (lng, lat)
+        :param k: number of intersections to find for each point
+        :return: (intersection ids, distances in meters) arrays of shape (n, k), closest first; -1 and NaN where
+        the city has fewer than k intersections
+        """
+        ids = np.full((len(points), k), -1, dtype=np.int64)
+        distances = np.full((len(points), k), np.nan)
+
+        todo = np.arange(len(points))
+        gap = self.grid.cells_to_grid(points)
+        radius = gap.copy()
+        while len(todo):
+            point_index, candidates, d = self._candidates(points[todo], radius[todo])
+            counts = np.bincount(point_index, minlength=len(todo))
+            group_start = np.cumsum(counts) - counts
+            rank = np.arange(len(point_index)) - group_start[point_index]
+            has_k = counts >= k
+            kth = np.full(len(todo), np.inf)
+            kth[has_k] = d[group_start[has_k] + k - 1]
+
+            # every intersection closer than the k-th candidate was a candidate if the search reached that far
+            done = (kth <= self._reach(points[todo], radius[todo])) | self._covers(points[todo], radius[todo])
+            keep = done[point_index] & (rank < k)
+            ids[todo[point_index[keep]], rank[keep]] = candidates[keep]
+            distances[todo[point_index[keep]], rank[keep]] = d[keep]
+
+            # search again with a neighborhood that reaches the k-th candidate, or twice as far into the grid if
+            # there were fewer than k
+            again = ~done
+            with np.errstate(invalid='ignore'):
+                next_radius = np.where(
+                    has_k, np.ceil((get_search_size(kth, points[todo, 1]) - self.grid.pad) / self.grid.cell_size),
+                    2 * radius[todo] - gap[todo] + 1)
+            radius[todo[again]] = np.maximum(next_radius, radius[todo] + 1)[again]
+            todo = todo[again]
+
+        return ids, distances
+
+    def within(self, points, max_distance):
+        """
+        Find the intersections within some distance of each point
+        :param points: (n, 2) array of (lng, lat)
+        :param max_distance: distance in meters, for all points or for each one
+        :return: (point index, intersection id, distance in meters) arrays, grouped by point index and closest first
+        """
+        max_distance = np.broadcast_to(max_distance, len(points))
+        search_size = get_search_size(max_distance, points[:, 1])
+        radius = np.ceil(np.maximum(search_size - self.grid.pad, 0) / self.grid.cell_size).astype(np.int64)
+        point_index, ids, distances = self._candidates(points, radius)
+        near = distances <= max_distance[point_index]
+        return point_index[near], ids[near], distances[near]
@@ -0,0 +1,151 @@
+from bisect import bisect_left
+import threading
+import numpy as np
+
+# Upper bounds of the histogram buckets, like Prometheus histograms: a value falls in the first bucket whose
+# bound is >= the value, or in a last, unbounded bucket.
+TIME_BUCKETS = (1e-5, 2.5e-5, 5e-5, 1e-4, 2.5e-4, 5e-4, 1e-3, 2.5e-3, 5e-3, 1e-2, 2.5e-2, 5e-2, 0.1, 0.25, 0.5, 1,
+                2.5, 5, 10)
+CANDIDATE_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def observe_many(self, values):
+        values = np.asarray(values)
+        counts = np.bincount(np.searchsorted(self.buckets, values, side='left'), minlength=len(self.counts))
+        for i, count in enumerate(counts.tolist()):
+            self.counts[i] += count
+        self.sum += values.sum().item()
+        self.count += len(values)
+
+    def as_dict(self):
+        """
+        :return: dict with the count, sum and mean of the values, and the number of values in each bucket
+        (keyed by its upper bound)
+        """
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'mean': self.sum / self.count if self.count else None,
+            'buckets': dict(zip([str(bound) for bound in self.buckets] + ['+Inf'], self.counts))
+        }
+
+
+class ProximityMetrics:
+    """
+    Timings and counts collected by an IntersectionProximity created with metrics enabled. Time spent in each
+    stage of a query and the number of candidate segments examined per label are kept as histograms; the index
+    load time and the result cache counters are exported alongside them.
+    One ProximityMetrics can be shared by several IntersectionProximity objects, and by several threads.
+    """
+    def __init__(self):
+        self.stage_seconds = {}
+        self.candidates = Histogram(CANDIDATE_BUCKETS)
+        self.values = {}
+        self.caches = []
+        self.callbacks = []
+        self._lock = threading.Lock()
+
+    def add_callback(self, callback):
+        """
+        Call a function for every observation, e.g. to forward it to another metrics system
+        :param callback: function of (name, value). name is a stage name with value in seconds, 'candidates' with
+        the number of candidate segments of a label (an array of them for batches), or the name of a value set
+        with set_value.
+        """
+        self.callbacks.append(callback)
+
+    def observe_time(self, stage, seconds):
+        with self._lock:
+            if stage not in self.stage_seconds:
+                self.stage_seconds[stage] = Histogram(TIME_BUCKETS)
+            self.stage_seconds[stage].observe(seconds)
+        for callback in self.callbacks:
+            callback(stage, seconds)
+
+    def observe_candidates(self, counts):
+        """
+        :param counts: number of candidate segments examined for a label, or an array of them for many labels
+        """
+        with self._lock:
+            if np.ndim(counts):
+                self.candidates.observe_many(counts)
+            else:
+                self.candidates.observe(counts)
+        for callback in self.callbacks:
+            callback('candidates', counts)
+
+    def set_value(self, name, value):
+        with self._lock:
+            self.values[name] = value
+        for callback in self.callbacks:
+            callback(name, value)
+
+    def get_cache_stats(self):
+        """
+        :return: hit, miss and eviction counts and size summed over the result caches of the instances
+        """
+        totals = {'size': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
+        for cache in self.caches:
+            stats = cache.stats()
+            for key in totals:
+                totals[key] += stats[key]
+        lookups = totals['hits'] + totals['misses']
+        totals['hit_rate'] = totals['hits'] / lookups if lookups else None
+        return totals
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'stage_seconds': {stage: histogram.as_dict() for stage, histogram in self.stage_seconds.items()},
+                'candidates': self.candidates.as_dict(),
+                'values': dict(self.values),
+                'cache': self.get_cache_stats()
+            }
+
+    def to_prometheus(self, prefix='intersection_proximity'):
+        """
+        Format the metrics in the Prometheus text exposition format
+        """
+        lines = []
+
+        def add_histogram(name, description, histograms, label=None):
+            lines.append('# HELP {}_{} {}'.format(prefix, name, description))
+            lines.append('# TYPE {}_{} histogram'.format(prefix, name))
+            for label_value, histogram in histograms:
+                labels = '' if label is None else '{}="{}",'.format(label, label_value)
+                cumulative = 0
+                for bound, count in zip([repr(float(b)) for b in histogram.buckets] + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    lines.append('{}_{}_bucket{{{}le="{}"}} {}'.format(prefix, name, labels, bound, cumulative))
+                labels = '' if label is None else '{{{}="{}"}}'.format(label, label_value)
+                lines.append('{}_{}_sum{} {}'.format(prefix, name, labels, repr(float(histogram.sum))))
+                lines.append('{}_{}_count{} {}'.format(prefix, name, labels, histogram.count))
+
+        with self._lock:
+            add_histogram('stage_seconds', 'Time spent in each stage of computing proximities.',
+                          sorted(self.stage_seconds.items()), label='stage')
+            add_histogram('candidates', 'Number of candidate street segments examined per label.',
+                          [(None, self.candidates)])
+            for name, value in sorted(self.values.items()):
+                lines.append('# TYPE {}_{} gauge'.format(prefix, name))
+                lines.append('{}_{} {}'.format(prefix, name, repr(float(value))))
+
+        cache = self.get_cache_stats()
+        for name in ('hits', 'misses', 'evictions'):
+            lines.append('# TYPE {}_cache_{}_total counter'.format(prefix, name))
+            lines.append('{}_cache_{}_total {}'.format(prefix, name, cache[name]))
+        lines.append('# TYPE {}_cache_size gauge'.format(prefix))
+        lines.append('{}_cache_size {}'.format(prefix, cache['size']))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,76 @@
+import numpy as np
+
+# Length of a degree of latitude (or of longitude at the equator) on a spherical earth
+METERS_PER_DEGREE = 111195
+
+
+def is_location(points):
+    """
+    Check which points are locations on earth: neither coordinate is NaN, latitudes are within 90 degrees and
+    longitudes within 180 degrees of 0
+    :param points: (n, 2) array of (lng, lat)
+    """
+    return (np.abs(points[:, 0]) <= 180) & (np.abs(points[:, 1]) <= 90)
+
+
+def get_search_size(meters, lat):
+    """
+    Get a distance in degrees, measured the way the segment search measures it (treating degrees of longitude
+    and latitude alike), that reaches every point within some meters of a location
+    :param meters: distance in meters
+    :param lat: latitude of the location
+    """
+    return meters / (METERS_PER_DEGREE * np.cos(np.radians(lat)))
+
+
+def get_approximate_distance(a, b):
+    """
+    Approximate distance in meters between (lng, lat) points, using the scale of longitude at the latitude of
+    the first points. This is precise enough for nearby points, and consistent with get_search_size.
+    :param a: (n, 2) array of (lng, lat)
+    :param b: (n, 2) array of (lng, lat)
+    """
+    d_lng = (a[:, 0] - b[:, 0]) * np.cos(np.radians(a[:, 1]))
+    return METERS_PER_DEGREE * np.hypot(d_lng, a[:, 1] - b[:, 1])
+
+
+def get_utm_crs(lng, lat):
+    """
+    Get the WGS 84 / UTM zone CRS that contains a point
+    :param lng: longitude of the point
+    :param lat: latitude of the point
+    :return: CRS string, e.g. 'EPSG:32610' for Seattle
+    """
+    zone = int((lng + 180) // 6) % 60 + 1
+    if lat >= 0:
+        return 'EPSG:{}'.format(32600 + zone)
+    return 'EPSG:{}'.format(32700 + zone)
+
+
+class MetricProjection:
+    """
+    Projects (lng, lat) coordinates to a metric CRS, so lengths along streets can be measured in meters.
+    The transformer is built once and reused for every call.
+    """
+    def __init__(self, crs):
+        # pyproj is only needed to preprocess, so it isn't imported with the package
+        import pyproj
+        self.crs = crs
+        self.transformer = pyproj.Transformer.from_crs('EPSG:4326', crs, always_xy=True)
+
+    @classmethod
+    def for_vertices(cls, vertices):
+        """
+        Create a projection into the UTM zone at the center of the bounding box of some vertices
+        :param vertices: (n, 2) array of (lng, lat)
+        """
+        center = (vertices.min(axis=0) + vertices.max(axis=0)) / 2
+        return cls(get_utm_crs(center[0], center[1]))
+
+    def project(self, vertices):
+        """
+        :param vertices: (n, 2) array of (lng, lat)
+        :return: (n, 2) array of (x, y) in meters
+        """
+        x, y = self.transformer.transform(vertices[:, 0], vertices[:, 1])
+        return np.column_stack((x, y))
@@ -0,0 +1,188 @@
+import json
+import os
+import shutil
+import numpy as np
+from numpy.lib.format import open_memmap
+from ._batch import get_closest_segment_to_each_point, get_distance_many
+from ._projection import METERS_PER_DEGREE, get_approximate_distance
+from .settings import *
+
+# A proximity raster stores the result of the cell center for every cell of a grid over a city, so approximate
+# results for any number of labels are just array lookups. Cells are cell_size meters on each side and grouped
+# in square tiles of RASTER_TILE_SIZE cells: every result array has shape (tile rows, tile columns, tile size,
+# tile size), so the cells of a tile, and so of a small area, are next to each other in the memory-mapped file.
+#
+# Inside a cell the closest point of a label moves along its sub-segment by at most the distance between the label
+# and the cell center, which is at most half a cell diagonal (in the degrees the segment search measures in), as
+# long as no other sub-segment can be closer to any part of the cell. Results therefore differ from the exact ones
+# by at most error_bound meters, and middleness by at most 200 * error_bound / segment length percentage points.
+# Cells where another sub-segment may be closer, i.e. near segment boundaries and on the inner side of bends, are
+# marked with segment id -1 and answered exactly instead, as are cells outside the street network's bounds.
+
+RASTER_FILES = ('distance', 'middleness', 'segment', 'segment-distance')
+
+
+def get_unambiguous(proximity, points, sub_segments, closest_points, reach):
+    """
+    Check for every point that no sub-segment other than its closest one can be the closest one to a point within
+    some distance of it
+    :param proximity: IntersectionProximity to check with
+    :param points: (n, 2) array of (lng, lat)
+    :param sub_segments: closest sub-segment of every point
+    :param closest_points: closest point on it of every point
+    :param reach: distance around the points, in degrees
+    """
+    grid, vertices, sub_segment_line = proximity.segment_grid, proximity.segment_vertices, proximity.sub_segment_line
+    distances = np.hypot(*(points - closest_points).T)
+    # a sub-segment can only be closest to a point within reach if it is within the closest distance + 2 * reach
+    limit = distances + 2 * reach
+    radius = np.ceil(np.maximum(limit - grid.pad, 0) / grid.cell_size).astype(np.int64)
+    point_index, candidates = grid.candidates(points, radius)
+    line = sub_segment_line[candidates]
+    first_vertex = candidates + line
+    candidate_closest, candidate_distances = get_distance_many(points[point_index], vertices[first_vertex],
+                                                               vertices[first_vertex + 1])
+    nearest = sub_segments[point_index]
+    distance, reach = distances[point_index], reach[point_index]
+
+    # The difference between the distances to a candidate and to the closest sub-segment changes by at most
+    # 2 * sin(angle / 2) per unit moved, where angle is between the directions from the two sub-segments to the
+    # point. That direction turns by at most 1 / distance per unit moved, so far from both sub-segments the
+    # difference changes slowly and a candidate only competes if it is nearly as close.
+    with np.errstate(invalid='ignore', divide='ignore'):
+        away = (points[point_index] - closest_points[point_index]) / distance[:, None]
+        candidate_away = (points[point_index] - candidate_closest) / candidate_distances[:, None]
+        angle = np.arccos(np.clip((away * candidate_away).sum(axis=1), -1, 1)) + \
+            reach / (distance - reach) + reach / (candidate_distances - reach)
+    angle = np.where((distance > reach) & (candidate_distances > reach), np.minimum(angle, np.pi), np.pi)
+    competing = (candidates != nearest) & (candidate_distances - distance <= 2 * reach * np.sin(angle / 2))
+
+    # the sub-segments before and after the closest one only take over on the inner side of the bend between them,
+    # so they don't compete with points far enough on the outer side
+    adjacent = (line == sub_segment_line[nearest]) & (np.abs(candidates - nearest) == 1)
+    start = vertices[nearest + line]
+    direction = vertices[nearest + line + 1] - start
+    far_vertex = np.where(candidates > nearest, first_vertex + 1, first_vertex)
+    bend = np.cross(direction, vertices[far_vertex] - start)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        side = np.cross(direction, points[point_index] - start) / np.hypot(*direction.T)
+    competing &= ~(adjacent & ((bend == 0) | (np.sign(bend) * side < -reach)))
+    return np.bincount(point_index[competing], minlength=len(points)) == 0
+
+
+def get_raster_cells(proximity, points, reach):
+    """
+    Compute the results of the cells of a raster
+    :param proximity: IntersectionProximity to compute with
+    :param points: (n, 2) array of the centers of the cells, in (lng, lat)
+    :param reach: half the diagonal of a cell, in degrees
+    :return: (distances, middleness, segment ids, distances to the segments in meters); segment id -1 for the
+    cells that have to be answered exactly
+    """
+    distances, middleness = np.empty(len(points)), np.empty(len(points))
+    segments, segment_distances = np.empty(len(points), dtype=np.int64), np.empty(len(points))
+    for chunk_start in range(0, len(points), BATCH_CHUNK_SIZE):
+        chunk = slice(chunk_start, chunk_start + BATCH_CHUNK_SIZE)
+        sub_segments, closest_points = get_closest_segment_to_each_point(
+            proximity.segment_grid, proximity.segment_vertices, proximity.sub_segment_line, points[chunk])
+        distances[chunk], middleness[chunk] = proximity._proximity_along_segments(sub_segments, closest_points)
+        unambiguous = get_unambiguous(proximity, points[chunk], sub_segments, closest_points,
+                                      np.full(len(sub_segments), reach))
+        segments[chunk] = np.where(unambiguous, proximity.sub_segment_line[sub_segments], -1)
+        segment_distances[chunk] = get_approximate_distance(points[chunk], closest_points)
+    return distances, middleness, segments, segment_distances
+
+
+def generate_raster(proximity, raster_dir, cell_size):
+    """
+    Precompute the results of every cell of a raster over a city's street network
+    :param proximity: IntersectionProximity of the city
+    :param raster_dir: directory to write the raster to
+    :param cell_size: length of the side of a cell, in meters
+    """
+    min_lng, min_lat, max_lng, max_lat = bounds = proximity.bounds
+    cell_lat = cell_size / METERS_PER_DEGREE
+    cell_lng = cell_size / (METERS_PER_DEGREE * np.cos(np.radians((min_lat + max_lat) / 2)))
+    tiles = (int(np.ceil((max_lat - min_lat) / cell_lat / RASTER_TILE_SIZE)),
+             int(np.ceil((max_lng - min_lng) / cell_lng / RASTER_TILE_SIZE)))
+    reach = np.hypot(cell_lng, cell_lat) / 2
+    error_bound = METERS_PER_DEGREE * reach
+
+    temporary_dir = raster_dir + '.tmp'
+    shutil.rmtree(temporary_dir, ignore_errors=True)
+    os.makedirs(temporary_dir)
+    shape = tiles + (RASTER_TILE_SIZE, RASTER_TILE_SIZE)
+    arrays = {name: open_memmap(os.path.join(temporary_dir, name + '.npy'), 'w+',
+                                np.int32 if name == 'segment' else np.float32, shape) for name in RASTER_FILES}
+
+    steps = np.arange(RASTER_TILE_SIZE) + 0.5
+    for tile_row in range(tiles[0]):
+        for tile_col in range(tiles[1]):
+            lats = min_lat + (tile_row * RASTER_TILE_SIZE + steps) * cell_lat
+            lngs = min_lng + (tile_col * RASTER_TILE_SIZE + steps) * cell_lng
+            centers = np.stack(np.meshgrid(lngs, lats), axis=-1).reshape(-1, 2)
+            # the last tiles reach past the street network, where there are no labels to speed up
+            inside = ((centers >= bounds[:2]) & (centers <= bounds[2:])).all(axis=1)
+            results = np.full(len(centers), np.nan), np.full(len(centers), np.nan), \
+                np.full(len(centers), -1), np.full(len(centers), np.nan)
+            for result, cells in zip(results, get_raster_cells(proximity, centers[inside], reach)):
+                result[inside] = cells
+            for name, result in zip(RASTER_FILES, results):
+                arrays[name][tile_row, tile_col] = result.reshape(RASTER_TILE_SIZE, RASTER_TILE_SIZE)
+
+    for array in arrays.values():
+        array.flush()
+    with open(os.path.join(temporary_dir, 'raster.json'), 'w') as f:
+        json.dump({'cell_size': cell_size, 'origin': [min_lng, min_lat], 'cell_degrees': [cell_lng, cell_lat],
+                   'tiles': tiles, 'tile_size': RASTER_TILE_SIZE, 'error_bound': error_bound}, f)
+    os.replace(temporary_dir, raster_dir)
+
+
+class ProximityRaster:
+    """
+    Precomputed approximate results over a city, written by generate_raster
+    """
+    def __init__(self, raster_dir):
+        """
+        Open a raster, memory-mapping its arrays
+        """
+        with open(os.path.join(raster_dir, 'raster.json')) as f:
+            geometry = json.load(f)
+        self.cell_size = geometry['cell_size']
+        self.origin = np.array(geometry['origin'])
+        self.cell_degrees = np.array(geometry['cell_degrees'])
+        self.tile_size = geometry['tile_size']
+        self.shape = np.array(geometry['tiles']) * self.tile_size
+        self.error_bound = geometry['error_bound']
+        self.arrays = {name: np.load(os.path.join(raster_dir, name + '.npy'), mmap_mode='r')
+                       for name in RASTER_FILES}
+
+    def lookup(self, points, max_distance=None):
+        """
+        Look up the results of points in the raster
+        :param points: (n, 2) array of (lng, lat)
+        :param max_distance: if given, points farther than this many meters from every street segment have no result
+        :return: (distances, middleness, segment ids, exact), where exact marks the points the raster can't answer:
+        points outside it, in cells near segment boundaries, or about max_distance from their segment
+        """
+        # cells are indexed (row, col), i.e. (lat, lng)
+        cell = np.floor((points - self.origin) / self.cell_degrees).astype(np.int64)[:, ::-1]
+        inside = ((cell >= 0) & (cell < self.shape)).all(axis=1)
+        tile, cell = np.divmod(cell[inside], self.tile_size)
+        index = tile[:, 0], tile[:, 1], cell[:, 0], cell[:, 1]
+
+        distances = np.full(len(points), np.nan)
+        middleness = np.full(len(points), np.nan)
+        segment_ids = np.full(len(points), -1, dtype=np.int64)
+        distances[inside] = self.arrays['distance'][index]
+        middleness[inside] = self.arrays['middleness'][index]
+        segment_ids[inside] = self.arrays['segment'][index]
+        exact = segment_ids < 0
+
+        if max_distance is not None:
+            segment_distances = np.full(len(points), np.nan)
+            segment_distances[inside] = self.arrays['segment-distance'][index]
+            exact |= np.abs(segment_distances - max_distance) <= self.error_bound
+            too_far = ~exact & (segment_distances > max_distance)
+            distances[too_far], middleness[too_far], segment_ids[too_far] = np.nan, np.nan, -1
+        return distances, middleness, segment_ids, exact
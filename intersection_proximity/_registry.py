@@ -0,0 +1,187 @@
+from collections import OrderedDict
+import os
+import threading
+import numpy as np
+from ._batch import SegmentGrid
+from ._geojson import get_collection_bounds
+from ._intersection_proximity import IntersectionProximity, get_intermediate_files
+from .settings import *
+
+
+class CityRegistry:
+    """
+    Serves proximity queries for many cities from one process. Each query is routed to the city whose street
+    network bounding box contains it, and a city's IntersectionProximity is only created the first time one
+    of its labels is queried. Cities are loaded (and preprocessed) under a lock of their own, so queries for
+    other cities go on meanwhile. When the loaded cities use more memory than the budget, the least recently
+    used ones are unloaded.
+    """
+    def __init__(self, city_configs=None, memory_budget=None, **proximity_kwargs):
+        """
+        :param city_configs: dict of city name -> city config, as passed to IntersectionProximity.
+        Defaults to default_settings.
+        :param memory_budget: maximum memory, in bytes, that loaded cities may use (as estimated by
+        IntersectionProximity.memory_usage). The most recently used city is always kept loaded.
+        :param proximity_kwargs: extra arguments for every IntersectionProximity (cache_size, max_distance, ...)
+        """
+        self.city_configs = dict(default_settings if city_configs is None else city_configs)
+        self.memory_budget = memory_budget
+        self.proximity_kwargs = proximity_kwargs
+        self._loaded = OrderedDict()
+        self._bounds = {}
+        self._lock = threading.RLock()
+        # held while a city is loaded, so that it's loaded once
+        self._city_locks = {}
+
+    def get(self, city):
+        """
+        Get the IntersectionProximity for a city, loading (and if needed preprocessing) it on first use
+        :param city: city name
+        """
+        with self._lock:
+            if city in self._loaded:
+                self._loaded.move_to_end(city)
+                return self._loaded[city]
+            if city not in self.city_configs:
+                raise Exception("Unknown city: {}".format(city))
+            city_lock = self._city_locks.setdefault(city, threading.Lock())
+
+        with city_lock:
+            with self._lock:
+                if city in self._loaded:
+                    self._loaded.move_to_end(city)
+                    return self._loaded[city]
+            ip = IntersectionProximity(self.city_configs[city], **self.proximity_kwargs)
+            with self._lock:
+                self._loaded[city] = ip
+                self._bounds[city] = ip.bounds
+                self._unload_over_budget()
+            return ip
+
+    def unload(self, city):
+        """
+        Drop a loaded city. It is loaded again the next time one of its labels is queried.
+        """
+        with self._lock:
+            self._loaded.pop(city, None)
+
+    def _unload_over_budget(self):
+        if self.memory_budget is None:
+            return
+        while len(self._loaded) > 1 and self.memory_usage() > self.memory_budget:
+            self._loaded.popitem(last=False)
+
+    def memory_usage(self):
+        """
+        Estimate the memory used by the loaded cities, in bytes
+        """
+        with self._lock:
+            return sum(ip.memory_usage() for ip in self._loaded.values())
+
+    def loaded_cities(self):
+        """
+        :return: names of the loaded cities, from least to most recently used
+        """
+        with self._lock:
+            return list(self._loaded)
+
+    def bounds(self, city):
+        """
+        Get the bounding box (min_lng, min_lat, max_lng, max_lat) of a city's street network, without loading the
+        city. It is read from the city's segment index, or if the city hasn't been preprocessed yet, from its
+        street network file, padded by MIN_SIZE like the index.
+        :return: the bounding box, or None if the city has neither
+        """
+        with self._lock:
+            if city in self._bounds:
+                return self._bounds[city]
+            city_config = self.city_configs[city]
+            segment_index_dir = get_intermediate_files(city_config,
+                                                       self.proximity_kwargs.get('cache_dir'))['segment_index_dirname']
+
+        if os.path.exists(os.path.join(segment_index_dir, 'grid-geometry.npy')):
+            bounds = SegmentGrid.load(segment_index_dir).bounds
+        elif os.path.exists(city_config['street_network_filename']):
+            with open(city_config['street_network_filename']) as f:
+                bounds = get_collection_bounds(f)
+            if bounds is not None:
+                bounds = (bounds[0] - MIN_SIZE, bounds[1] - MIN_SIZE, bounds[2] + MIN_SIZE, bounds[3] + MIN_SIZE)
+        else:
+            bounds = None
+
+        with self._lock:
+            if bounds is not None:
+                bounds = self._bounds.setdefault(city, bounds)
+            return bounds
+
+    def _routing_table(self):
+        """
+        :return: (city names, (n, 4) array of their bounds), from the smallest to the largest bounding box,
+        so that where boxes overlap the most specific city is found first. Cities whose bounds are unknown
+        are left out.
+        """
+        cities = []
+        bounds = []
+        for city in self.city_configs:
+            city_bounds = self.bounds(city)
+            if city_bounds is not None:
+                cities.append(city)
+                bounds.append(city_bounds)
+        bounds = np.array(bounds, dtype=np.float64).reshape(-1, 4)
+        order = np.argsort((bounds[:, 2] - bounds[:, 0]) * (bounds[:, 3] - bounds[:, 1]), kind='stable')
+        return [cities[i] for i in order], bounds[order]
+
+    def route(self, label_lats, label_lngs):
+        """
+        Find the city each label is in
+        :param label_lats: array of latitudes
+        :param label_lngs: array of longitudes
+        :return: array of city indices into the returned list of city names (-1 for labels in no city),
+        and the list of city names
+        """
+        cities, bounds = self._routing_table()
+        lats = np.asarray(label_lats, dtype=np.float64)[:, None]
+        lngs = np.asarray(label_lngs, dtype=np.float64)[:, None]
+        inside = (lngs >= bounds[:, 0]) & (lats >= bounds[:, 1]) & (lngs <= bounds[:, 2]) & (lats <= bounds[:, 3])
+        city_index = np.where(inside.any(axis=1), inside.argmax(axis=1), -1)
+        return city_index, cities
+
+    def city_for(self, label_lat, label_lng):
+        """
+        :return: name of the city a label is in, or None if it is in none of them
+        """
+        city_index, cities = self.route([label_lat], [label_lng])
+        if city_index[0] < 0:
+            return None
+        return cities[city_index[0]]
+
+    def compute_proximity(self, label_lat, label_lng):
+        """
+        Compute the proximity of a label using the city it is in
+        :return: tuple (absolute_dist_in_meters, middleness_percentage), or None if the label is in no city
+        """
+        city = self.city_for(label_lat, label_lng)
+        if city is None:
+            return None
+        return self.get(city).compute_proximity(label_lat, label_lng)
+
+    def compute_proximity_many(self, label_lats, label_lngs=None):
+        """
+        Compute the proximity of many labels, from any of the cities, at once. Labels in no city get NaN.
+        :param label_lats: array of latitudes, or a DataFrame with 'lat' and 'lng' columns
+        :param label_lngs: array of longitudes, if label_lats is not a DataFrame
+        :return: tuple of arrays (absolute_dist_in_meters, middleness_percentage)
+        """
+        if label_lngs is None:
+            label_lats, label_lngs = label_lats['lat'], label_lats['lng']
+        lats = np.asarray(label_lats, dtype=np.float64)
+        lngs = np.asarray(label_lngs, dtype=np.float64)
+
+        distances = np.full(len(lats), np.nan)
+        middleness = np.full(len(lats), np.nan)
+        city_index, cities = self.route(lats, lngs)
+        for i in np.unique(city_index[city_index >= 0]):
+            labels = city_index == i
+            distances[labels], middleness[labels] = self.get(cities[i]).compute_proximity_many(lats[labels],
+                                                                                               lngs[labels])
+        return distances, middleness
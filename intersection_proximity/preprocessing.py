@@ -3,31 +3,82 @@ from dbfread import DBF
 from rtree import index
 import geojson
 from math import isclose
-from shapely.ops import linemerge, split, nearest_points
-from shapely.geometry import MultiLineString, LineString, Point, MultiPoint
+from shapely.ops import linemerge
+from shapely.geometry import LineString
+import numpy as np
 import pickle
+import json
 import sys
+import os
+import warnings
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from ._batch import get_segment_arrays, get_sub_segment_arrays, get_cumulative_lengths, save_array, SegmentGrid
+from ._projection import MetricProjection
+from ._geojson import iter_features
+from ._intermediates import load_segment_lengths, get_input_fingerprints, write_input_fingerprints, \
+    get_changed_input_fingerprints
 from .settings import *
 
 multiplier = 1e5 # multiply all floats by this multiplier so we can compare them as integers
 MIN_SIZE = .0006 # maximum distance (in terms of longitude/latitude) to "search" for nearby street segments
-MAX_DIST = 1/multiplier  # maximum distance between intersection and street for a street to to be cut
+
+
+def read_dbf_columns(dbf_file, columns, chunk_size=DBF_CHUNK_SIZE):
+    """
+    Read some of the columns of a DBF file. Records are fixed width, so the file is memory-mapped as a NumPy
+    record array and only the requested columns are copied out, a chunk at a time. Deleted records are skipped,
+    like dbfread does.
+    :param dbf_file: filename of the DBF file
+    :param columns: names of the columns to read
+    :param chunk_size: number of records to copy at a time
+    :return: (dict of column name -> array of raw bytes values, text encoding of the file)
+    """
+    table = DBF(dbf_file, load=False)
+    fields = [('deletion_flag', 'S1')] + [(field.name, 'S{}'.format(field.length)) for field in table.fields]
+    records = np.memmap(dbf_file, dtype=np.dtype(fields), mode='r', offset=table.header.headerlen,
+                        shape=(table.header.numrecords,))
+
+    values = {column: [np.array([], dtype=records.dtype[column])] for column in columns}
+    for start in range(0, len(records), chunk_size):
+        chunk = records[start:start + chunk_size]
+        chunk = chunk[chunk['deletion_flag'] != b'*']
+        for column in columns:
+            values[column].append(np.array(chunk[column]))
+
+    return {column: np.concatenate(values[column]) for column in columns}, table.encoding
 
 
 def generate_street_edge_name_map(road_network_dump, osm_way_ids, street_edge_name_file):
     """
     Generate a map of street edge id -> street name using the osm_way_ids
     This is needed for computing the street intersections later on.
+    Street edges whose osm_way_id is missing from the road network dump are left out of the map, with a warning.
     """
-    osm_data = pd.DataFrame(DBF(road_network_dump).records)
-    osm_data.set_index('osm_id', inplace=True)
-    street_name = osm_data['name']
+    osm_data, encoding = read_dbf_columns(road_network_dump, ['osm_id', 'name'])
+    try:
+        osm_ids = osm_data['osm_id'].astype(np.int64)
+    except ValueError:
+        # blank or non-integer ids
+        osm_ids = pd.to_numeric(pd.Series(np.char.decode(osm_data['osm_id'], encoding)), errors='coerce').values
 
     street_id = pd.read_csv(osm_way_ids)
     street_id.set_index('street_edge_id', inplace=True)
 
-    street_id_name = street_id.apply(lambda x: street_name.loc[x['osm_way_id']], axis=1)
-    street_id_name.to_csv(street_edge_name_file, header=['street_name'])
+    # only decode the names of the ways that are used
+    used = np.isin(osm_ids, street_id['osm_way_id'].values)
+    names = np.char.rstrip(np.char.decode(osm_data['name'][used], encoding))
+    street_name = pd.Series(names, index=osm_ids[used])
+    street_name = street_name[~street_name.index.duplicated()]
+
+    street_id_name = street_id['osm_way_id'].map(street_name).rename('street_name')
+
+    missing = street_id_name.isna()
+    if missing.any():
+        warnings.warn('{} street edges have an osm_way_id that is not in {}, leaving them out'.format(
+            missing.sum(), road_network_dump))
+    street_id_name = street_id_name[~missing]
+    street_id_name.to_csv(street_edge_name_file, header=True)
 
 
 def extract_street_coords_from_geojson(street):
@@ -44,75 +95,169 @@ def extract_street_coords_from_geojson(street):
     return edge_id, coords_list
 
 
-def generate_intersection_points(street_network_file, street_edge_name_file, intersection_points_file):
+def load_street_network(street_network_file, street_network_cache_file=None):
     """
-    Find all the points that are intersections between two DIFFERENT streets.
-    This is what we classify as a street intersection for calculating proximity.
+    Read the coordinates of every street edge in the street network. The GeoJSON file is streamed one feature
+    at a time, so memory use depends on the number of coordinates rather than on the size of the file. If a
+    cache file is given, the coordinates are saved to it as arrays, and later calls for the same (unchanged)
+    street network file load them from there without parsing any JSON.
+    :param street_network_file: GeoJSON FeatureCollection of street edges
+    :param street_network_cache_file: .npz file to cache the coordinates in
+    :return: (edge_ids, coords, offsets), where edge_ids[i] has coordinates coords[offsets[i]:offsets[i+1]]
     """
+    source_stat = os.stat(street_network_file)
+    source_stamp = np.array([source_stat.st_size, source_stat.st_mtime_ns], dtype=np.int64)
+
+    if street_network_cache_file is not None and os.path.exists(street_network_cache_file):
+        with np.load(street_network_cache_file) as cached:
+            if np.array_equal(cached['source_stamp'], source_stamp):
+                return cached['edge_ids'], cached['coords'], cached['offsets']
+
+    edge_ids = []
+    coords = array('d')
+    lengths = array('q')
     with open(street_network_file) as f:
-        streets_gj = geojson.load(f)
+        for street in iter_features(f):
+            edge_id, coords_list = extract_street_coords_from_geojson(street)
+            edge_ids.append(edge_id)
+            for c in coords_list:
+                coords.append(c[0])
+                coords.append(c[1])
+            lengths.append(len(coords_list))
+
+    edge_ids = np.asarray(edge_ids)
+    coords = np.frombuffer(coords, dtype=np.float64).reshape(-1, 2)
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(np.frombuffer(lengths, dtype=np.int64), out=offsets[1:])
+
+    if street_network_cache_file is not None:
+        np.savez(street_network_cache_file, source_stamp=source_stamp, edge_ids=edge_ids, coords=coords,
+                 offsets=offsets)
+    return edge_ids, coords, offsets
+
+
+def get_edge_id_to_coords(edge_ids, coords, offsets):
+    """
+    Map each street edge id to its coordinates
+    :return: dict of edge id -> (n, 2) coordinates array
+    """
+    return {edge_id: coords[offsets[i]:offsets[i + 1]] for i, edge_id in enumerate(edge_ids.tolist())}
 
-    # Read streets into a list of street edge id->coordinates mapping
-    streets_list = streets_gj['features']
 
-    edge_id_to_coords_list = {}
+def get_intersection_points(edge_ids, coords, offsets, edge_names):
+    """
+    Find the points at which street edges of at least two different streets meet, with arrays: every vertex gets
+    the code of its street's name, and the distinct (point, name code) pairs are counted per point
+    :param edge_ids: street edge id of every street edge
+    :param coords: (n, 2) array of the vertices of all the street edges
+    :param offsets: the vertices of edge i are coords[offsets[i]:offsets[i + 1]]
+    :param edge_names: Series of street edge id -> street name, with '' for unnamed streets; edges that aren't in
+    it are ignored
+    :return: dict of (lng, lat) point, multiplied by multiplier and truncated -> set of the names of its streets
+    """
+    name_codes, names = pd.factorize(edge_names.values)
+    # -1 for the edges without a name
+    edge_codes = np.append(name_codes, -1)[edge_names.index.get_indexer(edge_ids)]
+    vertex_codes = np.repeat(edge_codes, np.diff(offsets))
+    named = vertex_codes >= 0
+    keys = (coords[named] * multiplier).astype(np.int64)
+    packed, vertex_codes = pack_point_keys(keys), vertex_codes[named]
+
+    # sort by point, then name, and keep the first vertex of every distinct (point, name) pair
+    order = np.lexsort((vertex_codes, packed))
+    packed, vertex_codes, keys = packed[order], vertex_codes[order], keys[order]
+    distinct = np.ones(len(packed), dtype=bool)
+    distinct[1:] = (packed[1:] != packed[:-1]) | (vertex_codes[1:] != vertex_codes[:-1])
+    packed, vertex_codes, keys = packed[distinct], vertex_codes[distinct], keys[distinct]
+
+    # the points with more than one name
+    point_starts = np.flatnonzero(np.r_[True, packed[1:] != packed[:-1]])
+    point_ends = np.r_[point_starts[1:], len(packed)]
+    is_intersection = point_ends - point_starts > 1
+    intersection_points = dict()
+    for start, end in zip(point_starts[is_intersection].tolist(), point_ends[is_intersection].tolist()):
+        intersection_points[tuple(keys[start].tolist())] = set(names[vertex_codes[start:end]].tolist())
+    return intersection_points
 
-    # load all edges
-    for street in streets_list:
-        edge_id, coords_list = extract_street_coords_from_geojson(street)
-        edge_id_to_coords_list[edge_id] = coords_list
 
-    # compute which points are intersections of at least two different streets
-    points_to_streets = dict()
+def generate_intersection_points(street_network_file, street_edge_name_file, intersection_points_file,
+                                 street_network_cache_file=None):
+    """
+    Find all the points that are intersections between two DIFFERENT streets.
+    This is what we classify as a street intersection for calculating proximity.
+    """
+    edge_ids, coords, offsets = load_street_network(street_network_file, street_network_cache_file)
 
     edge_to_name = pd.read_csv(street_edge_name_file)
-    edge_to_name.set_index('street_edge_id', inplace=True)
+    # unnamed streets are represented as an empty string
+    edge_names = edge_to_name.set_index('street_edge_id').street_name.fillna('')
 
-    for edge_id, coords_list in edge_id_to_coords_list.items():
-        try:
-            street_name = edge_to_name.loc[edge_id].street_name
-        except KeyError:
-            continue
-
-        for float_point in coords_list:
-            point_lng, point_lat = int(float_point[0] * multiplier), int(float_point[1] * multiplier)
+    intersection_points = get_intersection_points(edge_ids, coords, offsets, edge_names)
+    with open(intersection_points_file, 'wb') as f:
+        pickle.dump(intersection_points, f)
 
-            # print(float_point)
-            if (point_lng, point_lat) not in points_to_streets:
-                points_to_streets[point_lng, point_lat] = set()
+def generate_intersection_index(intersection_points_file, index_dir):
+    """
+    Build the index of street intersections that nearest_intersections and intersections_within search. The
+    intersections are numbered in the order of their points, and stored as a points array, the names of their
+    streets and a SegmentGrid in which every intersection is a sub-segment with both ends at its point.
+    :param intersection_points_file: intersection points written by generate_intersection_points
+    :param index_dir: directory to write the index to
+    """
+    with open(intersection_points_file, 'rb') as f:
+        intersection_points = pickle.load(f)
+    keys = sorted(intersection_points)
+    # the points were truncated to 1 / multiplier degrees when they were found
+    points = np.array(keys, dtype=np.float64).reshape(-1, 2) / multiplier
 
-            if type(street_name) == str:
-                # Add a street to the intersection
-                points_to_streets[point_lng, point_lat].add(street_name)
-            elif pd.isna(street_name):
-                # Unnamed street, just represent it as an empty string
-                points_to_streets[point_lng, point_lat].add('')
+    os.makedirs(index_dir, exist_ok=True)
+    save_array(os.path.join(index_dir, 'points.npy'), points)
+    with open(os.path.join(index_dir, 'street-names.json'), 'w') as f:
+        json.dump([sorted(intersection_points[key]) for key in keys], f)
+    SegmentGrid(points, points).save(index_dir)
 
-    # filter all points that aren't on > 1 streets
-    intersection_points = dict()
-    for point, street_names in points_to_streets.items():
-        if len(street_names) > 1:
-            intersection_points[point] = street_names
 
-    with open(intersection_points_file, 'wb') as f:
-        pickle.dump(intersection_points, f)
-
-def generate_real_segments(street_network_file, intersection_points_file, street_edge_name_file, real_segments_file):
+def cut_street_at_points(street, points):
     """
-    Figure out what the "real" segments are from the street network, intersection points, ...
+    Cut a street at all of its intersection points at once. A vertex is an intersection if its coordinates,
+    multiplied by multiplier and truncated like in generate_intersection_points, are one of the points; so
+    every linestring is cut in one pass over its vertices.
+    :param street: LineString or MultiLineString of the street
+    :param points: set of intersection points on the street, as coordinates multiplied by multiplier
+    :return: list of LineStrings the street is cut into
     """
-    with open(street_network_file) as f:
-        streets_gj = geojson.load(f)
+    if street.type == 'LineString':
+        lines = [street]
+    else:
+        assert street.type == 'MultiLineString'
+        lines = list(street.geoms)
+
+    pieces = []
+    for line in lines:
+        coords = np.asarray(line.coords)
+        keys = (coords * multiplier).astype(np.int64)
 
-    # Read streets into a list of street edge id->coordinates mapping
-    streets_list = streets_gj['features']
+        # the ends of a linestring are never cut
+        cut_at = [i for i, key in enumerate(zip(keys[1:-1, 0].tolist(), keys[1:-1, 1].tolist()), 1) if key in points]
 
-    edge_id_to_coords_list = {}
+        start = 0
+        for end in cut_at + [len(coords) - 1]:
+            pieces.append(LineString(coords[start:end + 1]))
+            start = end
+    return pieces
 
-    # load all edges
-    for street_segment in streets_list:
-        edge_id, coords_list = extract_street_coords_from_geojson(street_segment)
-        edge_id_to_coords_list[edge_id] = coords_list
+
+def generate_real_segments(street_network_file, intersection_points_file, street_edge_name_file, real_segments_file,
+                           workers=1, street_network_cache_file=None, segment_streets_file=None):
+    """
+    Figure out what the "real" segments are from the street network, intersection points, ...
+    :param workers: number of processes to cut streets with. The result is the same for any number of workers.
+    :param segment_streets_file: if given, the name of the street every real segment was cut from is pickled
+    to this file, as a list in the same order as the real segments
+    """
+    # Read streets into a street edge id->coordinates mapping
+    edge_id_to_coords_list = get_edge_id_to_coords(*load_street_network(street_network_file,
+                                                                        street_network_cache_file))
 
     # now group streets with the same name together
     name_to_edge = pd.read_csv(street_edge_name_file)
@@ -120,78 +265,77 @@ def generate_real_segments(street_network_file, intersection_points_file, street
     # unnamed streets are currently nans, so make them empty strings so they appear in the groupby
     name_to_edge.fillna('', inplace=True)
     street_linestrings = name_to_edge.groupby('street_name').apply(
-        lambda x: linemerge([edge_id_to_coords_list[k] for k in x.street_edge_id.values])
+        lambda x: linemerge([edge_id_to_coords_list[k].tolist() for k in x.street_edge_id.values])
     )
 
     with open(intersection_points_file, 'rb') as f:
         intersection_points = pickle.load(f)
 
-    def cut_street(street, p):
-        if street.type == 'GeometryCollection':
-            street = MultiLineString(street)
-
-        if street.distance(p) < MAX_DIST:
-            # cut the segment and return it
-            # note: this only works because the point is pretty close to a vertex on the LineString!
-            # TODO change to use shapely.ops.snap with tolerance MAX_DIST
-
-            if street.type == 'LineString':
-                mp = MultiPoint(list(street.coords))
-            else:
-                assert street.type == 'MultiLineString'
-                points = []
-                for line_string in street.geoms:
-                    points += line_string.coords
-
-                mp = MultiPoint(points)
-
-            split_vertex = nearest_points(mp, p)[0]
-
-            return split(street, split_vertex)
-
-        return street
-
+    # group the intersection points by street
+    points_by_street = {street_name: set() for street_name in street_linestrings.index}
     for point, street_names in intersection_points.items():
         for street_name in street_names:
-            # cut streets at each intersection point
-            street_linestrings.at[street_name] = cut_street(street_linestrings.loc[street_name],
-                                                            Point([point[0] / multiplier, point[1] / multiplier]))
+            points_by_street[street_name].add(point)
+
+    # cut streets at each of their intersection points. Every street is cut independently of the others,
+    # so the streets can be split up between worker processes.
+    streets = list(street_linestrings.values)
+    street_points = [points_by_street[street_name] for street_name in street_linestrings.index]
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            chunksize = max(1, len(streets) // (workers * 4))
+            cut_streets = list(executor.map(cut_street_at_points, streets, street_points, chunksize=chunksize))
+    else:
+        cut_streets = list(map(cut_street_at_points, streets, street_points))
 
     # now generate a list of all the segments we found
     real_segments = list()
-    for geometry_collection in street_linestrings.values:
-        if geometry_collection.type in ['GeometryCollection', 'MultiLineString']:
-            for linestring in geometry_collection:
-                real_segments.append(linestring)
-
-        elif geometry_collection.type == 'LineString':
-            real_segments.append(geometry_collection)
-
-        else:
-            raise Exception(f'Unexpected type found when generating real segments: {geometry_collection.type}')
+    segment_streets = list()
+    for street_name, pieces in zip(street_linestrings.index, cut_streets):
+        real_segments.extend(pieces)
+        segment_streets.extend([street_name] * len(pieces))
 
     # pickle the real segments (no need to create new edge id's because they would be irrelevant)
     with open(real_segments_file, 'wb') as f:
         pickle.dump(real_segments, f)
 
+    if segment_streets_file is not None:
+        with open(segment_streets_file, 'wb') as f:
+            pickle.dump(segment_streets, f)
 
-def get_rtree(lines):
+
+def get_rtree_items(vertices, offsets, segments=None):
+    """
+    Get the rtree entries of the sub-segments of real segments. Entries hold no object, only the sub-segment id,
+    which points into the segment arrays.
+    :param vertices: vertex array from get_segment_arrays
+    :param offsets: segment offsets from get_segment_arrays
+    :param segments: ids of the segments to get the entries of; all of them by default
+    :return: generator of (sub-segment id, box, None)
     """
-    Get an rtree index from a list of lines.
-    :param lines: list of lines [[[a, b], [c, d]], ...]
+    sub_segment_line, sub_segment_vertex = get_sub_segment_arrays(offsets)
+    if segments is None:
+        sub_segments = np.arange(len(sub_segment_line))
+    else:
+        sub_segments = np.flatnonzero(np.isin(sub_segment_line, segments))
+    starts, ends = vertices[sub_segment_vertex[sub_segments]], vertices[sub_segment_vertex[sub_segments] + 1]
+    #box = left, bottom, right, top
+    boxes = np.hstack((np.minimum(starts, ends), np.maximum(starts, ends)))
+    for sub_segment, box in zip(sub_segments.tolist(), boxes.tolist()):
+        yield sub_segment, tuple(box), None
+
+
+def get_rtree(vertices, offsets, filename=None, segments=None):
     """
-    def generate_items():
-        sindx = 0
-        for lid, l in lines:
-            for i in range(len(l)-1):
-                a, b = l[i]
-                c, d = l[i+1]
-                segment = ((a,b), (c,d))
-                box = (min(a, c), min(b,d), max(a, c), max(b,d))
-                #box = left, bottom, right, top
-                yield (sindx, box, (lid, segment))
-                sindx += 1
-    return index.Index(generate_items())
+    Get an rtree index over the sub-segments of real segments
+    :param vertices: vertex array from get_segment_arrays
+    :param offsets: segment offsets from get_segment_arrays
+    :param filename: if given, the index is written to disk at this path (without extension) so it can be reopened
+    :param segments: ids of the segments to index; all of them by default
+    """
+    if filename is not None:
+        return index.Index(filename, get_rtree_items(vertices, offsets, segments))
+    return index.Index(get_rtree_items(vertices, offsets, segments))
 
 
 def make_street_network_index(real_segments_file):
@@ -199,23 +343,353 @@ def make_street_network_index(real_segments_file):
     Make a street network index from a file with real segments that have been pickled.
     The street network index uses rtree.
     :param real_segments_file: filename of real segments file
-    :return:
+    :return: (rtree index, vertices, offsets, sub-segment line ids); the rtree ids are sub-segment ids
     '''
     # Load the pickled segments file
     with open(real_segments_file, 'rb') as f:
         real_segments = pickle.load(f)
 
-    # Read segments into a list of id->coordinates mapping
-    id_to_segment = []
-    for i in range(len(real_segments)):
-        id_to_segment.append((i, list(real_segments[i].coords)))
-
     # Index the streets
-    idx = get_rtree(id_to_segment)
-    return idx, real_segments
+    vertices, offsets = get_segment_arrays(real_segments)
+    sub_segment_line, _ = get_sub_segment_arrays(offsets)
+    idx = get_rtree(vertices, offsets)
+    return idx, vertices, offsets, sub_segment_line
 
 
-def run_preprocess(city_settings):
+def generate_segment_index(real_segments_file, segment_index_dir, metric_crs=None, segment_streets_file=None):
+    """
+    Write the real segments as flat arrays, together with the spatial indexes over them, so that they can be
+    memory-mapped at startup (see load_segment_index) instead of being unpickled and indexed again.
+    :param real_segments_file: filename of real segments file
+    :param segment_index_dir: directory to write the arrays and the on-disk rtree to
+    :param metric_crs: CRS to measure lengths along the segments in (see generate_segment_lengths)
+    :param segment_streets_file: if given, the street names written by generate_real_segments, to store the street
+    of every segment (see write_segment_streets)
+    """
+    with open(real_segments_file, 'rb') as f:
+        real_segments = pickle.load(f)
+
+    vertices, offsets = get_segment_arrays(real_segments)
+    sub_segment_line, sub_segment_vertex = get_sub_segment_arrays(offsets)
+    grid = SegmentGrid(vertices[sub_segment_vertex], vertices[sub_segment_vertex + 1])
+
+    if not os.path.exists(segment_index_dir):
+        os.mkdir(segment_index_dir)
+    save_array(os.path.join(segment_index_dir, 'vertices.npy'), vertices)
+    save_array(os.path.join(segment_index_dir, 'offsets.npy'), offsets.astype(np.int32))
+    save_array(os.path.join(segment_index_dir, 'sub-segment-line.npy'), sub_segment_line.astype(np.int32))
+    grid.save(segment_index_dir)
+
+    idx = get_rtree(vertices, offsets, os.path.join(segment_index_dir, 'rtree'))
+    idx.close()
+
+    if segment_streets_file is not None:
+        with open(segment_streets_file, 'rb') as f:
+            write_segment_streets(segment_index_dir, pickle.load(f))
+    generate_segment_lengths(segment_index_dir, metric_crs)
+
+
+def write_segment_streets(segment_index_dir, segment_streets):
+    """
+    Store the street of every segment in a segment index, as an id per segment plus a list of street names
+    :param segment_streets: street name of every segment, or None for removed segments
+    """
+    street_names = sorted(set(segment_streets) - {None})
+    street_ids = {street_name: i for i, street_name in enumerate(street_names)}
+    segment_street = np.array([street_ids.get(street_name, -1) for street_name in segment_streets], dtype=np.int32)
+    save_array(os.path.join(segment_index_dir, 'segment-street.npy'), segment_street)
+    with open(os.path.join(segment_index_dir, 'street-names.json'), 'w') as f:
+        json.dump(street_names, f)
+
+
+def generate_segment_lengths(segment_index_dir, metric_crs=None):
+    """
+    Write the distance along its segment at every vertex of a segment index, both in degrees and in meters, so
+    that queries can measure along a segment with a lookup instead of building geometries.
+    :param segment_index_dir: directory written by generate_segment_index
+    :param metric_crs: CRS to measure meters in, e.g. 'EPSG:32610'; by default the UTM zone at the center of
+    the segments
+    """
+    vertices = np.load(os.path.join(segment_index_dir, 'vertices.npy'))
+    offsets = np.load(os.path.join(segment_index_dir, 'offsets.npy'))
+    if metric_crs is None:
+        projection = MetricProjection.for_vertices(vertices)
+    else:
+        projection = MetricProjection(metric_crs)
+
+    save_array(os.path.join(segment_index_dir, 'cumulative-lengths.npy'), get_cumulative_lengths(vertices, offsets))
+    save_array(os.path.join(segment_index_dir, 'cumulative-lengths-metric.npy'),
+               get_cumulative_lengths(projection.project(vertices), offsets))
+    with open(os.path.join(segment_index_dir, 'metric-crs.txt'), 'w') as f:
+        f.write(projection.crs)
+
+
+def read_street_edge_names(street_edge_name_file):
+    """
+    Read a map written by generate_street_edge_name_map
+    :return: dict of street edge id -> street name, with '' for unnamed streets
+    """
+    edge_to_name = pd.read_csv(street_edge_name_file)
+    edge_to_name.fillna('', inplace=True)
+    return dict(zip(edge_to_name.street_edge_id.tolist(), edge_to_name.street_name.tolist()))
+
+
+def get_changed_edges(old_network, old_names, new_network, new_names):
+    """
+    Find the street edges that were added, removed, renamed or moved between two versions of a street network
+    :param old_network: (edge_ids, coords, offsets) from load_street_network
+    :param old_names: dict of street edge id -> street name
+    :param new_network: (edge_ids, coords, offsets) from load_street_network
+    :param new_names: dict of street edge id -> street name
+    :return: (old version of the changed edges, new version of the changed edges), each a dict of
+    street edge id -> (street name or None, coordinates), holding the edges that exist in that version
+    """
+    old_edges = get_edge_id_to_coords(*old_network)
+    new_edges = get_edge_id_to_coords(*new_network)
+
+    old_changed = {}
+    new_changed = {}
+    for edge_id in set(old_edges) | set(new_edges) | set(old_names) | set(new_names):
+        old_coords, new_coords = old_edges.get(edge_id), new_edges.get(edge_id)
+        old_name, new_name = old_names.get(edge_id), new_names.get(edge_id)
+        if old_name == new_name and old_coords is not None and new_coords is not None and \
+                np.array_equal(old_coords, new_coords):
+            continue
+        if old_coords is not None:
+            old_changed[edge_id] = (old_name, old_coords)
+        if new_coords is not None:
+            new_changed[edge_id] = (new_name, new_coords)
+    return old_changed, new_changed
+
+
+def pack_point_keys(keys):
+    """
+    Pack the keys of points, as generate_intersection_points makes them, into one integer per point
+    :param keys: (n, 2) integer array of coordinates multiplied by multiplier
+    """
+    return (keys[:, 0] << 32) | (keys[:, 1] & 0xffffffff)
+
+
+def update_intersection_points(intersection_points_file, network, names, changed_edges):
+    """
+    Recompute the intersection points at the vertices of changed street edges
+    :param network: (edge_ids, coords, offsets) of the new street network
+    :param names: dict of street edge id -> street name of the new street network
+    :param changed_edges: both versions of the changed edges, from get_changed_edges
+    :return: set of names of the streets whose intersection points changed
+    """
+    with open(intersection_points_file, 'rb') as f:
+        intersection_points = pickle.load(f)
+
+    # every vertex the changed edges had or have now
+    affected = set()
+    for edges in changed_edges:
+        for _, coords in edges.values():
+            keys = (coords * multiplier).astype(np.int64)
+            affected.update(zip(keys[:, 0].tolist(), keys[:, 1].tolist()))
+
+    # the streets that meet at each of those points now
+    edge_ids, coords, offsets = network
+    packed_affected = pack_point_keys(np.array(sorted(affected), dtype=np.int64).reshape(-1, 2))
+    vertex_edge = np.repeat(np.arange(len(edge_ids)), np.diff(offsets))
+    points_to_streets = {point: set() for point in affected}
+    vertex_keys = pack_point_keys((coords * multiplier).astype(np.int64))
+    for vertex in np.flatnonzero(np.isin(vertex_keys, packed_affected)).tolist():
+        street_name = names.get(edge_ids[vertex_edge[vertex]].item())
+        if street_name is not None:
+            point = int(coords[vertex, 0] * multiplier), int(coords[vertex, 1] * multiplier)
+            points_to_streets[point].add(street_name)
+
+    changed_streets = set()
+    for point, street_names in points_to_streets.items():
+        old_street_names = intersection_points.pop(point, set())
+        if len(street_names) > 1:
+            intersection_points[point] = street_names
+        else:
+            street_names = set()
+        changed_streets |= old_street_names ^ street_names
+
+    with open(intersection_points_file, 'wb') as f:
+        pickle.dump(intersection_points, f)
+    return changed_streets
+
+
+def update_real_segments(real_segments_file, segment_streets_file, intersection_points_file, network, names,
+                         streets):
+    """
+    Cut some streets into real segments again. The old segments of the streets are replaced by None, and the new
+    ones are appended, so the ids of all other segments stay the same.
+    :param network: (edge_ids, coords, offsets) of the new street network
+    :param names: dict of street edge id -> street name of the new street network
+    :param streets: names of the streets to cut again
+    :return: (ids of the removed segments, new segments)
+    """
+    with open(real_segments_file, 'rb') as f:
+        real_segments = pickle.load(f)
+    with open(segment_streets_file, 'rb') as f:
+        segment_streets = pickle.load(f)
+    with open(intersection_points_file, 'rb') as f:
+        intersection_points = pickle.load(f)
+
+    removed = [i for i, street_name in enumerate(segment_streets) if street_name in streets]
+    for i in removed:
+        real_segments[i] = None
+        segment_streets[i] = None
+
+    edge_id_to_coords_list = get_edge_id_to_coords(*network)
+    edges_by_street = {street_name: [] for street_name in streets}
+    for edge_id, street_name in names.items():
+        if street_name in edges_by_street:
+            edges_by_street[street_name].append(edge_id_to_coords_list[edge_id].tolist())
+    points_by_street = {street_name: set() for street_name in streets}
+    for point, street_names in intersection_points.items():
+        for street_name in street_names & points_by_street.keys():
+            points_by_street[street_name].add(point)
+
+    new_segments = []
+    for street_name in sorted(streets):
+        if edges_by_street[street_name]:
+            pieces = cut_street_at_points(linemerge(edges_by_street[street_name]), points_by_street[street_name])
+            new_segments.extend(pieces)
+            segment_streets.extend([street_name] * len(pieces))
+    real_segments.extend(new_segments)
+
+    with open(real_segments_file, 'wb') as f:
+        pickle.dump(real_segments, f)
+    with open(segment_streets_file, 'wb') as f:
+        pickle.dump(segment_streets, f)
+    return removed, new_segments
+
+
+def patch_segment_index(segment_index_dir, removed, new_segments):
+    """
+    Update a segment index for removed and new real segments. The new segments are appended to the arrays and the
+    removed ones are left out of the grid and the rtree, so the ids of the other segments don't change. The rtree
+    is patched in place unless more than RTREE_PATCH_FRACTION of it changed, in which case it is rebuilt.
+    :param segment_index_dir: directory written by generate_segment_index
+    :param removed: ids of the removed segments
+    :param new_segments: LineStrings of the new segments, which get the ids after the existing ones
+    """
+    vertices = np.load(os.path.join(segment_index_dir, 'vertices.npy'))
+    offsets = np.load(os.path.join(segment_index_dir, 'offsets.npy'))
+    removed = np.asarray(removed, dtype=np.int64)
+    removed_file = os.path.join(segment_index_dir, 'removed-segments.npy')
+    if os.path.exists(removed_file):
+        all_removed = np.union1d(np.load(removed_file), removed)
+    else:
+        all_removed = removed
+
+    if new_segments:
+        new_vertices, new_offsets = get_segment_arrays(new_segments)
+    else:
+        new_vertices, new_offsets = np.empty((0, 2)), np.zeros(1, dtype=np.int64)
+    old_sub_segment_line, old_sub_segment_vertex = get_sub_segment_arrays(offsets)
+    removed_sub_segments = np.flatnonzero(np.isin(old_sub_segment_line, removed))
+    n_new_sub_segments = new_offsets[-1] - len(new_segments)
+
+    rtree_file = os.path.join(segment_index_dir, 'rtree')
+    rebuild_rtree = len(removed_sub_segments) + n_new_sub_segments > RTREE_PATCH_FRACTION * len(old_sub_segment_line)
+    if not rebuild_rtree:
+        # take the removed segments out of the rtree; the new ones are put in once they are in the arrays
+        idx = index.Index(rtree_file)
+        for sub_segment, box, _ in get_rtree_items(vertices, offsets, removed):
+            idx.delete(sub_segment, box)
+
+    # append the new segments to the arrays
+    with open(os.path.join(segment_index_dir, 'metric-crs.txt')) as f:
+        projection = MetricProjection(f.read().strip())
+    cumulative_lengths, cumulative_lengths_metric, _ = load_segment_lengths(segment_index_dir)
+    cumulative_lengths = np.concatenate((cumulative_lengths, get_cumulative_lengths(new_vertices, new_offsets)))
+    cumulative_lengths_metric = np.concatenate((cumulative_lengths_metric, get_cumulative_lengths(
+        projection.project(new_vertices), new_offsets)))
+    first_segment = len(offsets) - 1
+    vertices = np.concatenate((vertices, new_vertices))
+    offsets = np.concatenate((offsets, new_offsets[1:] + offsets[-1])).astype(np.int32)
+    sub_segment_line, sub_segment_vertex = get_sub_segment_arrays(offsets)
+    sub_segment_line = sub_segment_line.astype(np.int32)
+
+    # the grid is cheap to build, so it is rebuilt over the segments that are left
+    live = np.flatnonzero(~np.isin(sub_segment_line, all_removed))
+    grid = SegmentGrid(vertices[sub_segment_vertex[live]], vertices[sub_segment_vertex[live] + 1], ids=live)
+
+    save_array(os.path.join(segment_index_dir, 'vertices.npy'), vertices)
+    save_array(os.path.join(segment_index_dir, 'offsets.npy'), offsets)
+    save_array(os.path.join(segment_index_dir, 'sub-segment-line.npy'), sub_segment_line)
+    save_array(os.path.join(segment_index_dir, 'cumulative-lengths.npy'), cumulative_lengths)
+    save_array(os.path.join(segment_index_dir, 'cumulative-lengths-metric.npy'), cumulative_lengths_metric)
+    save_array(removed_file, all_removed)
+    grid.save(segment_index_dir)
+
+    if rebuild_rtree:
+        # deleting from an rtree one entry at a time is slow, so larger changes rebuild it instead
+        for extension in ('.idx', '.dat'):
+            os.remove(rtree_file + extension)
+        live_segments = np.setdiff1d(np.arange(len(offsets) - 1), all_removed)
+        idx = get_rtree(vertices, offsets, rtree_file, live_segments)
+    else:
+        for item in get_rtree_items(vertices, offsets, np.arange(first_segment, len(offsets) - 1)):
+            idx.insert(*item)
+    idx.close()
+
+
+def update_preprocess(city_settings, workers=1):
+    """
+    Bring the intermediate files of a city up to date with its input files. Inputs that haven't changed since the
+    last preprocessing run are detected from their fingerprints and cost nothing. Otherwise only the streets
+    with added, removed, renamed or moved street edges, or whose intersections changed, are cut into segments
+    again, and the segment index is patched for them. If the intermediate files predate change detection, they
+    are assumed to be up to date.
+    The files are updated in place, and the input fingerprints are written last. IntersectionProximity runs the
+    update on a copy of the intermediate files, which replaces them once it's complete, so that an update that
+    fails partway doesn't leave files behind that look up to date.
+    :param city_settings: a dict of settings, like for run_preprocess
+    :param workers: number of processes to use if everything has to be preprocessed again
+    :return: True if any intermediate files were updated
+    """
+    fingerprints = get_changed_input_fingerprints(city_settings)
+    if fingerprints is None:
+        return False
+
+    # the street network cache still holds the street network of the last run
+    required = [city_settings['street_network_cache_filename'], city_settings['segment_streets_filename'],
+                os.path.join(city_settings['segment_index_dirname'], 'metric-crs.txt')]
+    if not all(os.path.exists(filename) for filename in required):
+        run_preprocess(city_settings, workers=workers)
+        return True
+
+    print('Updating intermediates for changed input files... ', end='', flush=True)
+    with np.load(city_settings['street_network_cache_filename']) as cached:
+        old_network = cached['edge_ids'], cached['coords'], cached['offsets']
+    old_names = read_street_edge_names(city_settings['street_edge_name_filename'])
+
+    generate_street_edge_name_map(city_settings['road_network_dump'], city_settings['osm_way_ids'],
+                                  city_settings['street_edge_name_filename'])
+    new_names = read_street_edge_names(city_settings['street_edge_name_filename'])
+    new_network = load_street_network(city_settings['street_network_filename'],
+                                      city_settings['street_network_cache_filename'])
+
+    changed_edges = get_changed_edges(old_network, old_names, new_network, new_names)
+    streets = update_intersection_points(city_settings['intersection_points_filename'], new_network, new_names,
+                                         changed_edges)
+    for edges in changed_edges:
+        streets.update(street_name for street_name, _ in edges.values() if street_name is not None)
+
+    removed, new_segments = update_real_segments(
+        city_settings['real_segments_output_filename'], city_settings['segment_streets_filename'],
+        city_settings['intersection_points_filename'], new_network, new_names, streets)
+    patch_segment_index(city_settings['segment_index_dirname'], removed, new_segments)
+    with open(city_settings['segment_streets_filename'], 'rb') as f:
+        write_segment_streets(city_settings['segment_index_dirname'], pickle.load(f))
+    generate_intersection_index(city_settings['intersection_points_filename'],
+                                city_settings['intersection_index_dirname'])
+
+    write_input_fingerprints(city_settings, fingerprints)
+    print('Done! ({} street edges changed, {} streets cut again)'.format(
+        len(set(changed_edges[0]) | set(changed_edges[1])), len(streets)))
+    return True
+
+
+def run_preprocess(city_settings, workers=1):
     """
     Preprocessing function. This is run once and overwrites other generated files.
     :param city_settings: a dict of settings. Ex.:
@@ -228,10 +702,19 @@ def run_preprocess(city_settings):
             # outputs
             'intersection_points_filename': 'intersection-points-seattle.pickle',
             'street_edge_name_filename': 'street-edge-name-seattle.csv',
-            'real_segments_output_filename': 'real-segments-seattle.pickle'
+            'real_segments_output_filename': 'real-segments-seattle.pickle',
+            'segment_index_dirname': 'segment-index-seattle',
+            'intersection_index_dirname': 'intersection-index-seattle',
+            'street_network_cache_filename': 'street-network-seattle.npz',
+            'segment_streets_filename': 'segment-streets-seattle.pickle',
+            'input_fingerprints_filename': 'input-fingerprints-seattle.json'
         }
+    :param workers: number of processes to use for the steps that can run in parallel
     :return: None
     """
+    # fingerprint the inputs before reading them, so that changes made while preprocessing are noticed next time
+    fingerprints = get_input_fingerprints(city_settings)
+
     print('Building street name->edge name map... ', end='', flush=True)
     generate_street_edge_name_map(city_settings['road_network_dump'], city_settings['osm_way_ids'],
                                   city_settings['street_edge_name_filename'])
@@ -239,11 +722,22 @@ def run_preprocess(city_settings):
 
     print('Finding street intersections... ', end='', flush=True)
     generate_intersection_points(city_settings['street_network_filename'], city_settings['street_edge_name_filename'],
-                                 city_settings['intersection_points_filename'])
+                                 city_settings['intersection_points_filename'],
+                                 street_network_cache_file=city_settings['street_network_cache_filename'])
     print('Done!')
 
     print('Generating street segments... ', end='', flush=True)
     generate_real_segments(city_settings['street_network_filename'], city_settings['intersection_points_filename'],
-                           city_settings['street_edge_name_filename'], city_settings['real_segments_output_filename'])
+                           city_settings['street_edge_name_filename'], city_settings['real_segments_output_filename'],
+                           workers=workers, street_network_cache_file=city_settings['street_network_cache_filename'],
+                           segment_streets_file=city_settings['segment_streets_filename'])
+    print('Done!')
+
+    print('Building segment index... ', end='', flush=True)
+    generate_segment_index(city_settings['real_segments_output_filename'], city_settings['segment_index_dirname'],
+                           city_settings.get('metric_crs'), city_settings['segment_streets_filename'])
+    generate_intersection_index(city_settings['intersection_points_filename'],
+                                city_settings['intersection_index_dirname'])
     print('Done!')
 
+    write_input_fingerprints(city_settings, fingerprints)
@@ -3,6 +3,16 @@ import os
 # All the default settings for the project are stored here.
 INFTY = 1000000
 MIN_SIZE = .0006
+DEFAULT_CACHE_SIZE = 100000  # maximum number of results an IntersectionProximity caches by default
+BATCH_CHUNK_SIZE = 65536  # number of points compute_proximity_many processes at a time
+DBF_CHUNK_SIZE = 1000000  # number of road network dump records decoded at a time during preprocessing
+ASYNC_BATCH_WINDOW = 0.005  # seconds AsyncIntersectionProximity waits for more labels before scoring a batch
+ASYNC_MAX_BATCH_SIZE = 4096  # number of waiting labels that makes AsyncIntersectionProximity score a batch at once
+SCORE_CHUNK_SIZE = 100000  # number of rows the score command reads, scores and writes at a time
+RTREE_PATCH_FRACTION = 0.02  # largest fraction of sub-segments changed for which the rtree is patched, not rebuilt
+RASTER_TILE_SIZE = 256  # number of cells along each side of a tile of a proximity raster
+CACHE_DIR_VARIABLE = 'INTERSECTION_PROXIMITY_CACHE_DIR'  # environment variable to keep intermediate files under
+ARTIFACT_FORMAT_VERSION = 1  # version of the layout of artifact bundles, checked when one is loaded
 street_network_index = None
 
 default_settings = {
@@ -13,18 +13,31 @@ setuptools.setup(
     long_description_content_type="text/markdown",
     url="https://github.com/ProjectSidewalk/intersection-proximity",
     packages=['intersection_proximity'],
+    # answering queries from preprocessed cities only needs NumPy
     install_requires=[
-        'dbfread>=2.0.7', 
-        'geojson>=2.4.1',
         'numpy>=1.16.4',
-        'pandas>=0.24.2',
-        'pyproj>=1.9.6',
-        'python-dateutil>=2.8.0',
-        'pytz>=2019.1',
-        'Rtree>=0.8.3',
-        'Shapely>=1.6.4.post2',
-        'six>=1.12.0',
     ],
+    extras_require={
+        'preprocessing': [
+            'dbfread>=2.0.7',
+            'geojson>=2.4.1',
+            'pandas>=0.24.2',
+            'pyproj>=2.2.0',
+            'python-dateutil>=2.8.0',
+            'pytz>=2019.1',
+            'Rtree>=0.8.3',
+            'Shapely>=1.6.4.post2',
+            'six>=1.12.0',
+        ],
+        'rtree': ['Rtree>=0.8.3'],
+        'cli': ['pandas>=0.24.2'],
+        'parquet': ['pandas>=0.24.2', 'pyarrow>=1.0.0'],
+        # running the tests and linting
+        'dev': ['pytest', 'pyflakes'],
+    },
+    entry_points={
+        'console_scripts': ['intersection-proximity=intersection_proximity._cli:main'],
+    },
     classifiers=[
         "Programming Language :: Python :: 3",
         "License :: OSI Approved :: MIT License",
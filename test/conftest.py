@@ -0,0 +1,34 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# Tests run against the working tree, on the synthetic cities of the benchmarks, so they need no downloaded data
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [REPO_DIR, os.path.join(REPO_DIR, 'benchmark')]
+CITY_SIZE = 10  # streets each way of the city fixture
+
+
+@pytest.fixture(scope='session')
+def city(tmp_path_factory):
+    """
+    A small irregular synthetic city, preprocessed into its own cache dir
+    :return: (city config, cache dir, (min_lng, min_lat, max_lng, max_lat) of the city)
+    """
+    from synthetic_city import make_city, get_bounds
+    from intersection_proximity import IntersectionProximity
+    directory = tmp_path_factory.mktemp('city')
+    city_config = make_city(str(directory / 'input'), CITY_SIZE, 'irregular')
+    IntersectionProximity(city_config, cache_dir=str(directory / 'cache'))
+    return city_config, str(directory / 'cache'), get_bounds(CITY_SIZE)
+
+
+@pytest.fixture
+def labels(city):
+    """
+    2000 random labels over the city and a little past its edges
+    :return: (lats, lngs)
+    """
+    min_lng, min_lat, max_lng, max_lat = city[2]
+    rng = np.random.RandomState(0)
+    return rng.uniform(min_lat - 0.002, max_lat + 0.002, 2000), rng.uniform(min_lng - 0.002, max_lng + 0.002, 2000)
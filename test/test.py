@@ -1,5 +1,6 @@
 import pandas as pd
 import math
+import numpy as np
 import intersection_proximity
 # Set predictor to be whatever predictor function we're using.
 # By default it is the one imported from this project
@@ -54,3 +55,10 @@ print('ABSOLUTE DISTANCE: ')
 print(f'\t {absolute_correct} / {total_entries} = {100*absolute_correct/total_entries:.2f}%')
 print('MIDDLENESS: ')
 print(f'\t {middleness_correct} / {total_entries} = {100*middleness_correct/total_entries:.2f}%')
+
+# The batch path should give the same results as calling the predictor one row at a time
+batch_dist, batch_middleness = ip.compute_proximity_many(ground_truth)
+scalar = ground_truth.apply(lambda row: pd.Series(predictor(row.lat, row.lng), index=['dist', 'middleness']), axis=1)
+batch_matches = np.isclose(batch_dist, scalar.dist) & np.isclose(batch_middleness, scalar.middleness)
+print('BATCH MATCHES SCALAR: ')
+print(f'\t {sum(batch_matches)} / {total_entries}')
@@ -0,0 +1,61 @@
+import os
+import tarfile
+import numpy as np
+import pytest
+from intersection_proximity import IntersectionProximity
+
+
+@pytest.fixture
+def artifact(city, tmp_path):
+    """
+    :return: artifact bundle of the city, with an 8 m raster
+    """
+    city_config, cache_dir, _ = city
+    artifact_file = str(tmp_path / 'city.tar')
+    IntersectionProximity(city_config, cache_dir=cache_dir, raster_cell_size=8).export_artifact(artifact_file)
+    return artifact_file
+
+
+def test_round_trip(city, labels, artifact, tmp_path):
+    city_config, cache_dir, _ = city
+    ip = IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir)
+    loaded = IntersectionProximity.from_artifact(artifact, cache_results=False, cache_dir=str(tmp_path / 'worker'))
+    lats, lngs = labels
+    for result, loaded_result in zip(ip.compute_proximity_many(lats, lngs, return_segment_ids=True),
+                                     loaded.compute_proximity_many(lats, lngs, return_segment_ids=True)):
+        np.testing.assert_array_equal(result, loaded_result)
+    for result, loaded_result in zip(ip.nearest_intersections_many(lats, lngs, 3),
+                                     loaded.nearest_intersections_many(lats, lngs, 3)):
+        np.testing.assert_array_equal(result, loaded_result)
+
+    # the raster comes with the bundle, and the bundle is only unpacked once
+    with tarfile.open(artifact) as tar:
+        assert 'rasters/8m/distance.npy' in tar.getnames()
+    with_raster = IntersectionProximity.from_artifact(artifact, cache_dir=str(tmp_path / 'worker'), raster_cell_size=8)
+    assert with_raster.settings['raster_dirname'] == loaded.settings['raster_dirname']
+    assert with_raster.raster is not None
+    assert len(os.listdir(str(tmp_path / 'worker' / 'artifacts'))) == 2  # the bundle and its lock file
+
+
+def test_corrupt_bundle(artifact, tmp_path):
+    with tarfile.open(artifact) as tar:
+        offset = tar.getmember('segment-index/vertices.npy').offset_data
+    with open(artifact, 'r+b') as f:
+        f.seek(offset + 200)
+        byte = f.read(1)
+        f.seek(offset + 200)
+        f.write(bytes([byte[0] ^ 1]))
+
+    with pytest.raises(Exception, match="corrupt"):
+        IntersectionProximity.from_artifact(artifact, cache_dir=str(tmp_path / 'worker'))
+    # nothing half-unpacked is left behind
+    artifacts_path = str(tmp_path / 'worker' / 'artifacts')
+    assert [filename for filename in os.listdir(artifacts_path) if not filename.endswith('.lock')] == []
+
+
+def test_not_a_bundle(tmp_path):
+    artifact_file = str(tmp_path / 'empty.tar')
+    with tarfile.open(artifact_file, 'w'):
+        pass
+    with pytest.raises(Exception, match="not an artifact bundle"):
+        IntersectionProximity.from_artifact(artifact_file, cache_dir=str(tmp_path / 'worker'))
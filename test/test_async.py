@@ -0,0 +1,70 @@
+import asyncio
+import numpy as np
+from intersection_proximity import IntersectionProximity, AsyncIntersectionProximity
+
+
+class RecordingProximity:
+    """
+    Scores labels with an IntersectionProximity, and records the size of every batch it is given
+    """
+    def __init__(self, intersection_proximity):
+        self.intersection_proximity = intersection_proximity
+        self.batch_sizes = []
+
+    def compute_proximity_many(self, lats, lngs):
+        self.batch_sizes.append(len(lats))
+        return self.intersection_proximity.compute_proximity_many(lats, lngs)
+
+
+async def score_concurrently(async_ip, lats, lngs):
+    return await asyncio.gather(*(async_ip.compute_proximity(lat, lng) for lat, lng in zip(lats, lngs)))
+
+
+def test_labels_are_batched(city, labels):
+    city_config, cache_dir, _ = city
+    ip = IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir)
+    recording = RecordingProximity(ip)
+    lats, lngs = labels[0][:100], labels[1][:100]
+
+    results = asyncio.run(score_concurrently(AsyncIntersectionProximity(recording, batch_window=0.05), lats, lngs))
+    assert recording.batch_sizes == [100]
+    distances, middleness = ip.compute_proximity_many(lats, lngs)
+    np.testing.assert_allclose(results, np.column_stack((distances, middleness)))
+
+
+def test_full_batches_are_scored_at_once(city, labels):
+    city_config, cache_dir, _ = city
+    recording = RecordingProximity(IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir))
+    async_ip = AsyncIntersectionProximity(recording, batch_window=10, max_batch_size=10)
+
+    async def score():
+        # the last 5 labels would wait for the window to end, but flush scores them now
+        tasks = [asyncio.ensure_future(async_ip.compute_proximity(lat, lng))
+                 for lat, lng in zip(labels[0][:25], labels[1][:25])]
+        await asyncio.sleep(0)
+        await async_ip.flush()
+        return await asyncio.wait_for(asyncio.gather(*tasks), 5)
+    assert len(asyncio.run(score())) == 25
+    assert recording.batch_sizes == [10, 10, 5]
+
+
+def test_results_are_cached(city, labels):
+    city_config, cache_dir, _ = city
+    ip = IntersectionProximity(city_config, cache_dir=cache_dir)
+    lats, lngs = labels[0][:20], labels[1][:20]
+    results = asyncio.run(score_concurrently(AsyncIntersectionProximity(ip), lats, lngs))
+    assert ip.proximity_cache.stats()['size'] == 20
+    assert [ip.proximity_cache.get(lat, lng) for lat, lng in zip(lats, lngs)] == results
+
+
+def test_errors_reach_every_caller():
+    class Failing:
+        def compute_proximity_many(self, lats, lngs):
+            raise Exception("Scoring failed")
+
+    async def score():
+        async_ip = AsyncIntersectionProximity(Failing())
+        return await asyncio.gather(*(async_ip.compute_proximity(47.65, -122.35 + i * 1e-4) for i in range(3)),
+                                    return_exceptions=True)
+    errors = asyncio.run(score())
+    assert len(errors) == 3 and all(str(e) == "Scoring failed" for e in errors)
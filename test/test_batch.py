@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from intersection_proximity import IntersectionProximity
+
+# compute_proximity_many gives the results compute_proximity would, up to rounding: they measure along segments
+# with the same formulas, but on arrays.
+
+NOT_LOCATIONS = [(np.nan, -122.35), (47.65, np.nan), (np.nan, np.nan), (np.inf, -122.35), (95.0, -122.35),
+                 (47.65, 200.0)]
+FAR_AWAY = [(47.0, -122.35), (-47.65, 57.65)]
+
+
+@pytest.mark.parametrize('options', [{'index_backend': 'rtree'}, {'index_backend': 'grid'}, {'max_distance': 50},
+                                     {'raster_cell_size': 8}])
+def test_batch_matches_scalar(city, labels, options):
+    city_config, cache_dir, _ = city
+    ip = IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir, **options)
+    lats, lngs = labels
+    lats = np.concatenate((lats, [lat for lat, _ in NOT_LOCATIONS + FAR_AWAY]))
+    lngs = np.concatenate((lngs, [lng for _, lng in NOT_LOCATIONS + FAR_AWAY]))
+
+    distances, middleness = ip.compute_proximity_many(lats, lngs)
+    results = [ip.compute_proximity(lat, lng) for lat, lng in zip(lats, lngs)]
+    no_result = np.array([result is None for result in results])
+    np.testing.assert_array_equal(np.isnan(distances), no_result)
+    np.testing.assert_array_equal(np.isnan(middleness), no_result)
+    assert no_result[len(labels[0]):][:len(NOT_LOCATIONS)].all()
+    if 'max_distance' in options:
+        assert no_result[-len(FAR_AWAY):].all() and no_result.sum() < len(lats) // 2
+    else:
+        assert no_result.sum() == len(NOT_LOCATIONS)
+
+    expected = np.array([result for result in results if result is not None])
+    np.testing.assert_allclose(distances[~no_result], expected[:, 0], rtol=1e-9, atol=1e-9)
+    np.testing.assert_allclose(middleness[~no_result], expected[:, 1], rtol=1e-9, atol=1e-9)
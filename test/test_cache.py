@@ -0,0 +1,43 @@
+from intersection_proximity import IntersectionProximity
+from intersection_proximity._cache import ProximityCache
+
+
+def test_least_recently_used_is_evicted():
+    cache = ProximityCache(2)
+    cache.put(47.1, -122.1, (1.0, 10.0))
+    cache.put(47.2, -122.2, (2.0, 20.0))
+    assert cache.get(47.1, -122.1) == (1.0, 10.0)
+    # 47.2 is now the least recently used
+    cache.put(47.3, -122.3, (3.0, 30.0))
+    assert cache.get(47.2, -122.2) is None
+    assert cache.get(47.1, -122.1) == (1.0, 10.0)
+    assert cache.get(47.3, -122.3) == (3.0, 30.0)
+    assert cache.stats() == {'size': 2, 'max_size': 2, 'hits': 3, 'misses': 1, 'evictions': 1}
+
+
+def test_quantized_keys():
+    cache = ProximityCache(10, quantization=1e-6)
+    cache.put(47.6500001, -122.3500001, (1.0, 10.0))
+    assert cache.get(47.65000014, -122.35000006) == (1.0, 10.0)
+    assert cache.get(47.650002, -122.3500001) is None
+
+    exact = ProximityCache(10)
+    exact.put(47.6500001, -122.3500001, (1.0, 10.0))
+    assert exact.get(47.65000014, -122.35000006) is None
+
+
+def test_compute_proximity_cache(city, labels):
+    city_config, cache_dir, _ = city
+    uncached = IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir)
+    ip = IntersectionProximity(city_config, cache_size=5, cache_dir=cache_dir)
+    lats, lngs = labels
+    for lat, lng in zip(lats[:10], lngs[:10]):
+        assert ip.compute_proximity(lat, lng) == uncached.compute_proximity(lat, lng)
+    # cached results are the same as computed ones
+    for lat, lng in zip(lats[5:10], lngs[5:10]):
+        assert ip.compute_proximity(lat, lng) == uncached.compute_proximity(lat, lng)
+
+    stats = ip.proximity_cache.stats()
+    assert stats['size'] == 5
+    assert stats['evictions'] == 5
+    assert stats['hits'] == 5
@@ -0,0 +1,60 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+from intersection_proximity import IntersectionProximity
+from intersection_proximity._cli import main
+from intersection_proximity.settings import CACHE_DIR_VARIABLE
+
+
+@pytest.fixture
+def cli_city(city, labels, tmp_path, monkeypatch):
+    """
+    The city fixture as a config file, and a CSV of labels in it
+    :return: (city config file, labels file)
+    """
+    city_config, cache_dir, _ = city
+    monkeypatch.setenv(CACHE_DIR_VARIABLE, cache_dir)
+    config_file = str(tmp_path / 'city.json')
+    with open(config_file, 'w') as f:
+        json.dump(city_config, f)
+
+    lats, lngs = labels
+    labels_file = str(tmp_path / 'labels.csv')
+    pd.DataFrame({'label_id': np.arange(len(lats) + 1), 'lat': np.append(lats, np.nan),
+                  'lng': np.append(lngs, -122.35)}).to_csv(labels_file, index=False)
+    return config_file, labels_file
+
+
+def test_score(city, cli_city, tmp_path):
+    config_file, labels_file = cli_city
+    for workers in (1, 2):
+        main(['score', labels_file, str(tmp_path / 'scored-{}.csv'.format(workers)), '--config', config_file,
+              '--workers', str(workers), '--chunk-size', '300'])
+    with open(str(tmp_path / 'scored-1.csv')) as serial, open(str(tmp_path / 'scored-2.csv')) as parallel:
+        assert serial.read() == parallel.read()
+
+    scored = pd.read_csv(str(tmp_path / 'scored-1.csv'))
+    labels = pd.read_csv(labels_file)
+    pd.testing.assert_frame_equal(scored[labels.columns], labels)
+    city_config, cache_dir, _ = city
+    ip = IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir)
+    distances, middleness, segment_ids = ip.compute_proximity_many(labels, return_segment_ids=True)
+    np.testing.assert_allclose(scored['distance'], distances, rtol=1e-12)
+    np.testing.assert_allclose(scored['middleness'], middleness, rtol=1e-12)
+    np.testing.assert_array_equal(scored['segment_id'], segment_ids)
+    assert np.isnan(scored['distance'].values[-1]) and scored['segment_id'].values[-1] == -1
+
+
+def test_score_artifact(cli_city, tmp_path, monkeypatch):
+    config_file, labels_file = cli_city
+    artifact_file = str(tmp_path / 'city.tar')
+    main(['build-artifact', artifact_file, '--config', config_file])
+    main(['score', labels_file, str(tmp_path / 'scored.csv'), '--config', config_file])
+
+    # a worker only has the bundle
+    monkeypatch.setenv(CACHE_DIR_VARIABLE, str(tmp_path / 'worker'))
+    main(['score', labels_file, str(tmp_path / 'scored-artifact.csv'), '--artifact', artifact_file,
+          '--workers', '2', '--chunk-size', '300'])
+    with open(str(tmp_path / 'scored.csv')) as scored, open(str(tmp_path / 'scored-artifact.csv')) as from_artifact:
+        assert scored.read() == from_artifact.read()
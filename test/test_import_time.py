@@ -0,0 +1,69 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+# Processes that only answer queries must not import the dependencies of preprocessing, which took about half a
+# second to import. Imports are measured in fresh interpreters, so modules imported by pytest don't count.
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PREPROCESSING_MODULES = ('pandas', 'dbfread', 'geojson', 'pyproj', 'shapely')
+# the rtree index backend is imported when a city is loaded, not with the package
+HEAVY_MODULES = PREPROCESSING_MODULES + ('rtree',)
+# seconds importing the package may take on top of importing NumPy. It takes about 0.02s; the budget is loose so
+# that slow or busy machines pass, and only catches heavy imports coming back.
+IMPORT_TIME_BUDGET = 2
+
+
+def run_python(code):
+    """
+    Run code in a fresh interpreter with the working tree on its path
+    :return: what the code printed, parsed as JSON
+    """
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([REPO_DIR, os.path.join(REPO_DIR, 'benchmark')]))
+    return json.loads(subprocess.check_output([sys.executable, '-c', code], env=env).decode().splitlines()[-1])
+
+
+def test_import_time():
+    result = run_python(
+        "import json, sys, time\n"
+        "import numpy\n"
+        "start = time.perf_counter()\n"
+        "import intersection_proximity\n"
+        "print(json.dumps({'seconds': time.perf_counter() - start, 'modules': sorted(sys.modules)}))\n")
+    print('import intersection_proximity took {:.3f}s'.format(result['seconds']))
+    assert not set(HEAVY_MODULES) & {module.split('.')[0] for module in result['modules']}
+    assert result['seconds'] < IMPORT_TIME_BUDGET
+
+
+def test_cli_imports():
+    # `score --artifact` runs on workers with only the cli extra installed
+    result = run_python(
+        "import json, sys\n"
+        "import intersection_proximity._cli\n"
+        "print(json.dumps(sorted(sys.modules)))\n")
+    assert not set(HEAVY_MODULES) & {module.split('.')[0] for module in result}
+
+
+def test_query_path_imports():
+    with tempfile.TemporaryDirectory() as directory:
+        # preprocess a small synthetic city and bundle it, like a build job would
+        run_python(
+            "import json\n"
+            "from intersection_proximity import IntersectionProximity\n"
+            "from synthetic_city import make_city\n"
+            "city_config = make_city({0!r}, 5)\n"
+            "IntersectionProximity(city_config, cache_dir={0!r}).export_artifact({1!r})\n"
+            "print('{{}}')\n".format(directory, os.path.join(directory, 'city.tar')))
+
+        result = run_python(
+            "import json, sys\n"
+            "from intersection_proximity import IntersectionProximity\n"
+            "ip = IntersectionProximity.from_artifact({0!r}, cache_dir={1!r})\n"
+            "ip.compute_proximity(47.651, -122.349)\n"
+            "ip.compute_proximity_many([47.651, 47.652], [-122.349, -122.348])\n"
+            "ip.nearest_intersections(47.651, -122.349)\n"
+            "print(json.dumps(sorted(sys.modules)))\n".format(os.path.join(directory, 'city.tar'),
+                                                               os.path.join(directory, 'worker')))
+    assert not set(PREPROCESSING_MODULES) & {module.split('.')[0] for module in result}
@@ -0,0 +1,38 @@
+import numpy as np
+from intersection_proximity import IntersectionProximity
+from intersection_proximity._projection import get_search_size
+
+# The index backends answer the same queries with the same results, so IntersectionProximity can search with either
+
+
+def get_backends(city):
+    city_config, cache_dir, _ = city
+    return [IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir, index_backend=backend).index
+            for backend in ('rtree', 'grid')]
+
+
+def test_nearest(city, labels):
+    rtree_index, grid_index = get_backends(city)
+    lats, lngs = labels
+    points = np.column_stack((np.append(lngs, [-122.35, -60.0]), np.append(lats, [47.0, -30.0])))
+    for max_search_size in (None, get_search_size(50, lats)):
+        if max_search_size is not None:
+            max_search_size = np.append(max_search_size, [1.0, 1.0])
+        rtree_sub_segments, rtree_closest = rtree_index.nearest(points, max_search_size)
+        grid_sub_segments, grid_closest = grid_index.nearest(points, max_search_size)
+        np.testing.assert_array_equal(rtree_sub_segments, grid_sub_segments)
+        np.testing.assert_array_equal(rtree_closest, grid_closest)
+    # labels past max_search_size have no sub-segment
+    assert (rtree_sub_segments == -1).any()
+
+
+def test_intersection(city, labels):
+    rtree_index, grid_index = get_backends(city)
+    lats, lngs = labels
+    size = np.linspace(0, 0.003, len(lats))
+    boxes = np.column_stack((lngs - size, lats - size, lngs + size, lats + size))
+    rtree_box_index, rtree_sub_segments = rtree_index.intersection(boxes)
+    grid_box_index, grid_sub_segments = grid_index.intersection(boxes)
+    assert len(rtree_sub_segments) > len(boxes)
+    np.testing.assert_array_equal(rtree_box_index, grid_box_index)
+    np.testing.assert_array_equal(rtree_sub_segments, grid_sub_segments)
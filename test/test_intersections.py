@@ -0,0 +1,103 @@
+import csv
+import json
+import pickle
+import numpy as np
+import pytest
+from intersection_proximity import IntersectionProximity
+from intersection_proximity._projection import get_approximate_distance
+from intersection_proximity.preprocessing import multiplier
+
+
+@pytest.fixture
+def ip(city):
+    city_config, cache_dir, _ = city
+    return IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir)
+
+
+def get_intersection_points_one_by_one(city_config, street_edge_name_file):
+    """
+    Find the intersection points like earlier versions did, one vertex at a time
+    :return: dict of (lng, lat) point, multiplied by multiplier and truncated -> set of the names of its streets
+    """
+    with open(street_edge_name_file) as f:
+        edge_names = {int(row['street_edge_id']): row['street_name'] for row in csv.DictReader(f)}
+    with open(city_config['street_network_filename']) as f:
+        streets = json.load(f)['features']
+
+    points_to_streets = dict()
+    for street in streets:
+        edge_id = street['properties']['street_edge_id']
+        if edge_id not in edge_names:
+            continue
+        for lng, lat in street['geometry']['coordinates']:
+            points_to_streets.setdefault((int(lng * multiplier), int(lat * multiplier)), set()).add(edge_names[edge_id])
+    return {point: street_names for point, street_names in points_to_streets.items() if len(street_names) > 1}
+
+
+def get_all_distances(ip, lats, lngs):
+    """
+    :return: (number of labels, number of intersections) array of the distance from every label to every
+    intersection, measured one by one
+    """
+    points = np.asarray(ip.intersection_index.points)
+    return np.array([get_approximate_distance(np.tile((lng, lat), (len(points), 1)), points)
+                     for lat, lng in zip(lats, lngs)])
+
+
+def test_index_holds_every_intersection(ip):
+    with open(ip.settings['intersection_points_filename'], 'rb') as f:
+        intersection_points = pickle.load(f)
+    assert len(ip.intersection_index) == len(intersection_points)
+    for intersection_id in range(len(ip.intersection_index)):
+        intersection = ip.get_intersection(intersection_id)
+        key = round(intersection['lng'] * multiplier), round(intersection['lat'] * multiplier)
+        assert intersection['street_names'] == sorted(intersection_points[key])
+
+
+def test_intersection_points(city, ip):
+    city_config, _, _ = city
+    with open(ip.settings['intersection_points_filename'], 'rb') as f:
+        intersection_points = pickle.load(f)
+    assert intersection_points == get_intersection_points_one_by_one(city_config,
+                                                                     ip.settings['street_edge_name_filename'])
+    assert len(intersection_points) == 96
+
+
+@pytest.mark.parametrize('k', [1, 4])
+def test_nearest_intersections(ip, labels, k):
+    lats, lngs = labels
+    # and some labels far outside the city
+    lats, lngs = np.append(lats, [47.0, 48.5]), np.append(lngs, [-122.35, -121.0])
+    ids, distances = ip.nearest_intersections_many(lats, lngs, k)
+
+    all_distances = get_all_distances(ip, lats, lngs)
+    np.testing.assert_allclose(distances, np.sort(all_distances, axis=1)[:, :k])
+    np.testing.assert_allclose(np.take_along_axis(all_distances, ids, axis=1), distances)
+
+    single = ip.nearest_intersections(lats[0], lngs[0], k)
+    assert [intersection['intersection_id'] for intersection in single] == ids[0].tolist()
+
+
+def test_nearest_intersections_past_the_number_of_intersections(ip):
+    ids, distances = ip.nearest_intersections_many([47.651], [-122.349], len(ip.intersection_index) + 2)
+    assert sorted(ids[0, :-2].tolist()) == list(range(len(ip.intersection_index)))
+    assert (ids[0, -2:] == -1).all() and np.isnan(distances[0, -2:]).all()
+
+
+def test_intersections_within(ip, labels):
+    lats, lngs = labels
+    radius = 150
+    label_index, ids, distances = ip.intersections_within_many(lats, lngs, radius)
+
+    all_distances = get_all_distances(ip, lats, lngs)
+    expected_label_index, expected_ids = np.nonzero(all_distances <= radius)
+    assert len(expected_ids) > len(lats)
+    assert sorted(zip(label_index.tolist(), ids.tolist())) == sorted(zip(expected_label_index.tolist(),
+                                                                         expected_ids.tolist()))
+    np.testing.assert_allclose(distances, all_distances[label_index, ids])
+    # grouped by label, closest first
+    assert (np.diff(label_index) >= 0).all()
+    assert (np.diff(distances)[np.diff(label_index) == 0] >= 0).all()
+
+    single = ip.intersections_within(lats[0], lngs[0], radius)
+    assert [intersection['intersection_id'] for intersection in single] == ids[label_index == 0].tolist()
@@ -0,0 +1,85 @@
+import re
+import numpy as np
+from intersection_proximity import IntersectionProximity, ProximityMetrics
+
+
+def test_counts(city, labels):
+    city_config, cache_dir, _ = city
+    metrics = ProximityMetrics()
+    observations = []
+    metrics.add_callback(lambda name, value: observations.append(name))
+    ip = IntersectionProximity(city_config, cache_dir=cache_dir, metrics=metrics)
+    lats, lngs = labels
+    for lat, lng in zip(lats[:10], lngs[:10]):
+        ip.compute_proximity(lat, lng)
+    # cached results cost nothing
+    for lat, lng in zip(lats[:4], lngs[:4]):
+        ip.compute_proximity(lat, lng)
+    ip.compute_proximity_many(lats, lngs)
+
+    result = metrics.as_dict()
+    assert {stage: histogram['count'] for stage, histogram in result['stage_seconds'].items()} == {
+        'search': 10, 'measure': 10, 'query': 10, 'batch_search': 1, 'batch_measure': 1, 'batch': 1}
+    assert result['candidates']['count'] == 10 + len(lats)
+    assert sum(result['candidates']['buckets'].values()) == 10 + len(lats)
+    # every label has a candidate
+    assert result['candidates']['buckets']['0'] == 0
+    assert result['values']['index_load_seconds'] > 0
+    assert result['cache'] == {'size': 10, 'hits': 4, 'misses': 10, 'evictions': 0, 'hit_rate': 4 / 14}
+    assert observations.count('candidates') == 11 and observations.count('query') == 10
+
+
+def test_raster_queries(city, labels):
+    city_config, cache_dir, _ = city
+    ip = IntersectionProximity(city_config, cache_dir=cache_dir, metrics=True, raster_cell_size=8)
+    lats, lngs = labels[0][:200], labels[1][:200]
+    _, _, _, exact = ip.raster.lookup(np.column_stack((lngs, lats)))
+    assert 0 < exact.sum() < len(lats)
+    for lat, lng in zip(lats, lngs):
+        ip.compute_proximity(lat, lng)
+
+    result = ip.metrics.as_dict()
+    # every label is looked up in the raster, and only the ones it can't answer are searched for
+    assert result['stage_seconds']['raster']['count'] == len(lats)
+    assert result['stage_seconds']['query']['count'] == exact.sum()
+    # the results from the raster are cached too
+    assert result['cache']['size'] == len(lats)
+    assert [ip.compute_proximity(lat, lng) for lat, lng in zip(lats, lngs)] == \
+        [ip.proximity_cache.get(lat, lng) for lat, lng in zip(lats, lngs)]
+    assert ip.metrics.as_dict()['stage_seconds']['raster']['count'] == len(lats)
+
+
+def test_prometheus(city, labels):
+    city_config, cache_dir, _ = city
+    ip = IntersectionProximity(city_config, cache_dir=cache_dir, metrics=True)
+    lats, lngs = labels
+    for lat, lng in zip(lats[:10], lngs[:10]):
+        ip.compute_proximity(lat, lng)
+    ip.compute_proximity(lats[0], lngs[0])
+    ip.compute_proximity_many(lats, lngs)
+
+    text = ip.metrics.to_prometheus()
+    samples = {}
+    for line in text.splitlines():
+        if line.startswith('#'):
+            assert re.fullmatch(r'# (HELP intersection_proximity_\w+ .+|TYPE intersection_proximity_\w+ '
+                                r'(histogram|gauge|counter))', line)
+        else:
+            name, value = line.rsplit(' ', 1)
+            samples[name] = float(value)
+
+    result = ip.metrics.as_dict()
+    for stage, histogram in result['stage_seconds'].items():
+        buckets = [samples['intersection_proximity_stage_seconds_bucket{{stage="{}",le="{}"}}'.format(
+            stage, bound if bound == '+Inf' else repr(float(bound)))] for bound in histogram['buckets']]
+        # buckets are cumulative
+        assert buckets == sorted(buckets) and buckets[-1] == histogram['count']
+        assert samples['intersection_proximity_stage_seconds_count{{stage="{}"}}'.format(stage)] == histogram['count']
+        assert samples['intersection_proximity_stage_seconds_sum{{stage="{}"}}'.format(stage)] == histogram['sum']
+    assert samples['intersection_proximity_candidates_bucket{le="+Inf"}'] == 10 + len(lats)
+    assert samples['intersection_proximity_candidates_count'] == 10 + len(lats)
+    assert samples['intersection_proximity_index_load_seconds'] == result['values']['index_load_seconds']
+    assert samples['intersection_proximity_cache_hits_total'] == 1
+    assert samples['intersection_proximity_cache_misses_total'] == 10
+    assert samples['intersection_proximity_cache_evictions_total'] == 0
+    assert samples['intersection_proximity_cache_size'] == 10
@@ -0,0 +1,40 @@
+import os
+import numpy as np
+from intersection_proximity import IntersectionProximity
+from intersection_proximity import preprocessing
+from intersection_proximity._intersection_proximity import get_intermediates_path, get_intermediate_files
+
+# Intermediates written by earlier versions only hold the street edge names, the intersection points and the real
+# segments; everything newer is built from them when the city is loaded.
+
+
+def write_legacy_intermediates(city_config, cache_dir):
+    intermediates_path = get_intermediates_path(city_config, cache_dir)
+    os.makedirs(intermediates_path)
+    settings = {**city_config, **get_intermediate_files(city_config, intermediates_path=intermediates_path)}
+    preprocessing.generate_street_edge_name_map(settings['road_network_dump'], settings['osm_way_ids'],
+                                                settings['street_edge_name_filename'])
+    preprocessing.generate_intersection_points(settings['street_network_filename'],
+                                               settings['street_edge_name_filename'],
+                                               settings['intersection_points_filename'])
+    preprocessing.generate_real_segments(settings['street_network_filename'], settings['intersection_points_filename'],
+                                         settings['street_edge_name_filename'],
+                                         settings['real_segments_output_filename'])
+    assert sorted(os.listdir(intermediates_path)) == ['intersection-points.pickle', 'real-segments.pickle',
+                                                      'street-edge-name.csv']
+
+
+def test_legacy_intermediates(city, labels, tmp_path):
+    city_config, cache_dir, _ = city
+    write_legacy_intermediates(city_config, str(tmp_path / 'cache'))
+    migrated = IntersectionProximity(city_config, cache_results=False, cache_dir=str(tmp_path / 'cache'))
+    ip = IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir)
+
+    lats, lngs = labels
+    for migrated_result, result in zip(migrated.compute_proximity_many(lats, lngs, return_segment_ids=True),
+                                       ip.compute_proximity_many(lats, lngs, return_segment_ids=True)):
+        np.testing.assert_array_equal(migrated_result, result)
+    assert migrated.compute_proximity(lats[0], lngs[0]) == ip.compute_proximity(lats[0], lngs[0])
+    assert len(migrated.intersection_index) == len(ip.intersection_index)
+    # the streets of the segments weren't kept
+    assert migrated.get_segment_street(0) is None and ip.get_segment_street(0) is not None
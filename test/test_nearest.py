@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+from intersection_proximity import IntersectionProximity
+from intersection_proximity._batch import get_distance_many
+from intersection_proximity._projection import get_approximate_distance
+
+# The search for the closest sub-segment is exact: it finds the sub-segment a brute-force search over every
+# sub-segment finds, however far the label is from the city.
+
+MAX_DISTANCE = 50
+
+
+def get_brute_force_nearest(ip, points):
+    """
+    :return: (distance in degrees to the closest sub-segment, closest point on it) of every point, measuring the
+    distance to every sub-segment
+    """
+    first_vertex = np.arange(len(ip.sub_segment_line)) + ip.sub_segment_line
+    starts, ends = ip.segment_vertices[first_vertex], ip.segment_vertices[first_vertex + 1]
+    distances = np.empty(len(points))
+    closest_points = np.empty((len(points), 2))
+    for i, point in enumerate(points):
+        closest, d = get_distance_many(np.broadcast_to(point, starts.shape), starts, ends)
+        distances[i], closest_points[i] = d.min(), closest[np.argmin(d)]
+    return distances, closest_points
+
+
+def get_points(labels):
+    lats, lngs = labels
+    # and some labels far outside the city
+    return np.column_stack((np.append(lngs, [-122.35, -121.0, -60.0]), np.append(lats, [47.0, 48.5, -30.0])))
+
+
+@pytest.mark.parametrize('index_backend', ['rtree', 'grid'])
+def test_nearest_matches_brute_force(city, labels, index_backend):
+    city_config, cache_dir, _ = city
+    ip = IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir, index_backend=index_backend)
+    points = get_points(labels)
+    sub_segments, closest_points = ip.index.nearest(points)
+    distances, _ = get_brute_force_nearest(ip, points)
+    assert (sub_segments >= 0).all()
+    np.testing.assert_allclose(np.hypot(*(points - closest_points).T), distances, rtol=0, atol=1e-12)
+
+
+def test_max_distance(city, labels):
+    city_config, cache_dir, _ = city
+    ip = IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir, max_distance=MAX_DISTANCE)
+    unlimited = IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir)
+    points = get_points(labels)
+    _, closest_points = get_brute_force_nearest(ip, points)
+    too_far = get_approximate_distance(points, closest_points) > MAX_DISTANCE
+    assert 0 < too_far.sum() < len(points) // 2
+
+    distances, middleness = ip.compute_proximity_many(points[:, 1], points[:, 0])
+    np.testing.assert_array_equal(np.isnan(distances), too_far)
+    np.testing.assert_array_equal(np.isnan(middleness), too_far)
+    results = [ip.compute_proximity(lat, lng) for lng, lat in points]
+    assert [result is None for result in results] == too_far.tolist()
+
+    # labels close enough get the same results as without a maximum distance
+    unlimited_distances, unlimited_middleness = unlimited.compute_proximity_many(points[:, 1], points[:, 0])
+    np.testing.assert_array_equal(distances[~too_far], unlimited_distances[~too_far])
+    np.testing.assert_array_equal(middleness[~too_far], unlimited_middleness[~too_far])
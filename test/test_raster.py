@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+from intersection_proximity import IntersectionProximity
+
+
+@pytest.mark.parametrize('cell_size', [4, 8])
+def test_raster_error_bound(city, cell_size):
+    city_config, cache_dir, (min_lng, min_lat, max_lng, max_lat) = city
+    exact = IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir)
+    ip = IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir, raster_cell_size=cell_size)
+    rng = np.random.RandomState(1)
+    lats, lngs = rng.uniform(min_lat, max_lat, 20000), rng.uniform(min_lng, max_lng, 20000)
+
+    points = np.column_stack((lngs, lats))
+    _, _, _, fell_back = ip.raster.lookup(points)
+    # enough labels are answered from the raster to check its error bound on
+    assert (~fell_back).sum() > 5000
+
+    distances, middleness, segment_ids = ip.compute_proximity_many(lats, lngs, return_segment_ids=True)
+    exact_distances, exact_middleness, exact_segment_ids = exact.compute_proximity_many(lats, lngs,
+                                                                                         return_segment_ids=True)
+    assert (segment_ids == exact_segment_ids).all()
+    assert np.abs(distances - exact_distances).max() <= ip.raster.error_bound + 1e-9
+    np.testing.assert_array_equal(distances[fell_back], exact_distances[fell_back])
+
+    # middleness is off by at most 200 * error_bound / segment length percentage points
+    segment_lengths = exact.cumulative_lengths_metric[exact.segment_offsets[segment_ids + 1] - 1]
+    assert (np.abs(middleness - exact_middleness) <= 200 * ip.raster.error_bound / segment_lengths + 1e-9).all()
@@ -0,0 +1,89 @@
+import json
+import os
+import threading
+import numpy as np
+from synthetic_city import make_city, get_bounds
+from intersection_proximity import CityRegistry, IntersectionProximity
+from intersection_proximity import _registry
+from intersection_proximity._intersection_proximity import get_intermediates_path
+
+SIZE = 6
+SHIFT = 0.1  # degrees of longitude between the two cities
+
+
+def make_cities(tmp_path):
+    """
+    Make two synthetic cities side by side, of which only the first is preprocessed
+    :return: (city configs, cache dir)
+    """
+    city_configs = {'a': make_city(str(tmp_path / 'a'), SIZE), 'b': make_city(str(tmp_path / 'b'), SIZE)}
+    with open(city_configs['b']['street_network_filename']) as f:
+        streets = json.load(f)
+    for feature in streets['features']:
+        for c in feature['geometry']['coordinates']:
+            c[0] += SHIFT
+    with open(city_configs['b']['street_network_filename'], 'w') as f:
+        json.dump(streets, f)
+
+    cache_dir = str(tmp_path / 'cache')
+    IntersectionProximity(city_configs['a'], cache_dir=cache_dir)
+    return city_configs, cache_dir
+
+
+def get_center(shift=0.0):
+    min_lng, min_lat, max_lng, max_lat = get_bounds(SIZE)
+    return (min_lat + max_lat) / 2, (min_lng + max_lng) / 2 + shift
+
+
+def test_cities_load_lazily(tmp_path):
+    city_configs, cache_dir = make_cities(tmp_path)
+    registry = CityRegistry(city_configs, cache_dir=cache_dir)
+
+    assert registry.compute_proximity(*get_center()) is not None
+    assert registry.loaded_cities() == ['a']
+    # b was routed to from its street network file, without preprocessing it
+    assert not os.path.exists(get_intermediates_path(city_configs['b'], cache_dir))
+
+    assert registry.city_for(*get_center(SHIFT)) == 'b'
+    distances, _ = registry.compute_proximity_many(*zip(get_center(), get_center(SHIFT)))
+    assert np.isfinite(distances).all()
+    assert sorted(registry.loaded_cities()) == ['a', 'b']
+
+
+def test_cities_without_inputs_are_skipped(tmp_path):
+    city_configs, cache_dir = make_cities(tmp_path)
+    city_configs['c'] = {key: str(tmp_path / 'missing' / os.path.basename(filename))
+                         for key, filename in city_configs['a'].items()}
+    registry = CityRegistry(city_configs, cache_dir=cache_dir)
+
+    assert registry.bounds('c') is None
+    assert registry.compute_proximity(*get_center()) is not None
+    assert registry.loaded_cities() == ['a']
+
+
+def test_loading_a_city_doesnt_block_others(tmp_path, monkeypatch):
+    city_configs, cache_dir = make_cities(tmp_path)
+    registry = CityRegistry(city_configs, cache_dir=cache_dir)
+    registry.get('a')
+
+    loading, release = threading.Event(), threading.Event()
+
+    def load_slowly(city_config, **kwargs):
+        if city_config is city_configs['b']:
+            loading.set()
+            release.wait(30)
+        return IntersectionProximity(city_config, **kwargs)
+    monkeypatch.setattr(_registry, 'IntersectionProximity', load_slowly)
+
+    load_b = threading.Thread(target=registry.get, args=('b',))
+    load_b.start()
+    try:
+        assert loading.wait(30)
+        query_a = threading.Thread(target=registry.compute_proximity, args=get_center())
+        query_a.start()
+        query_a.join(10)
+        assert not query_a.is_alive()
+    finally:
+        release.set()
+        load_b.join()
+    assert registry.loaded_cities() == ['a', 'b']
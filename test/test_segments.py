@@ -0,0 +1,65 @@
+import filecmp
+import os
+import pickle
+import numpy as np
+from synthetic_city import make_city, BLOCK_SIZE
+from intersection_proximity._intersection_proximity import get_intermediate_files
+from intersection_proximity.preprocessing import run_preprocess, multiplier
+
+# Streets are cut at every vertex that is one of their intersection points. These pin that segmentation, which
+# differs from the cut_street of earlier versions: that only cut a street where its intersection point, truncated to
+# 1e-5 degrees, was less than 1e-5 degrees from it, so it skipped crossings depending on how coordinates truncated.
+
+
+def preprocess(directory, size, kind, seed=0):
+    city_config = make_city(directory, size, kind, seed)
+    settings = {**city_config, **get_intermediate_files(city_config, intermediates_path=directory)}
+    run_preprocess(settings)
+    with open(settings['real_segments_output_filename'], 'rb') as f:
+        segments = pickle.load(f)
+    with open(settings['segment_streets_filename'], 'rb') as f:
+        segment_streets = pickle.load(f)
+    with open(settings['intersection_points_filename'], 'rb') as f:
+        intersection_points = pickle.load(f)
+    return segments, segment_streets, intersection_points
+
+
+def get_files(directory):
+    """
+    :return: sorted paths of every file under a directory, relative to it
+    """
+    return sorted(os.path.relpath(os.path.join(root, filename), directory)
+                  for root, _, filenames in os.walk(directory) for filename in filenames)
+
+
+def test_grid_segments(tmp_path):
+    segments, _, _ = preprocess(str(tmp_path), 5, 'grid')
+    # 5 streets each way, cut into a segment per block at every crossing
+    assert len(segments) == 40
+    for segment in segments:
+        coords = np.asarray(segment.coords)
+        assert np.isclose(np.abs(coords[-1] - coords[0]).sum(), BLOCK_SIZE)
+
+
+def test_irregular_segments(tmp_path):
+    segments, segment_streets, intersection_points = preprocess(str(tmp_path), 10, 'irregular')
+    assert len(segments) == 163
+    for segment, street_name in zip(segments, segment_streets):
+        keys = (np.asarray(segment.coords) * multiplier).astype(np.int64)
+        # no segment runs through an intersection of its street
+        for key in map(tuple, keys[1:-1].tolist()):
+            assert street_name not in intersection_points.get(key, ())
+
+
+def test_workers_write_the_same_intermediates(tmp_path):
+    city_config = make_city(str(tmp_path / 'input'), 10, 'irregular')
+    for workers in (1, 2):
+        intermediates_path = str(tmp_path / 'workers-{}'.format(workers))
+        os.mkdir(intermediates_path)
+        run_preprocess({**city_config, **get_intermediate_files(city_config, intermediates_path=intermediates_path)},
+                       workers=workers)
+
+    serial, parallel = str(tmp_path / 'workers-1'), str(tmp_path / 'workers-2')
+    _, mismatch, errors = filecmp.cmpfiles(serial, parallel, get_files(serial), shallow=False)
+    assert get_files(serial) == get_files(parallel)
+    assert mismatch == [] and errors == []
@@ -0,0 +1,28 @@
+import pandas as pd
+import pytest
+from synthetic_city import make_city, write_dbf
+from intersection_proximity import IntersectionProximity
+from intersection_proximity.preprocessing import generate_street_edge_name_map
+
+
+def test_missing_way_ids(tmp_path):
+    city_config = make_city(str(tmp_path / 'input'), 5)
+    way_ids = pd.read_csv(city_config['osm_way_ids'])
+    # the road network dump lacks the way of the first street
+    missing_way_id = way_ids['osm_way_id'][0]
+    names = {way_id: '{} St'.format(way_id) for way_id in way_ids['osm_way_id'].unique() if way_id != missing_way_id}
+    write_dbf(city_config['road_network_dump'], sorted(names.items()))
+
+    street_edge_name_file = str(tmp_path / 'street-edge-name.csv')
+    missing = way_ids['osm_way_id'] == missing_way_id
+    with pytest.warns(UserWarning, match="{} street edges have an osm_way_id that is not in".format(missing.sum())):
+        generate_street_edge_name_map(city_config['road_network_dump'], city_config['osm_way_ids'],
+                                      street_edge_name_file)
+    edge_names = pd.read_csv(street_edge_name_file)
+    assert edge_names['street_edge_id'].tolist() == way_ids['street_edge_id'][~missing].tolist()
+    assert edge_names['street_name'].tolist() == [names[way_id] for way_id in way_ids['osm_way_id'][~missing]]
+
+    # the other streets are preprocessed as usual: the 40 segments of the city, but the 4 of the first street
+    with pytest.warns(UserWarning):
+        ip = IntersectionProximity(city_config, cache_results=False, cache_dir=str(tmp_path / 'cache'))
+    assert len(ip.segment_offsets) - 1 == 36
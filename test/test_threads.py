@@ -0,0 +1,32 @@
+from concurrent.futures import ThreadPoolExecutor
+import pytest
+from intersection_proximity import IntersectionProximity
+
+THREADS = 8
+
+
+@pytest.mark.parametrize('options', [{}, {'raster_cell_size': 8}, {'max_distance': 50}])
+def test_threads_match_serial(city, labels, options):
+    city_config, cache_dir, _ = city
+    serial = IntersectionProximity(city_config, cache_results=False, cache_dir=cache_dir, **options)
+    # a cache small enough to evict entries while other threads use it
+    ip = IntersectionProximity(city_config, cache_size=200, cache_dir=cache_dir, thread_safe=True, metrics=True,
+                               **options)
+    # every label twice, so that threads find each other's results in the cache
+    lats, lngs = list(labels[0][:500]) * 2, list(labels[1][:500]) * 2
+
+    expected = [serial.compute_proximity(lat, lng) for lat, lng in zip(lats, lngs)]
+    with ThreadPoolExecutor(THREADS) as executor:
+        results = list(executor.map(ip.compute_proximity, lats, lngs))
+    assert results == expected
+
+    stats = ip.proximity_cache.stats()
+    assert stats['evictions'] > 0 and stats['hits'] + stats['misses'] == len(lats)
+    metrics = ip.metrics.as_dict()
+    assert metrics['stage_seconds']['search']['count'] == metrics['candidates']['count']
+
+
+def test_rtree_is_not_thread_safe(city):
+    city_config, cache_dir, _ = city
+    with pytest.raises(Exception, match="can't be queried from several threads"):
+        IntersectionProximity(city_config, cache_dir=cache_dir, thread_safe=True, index_backend='rtree')
@@ -0,0 +1,96 @@
+import os
+import json
+import numpy as np
+import pytest
+from synthetic_city import make_city, get_bounds
+from intersection_proximity import IntersectionProximity
+from intersection_proximity import preprocessing
+
+# An incremental update of a city's intermediates must give the same results as preprocessing the edited city from
+# scratch, also when an earlier attempt at the update failed partway.
+
+SIZE = 12
+
+
+def edit_city(city_config):
+    """
+    Move, remove and rename a few street edges of a synthetic city, like a weekly edit of a real one
+    """
+    with open(city_config['street_network_filename']) as f:
+        streets = json.load(f)
+    features = streets['features']
+    for feature in features[3:60:7]:
+        coords = feature['geometry']['coordinates']
+        for c in coords[1:-1]:
+            c[0] += 0.0002
+    removed = features.pop(20)['properties']['street_edge_id']
+    with open(city_config['street_network_filename'], 'w') as f:
+        json.dump(streets, f)
+
+    with open(city_config['osm_way_ids']) as f:
+        lines = f.readlines()
+    lines = [line for line in lines if not line.startswith('{},'.format(removed))]
+    # put an edge of one street on another one
+    edge_id, _ = lines[40].split(',')
+    lines[40] = '{},{}\n'.format(edge_id, lines[1].split(',')[1].strip())
+    with open(city_config['osm_way_ids'], 'w') as f:
+        f.writelines(lines)
+
+
+def get_labels():
+    min_lng, min_lat, max_lng, max_lat = get_bounds(SIZE)
+    rng = np.random.RandomState(0)
+    return rng.uniform(min_lat, max_lat, 3000), rng.uniform(min_lng, max_lng, 3000)
+
+
+def assert_same_results(updated, rebuilt):
+    lats, lngs = get_labels()
+    updated_results = updated.compute_proximity_many(lats, lngs)
+    rebuilt_results = rebuilt.compute_proximity_many(lats, lngs)
+    for updated_result, rebuilt_result in zip(updated_results, rebuilt_results):
+        np.testing.assert_allclose(updated_result, rebuilt_result, atol=1e-6)
+
+
+def test_update_matches_rebuild(tmp_path):
+    city_config = make_city(str(tmp_path / 'city'), SIZE, 'irregular')
+    IntersectionProximity(city_config, cache_results=False, cache_dir=str(tmp_path / 'cache'))
+    edit_city(city_config)
+
+    updated = IntersectionProximity(city_config, cache_results=False, cache_dir=str(tmp_path / 'cache'))
+    assert updated.removed_segments is not None and len(updated.removed_segments)
+    rebuilt = IntersectionProximity(city_config, cache_results=False, cache_dir=str(tmp_path / 'rebuilt'))
+    assert_same_results(updated, rebuilt)
+
+
+def test_failed_update_is_made_again(tmp_path, monkeypatch):
+    city_config = make_city(str(tmp_path / 'city'), SIZE, 'irregular')
+    IntersectionProximity(city_config, cache_results=False, cache_dir=str(tmp_path / 'cache'))
+    edit_city(city_config)
+
+    def fail(*args):
+        raise Exception("Interrupted")
+    with monkeypatch.context() as patch:
+        patch.setattr(preprocessing, 'patch_segment_index', fail)
+        with pytest.raises(Exception, match="Interrupted"):
+            IntersectionProximity(city_config, cache_results=False, cache_dir=str(tmp_path / 'cache'))
+
+    updated = IntersectionProximity(city_config, cache_results=False, cache_dir=str(tmp_path / 'cache'))
+    rebuilt = IntersectionProximity(city_config, cache_results=False, cache_dir=str(tmp_path / 'rebuilt'))
+    assert_same_results(updated, rebuilt)
+
+
+def test_missing_inputs_keep_the_intermediates(tmp_path):
+    city_config = make_city(str(tmp_path / 'city'), SIZE, 'irregular')
+    ip = IntersectionProximity(city_config, cache_results=False, cache_dir=str(tmp_path / 'cache'))
+    with open(ip.settings['input_fingerprints_filename']) as f:
+        fingerprints = f.read()
+    # a deployment that only ships the intermediate files, from before an edit
+    edit_city(city_config)
+    os.remove(city_config['road_network_dump'])
+
+    with pytest.warns(UserWarning, match="missing"):
+        loaded = IntersectionProximity(city_config, cache_results=False, cache_dir=str(tmp_path / 'cache'))
+    assert not loaded.removed_segments
+    with open(ip.settings['input_fingerprints_filename']) as f:
+        assert f.read() == fingerprints
+    assert_same_results(loaded, ip)